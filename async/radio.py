@@ -0,0 +1,188 @@
+# radio.py Internet radio client for the asynchronous VS1053 driver
+# (C) Peter Hinch 2020-2022
+# Released under the MIT licence
+
+# Plays an HTTP audio stream, e.g. from a Shoutcast or Icecast server. If the
+# server interleaves metadata (icy-metaint header) the metadata blocks are
+# removed as the stream is read: audio is read directly into the player's
+# buffer, metadata into a separate buffer, so audio is never copied or moved.
+# The player's buffer is the jitter buffer: its size is set by the VS1053
+# buffered arg. See ASYNC.md section 9.
+
+# Usage:
+# player = VS1053(SPI(2), reset, dreq, xdcs, xcs, buffered=16384)
+# radio = Radio(player, 'http://example.com:8000/stream')
+# asyncio.create_task(radio.play())
+# ...
+# print(radio.title, radio.stats())
+
+import uasyncio as asyncio
+
+_MAXMETA = const(255 * 16)  # Maximum metadata block
+_REQUEST = 'GET {} HTTP/1.0\r\nHost: {}\r\nIcy-MetaData: 1\r\nUser-Agent: micropython-vs1053\r\n\r\n'
+
+
+# Parse an http URL. Return host, port, path.
+def _parse(url):
+    if not url.startswith('http://'):
+        raise ValueError('Only http URLs are supported')
+    host, _, path = url[7:].partition('/')
+    host, _, port = host.partition(':')
+    return host, int(port) if port else 80, '/' + path
+
+
+# Resolve a redirect Location against the URL which returned it: it may be a
+# path on the same server.
+def _location(loc, host, port, path):
+    if '://' in loc:
+        return loc
+    if not loc.startswith('/'):  # Relative to the current path
+        loc = path[: path.rfind('/') + 1] + loc
+    return 'http://{}:{}{}'.format(host, port, loc)
+
+
+# Presents the body of an ICY stream to the player as an asynchronous source
+# with the metadata blocks removed. Each read is limited so that it ends at a
+# metadata boundary.
+class _ICY:
+
+    def __init__(self, radio, reader, metaint):
+        self._radio = radio
+        self._s = reader
+        self._readinto = hasattr(reader, 'readinto')
+        self._metaint = metaint
+        self._left = metaint  # Audio bytes before next metadata block
+        self._meta = bytearray(_MAXMETA)
+        self._mlen = bytearray(1)
+
+    async def _read(self, buf):  # Read into buf. Return no. of bytes read.
+        if self._readinto:
+            return await self._s.readinto(buf)
+        data = await self._s.read(len(buf))  # Firmware lacks readinto
+        n = len(data)
+        buf[:n] = data
+        return n
+
+    async def _readexactly(self, buf):
+        mv = memoryview(buf)
+        n = 0
+        while n < len(buf):
+            r = await self._read(mv[n:])
+            if not r:
+                raise EOFError
+            n += r
+
+    async def _metadata(self):
+        await self._readexactly(self._mlen)
+        n = self._mlen[0] * 16
+        if n:
+            mv = memoryview(self._meta)[:n]
+            await self._readexactly(mv)
+            self._radio._metadata(bytes(mv))
+        self._left = self._metaint
+
+    async def readinto(self, buf):
+        if not self._metaint:
+            return await self._read(buf)
+        if not self._left:
+            try:
+                await self._metadata()
+            except EOFError:
+                return 0
+        if len(buf) > self._left:
+            buf = memoryview(buf)[: self._left]
+        n = await self._read(buf)
+        self._left -= n
+        return n
+
+
+class Radio:
+
+    def __init__(self, player, url, prebuffer=None, watermarks=None, callback=None):
+        self._player = player
+        self.url = url
+        self._prebuffer = prebuffer
+        self._watermarks = watermarks
+        self._cb = callback  # Called with the new title when it changes
+        self.headers = {}  # Response headers (lower case names)
+        self.title = ''  # StreamTitle from metadata
+        self.metadata = 0  # Metadata blocks received
+        self._writer = None
+
+    # Called by _ICY with the contents of a metadata block, a sequence of
+    # key='value'; pairs padded with zeros.
+    def _metadata(self, data):
+        self.metadata += 1
+        try:
+            data = data.rstrip(b'\0').decode()
+        except UnicodeError:
+            return
+        i = data.find("StreamTitle='")
+        if i >= 0:
+            j = data.find("';", i + 13)
+            if j < 0:  # Last pair: the terminating ; may be omitted
+                j = data.rfind("'")
+                if j < i + 13:  # No closing quote
+                    j = len(data)
+            title = data[i + 13 : j]
+            if title != self.title:
+                self.title = title
+                if self._cb is not None:
+                    self._cb(title)
+
+    # Connect, following up to 4 redirects. Return the reader with the
+    # response headers consumed.
+    async def _connect(self):
+        url = self.url
+        for _ in range(5):
+            host, port, path = _parse(url)
+            reader, writer = await asyncio.open_connection(host, port)
+            self._writer = writer
+            writer.write(_REQUEST.format(path, host).encode())
+            await writer.drain()
+            status = (await reader.readline()).split()
+            code = int(status[1]) if len(status) > 1 else 0
+            self.headers = {}
+            while True:
+                line = await reader.readline()
+                if not line or line == b'\r\n' or line == b'\n':
+                    break
+                try:
+                    name, _, value = line.decode().partition(':')
+                except UnicodeError:
+                    continue
+                self.headers[name.strip().lower()] = value.strip()
+            if code in (301, 302, 303, 307, 308) and 'location' in self.headers:
+                self._close()
+                url = _location(self.headers['location'], host, port, path)
+                continue
+            if code != 200:
+                self._close()
+                raise OSError('HTTP status {}'.format(code))
+            return reader
+        raise OSError('Too many redirects')
+
+    def _close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    # Play the stream until it ends, the connection fails or stop() is called.
+    async def play(self):
+        reader = await self._connect()
+        try:
+            src = _ICY(self, reader, int(self.headers.get('icy-metaint', 0)))
+            await self._player.play(src, self._prebuffer, self._watermarks)
+        finally:
+            self._close()
+
+    async def stop(self):
+        await self._player.cancel()
+
+    # Buffer health from the player with stream details.
+    def stats(self):
+        st = self._player.buffer_stats() or {}
+        st['metadata'] = self.metadata
+        st['bitrate'] = self.headers.get('icy-br')
+        st['name'] = self.headers.get('icy-name')
+        return st
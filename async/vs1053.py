@@ -11,13 +11,25 @@
 import time
 import os
 import uasyncio as asyncio
+from array import array
 
+# V0.1.15 play skips leading metadata (tags, album art) by seeking.
+# V0.1.14 Jitter buffer control and buffer health for async sources. radio.py.
+# V0.1.13 play accepts asynchronous sources.
+# V0.1.12 Gapless play_list.
+# V0.1.11 Accept an SPIBus to share the SPI bus with the SD card at its own rate.
+# V0.1.10 Record to any stream. wav_header is public.
+# V0.1.9 Ogg Vorbis recording using the VLSI encoder plugin.
+# V0.1.8 Asynchronous recording with optional file preallocation.
+# V0.1.7 Cache register values and batch SCI accesses to reduce SPI traffic.
+#        Fast plugin loading. Load plugins from a buffer.
+# V0.1.6 Optional interrupt driven DREQ wait. Fix buffered mode cancellation.
 # V0.1.5 Buffered read option for ESP32 compatibility.
 # V0.1.4 .play efficiency improvements, test with Pico
 # V0.1.3 Synchronous code in play loop
 # V0.1.2 Add patch facility
 # V0.1.1 Bugfix: SPI baudrate was wrong during reset.
-__version__ = (0, 1, 5)
+__version__ = (0, 1, 15)
 
 # Before setting, the internal clock runs at 12.288MHz. Data P7: "the
 # maximum speed for SCI reads is CLKI/7" hence max initial baudrate is
@@ -25,7 +37,7 @@ __version__ = (0, 1, 5)
 _INITIAL_BAUDRATE = const(1_000_000)
 # 12.288*3.5/4 = 10.752MHz for data read (using _SCI_CLOCKF,0x8800)
 _DATA_BAUDRATE = const(10_752_000)  # Speed for data transfers. On Pyboard D
-# actual rate is 9MHz shared with SD card - sdcard.py uses 1.32MHz.
+# actual rate is 9MHz. sdcard.py negotiates its own rate: see spibus.py.
 # RP2 rate is 10,416,666
 _SCI_BAUDRATE = const(5_000_000)
 
@@ -40,12 +52,15 @@ _SCI_WRAM = const(0x6)
 _SCI_WRAMADDR= const(0x7)
 _SCI_HDAT0 = const(0x8)
 _SCI_HDAT1 = const(0x9)
-# _SCI_AIADDR = const(0xa)
+_SCI_AIADDR = const(0xa)
 _SCI_VOL = const(0xb)
-# _SCI_AICTRL0 = const(0xc)
-# _SCI_AICTRL1 = const(0xd)
-# _SCI_AICTRL2 = const(0xe)
-# _SCI_AICTRL3 = const(0xf)
+_SCI_AICTRL0 = const(0xc)
+_SCI_AICTRL1 = const(0xd)
+_SCI_AICTRL2 = const(0xe)
+_SCI_AICTRL3 = const(0xf)
+
+# Registers whose values are cached: MODE BASS CLOCKF VOL AICTRL0-3
+_SHADOWED = const(0xf80d)
 
 # Mode register bits: Public
 SM_DIFF = const(0x01)  # Invert left channel (why?)
@@ -58,12 +73,12 @@ _SM_RESET = const(0x04)
 _SM_CANCEL = const(0x08)
 _SM_TESTS = const(0x20)
 _SM_SDINEW = const(0x800)
+_SM_ADPCM = const(0x1000)
 # Unused and private
 # _SM_STREAM = const(0x40)
 # _SM_DACT = const(0x100)
 # _SM_SDIORD = const(0x200)
 # _SM_SDISHARE = const(0x400)
-# _SM_ADPCM = const(0x1000)
 # _SM_ADPCM_HP = const(0x2000)
 # _SM_CLK_RANGE = const(0x8000)
 
@@ -75,46 +90,334 @@ _POS_MS_MS = const(0x1e28)
 _IO_DIRECTION = const(0xc017)  # Datasheet 11.10
 _IO_READ = const(0xc018)
 _IO_WRITE = const(0xc019)
+_INT_ENABLE = const(0xc01a)
+
+_PATCH_BUF = const(1024)  # Plugin loader read buffer
+
+# Recording patches. RAM-efficient storage.
+_PATCH = array('H', (0x3e12, 0xb817, 0x3e14, 0xf812, 0x3e01, 0xb811, 0x0007, 0x9717,
+            0x0020, 0xffd2, 0x0030, 0x11d1, 0x3111, 0x8024, 0x3704, 0xc024,
+            0x3b81, 0x8024, 0x3101, 0x8024, 0x3b81, 0x8024, 0x3f04, 0xc024,
+            0x2808, 0x4800, 0x36f1, 0x9811))
+_PATCH1 = array('H', (0x2a00, 0x040e))
+
+_REC_BUF = const(512)  # Size of each of the two recording buffers
+_REC_BURST = const(128)  # Words in chip buffer which trigger a drain
+_OGG_WPMS = const(12)  # Ogg encoder output words/ms assumed for polling (~200kbps)
 
-_BUF_SIZE = 2048
-_BUF_MASK = _BUF_SIZE - 1
+_HDAT0_READ = b'\x03\x08\xff\xff'  # SCI read of SCI_HDAT0
+
+# Header for IMA ADPCM wav file
+_HEADER = (b'RIFF\x00\x00\x00\x00WAVEfmt '
+            b'\x14\x00\x00\x00\x11\x00\x02\x00\x40\x1f\x00\x00\xae\x1f\x00\x00'
+            b'\x00\x02\x04\x00\x02\x00\xf9\x01fact\x04\x00\x00\x00'
+            b'\x00\x00\x00\x00data\x00\x00\x00\x00')  # Template.
+
+_BUF_SIZE = 2048  # Default buffer size
+_MAXREAD = const(2048)  # Maximum bytes per refill read: limits blocking time
+_STARVE_MS = const(5)  # Poll interval while awaiting data from an asynchronous source
+_MINREAD = const(256)  # Minimum free space for a read from an asynchronous source
+_MAXHEAD = const(64)  # Longest FLAC or RIFF header block retained when skipping metadata
 """
 Buffering: aim is to fill the software buffer during the periods when the VS1053
 hardware buffer is more than 2/3 full and unable to accept data. Thus file
 reading time has no impact on performance when the hardware buffer is refilled.
 
+Refills are whole 512 byte sectors at sector aligned file offsets. While the
+buffer holds less than the high watermark, one read is done on each pass while
+dreq is low. If it falls below the low watermark, reads are done regardless of
+dreq.
+
 Buffered play does not use native code, ensuring compatibility with ESP32.
 """
+# An SCI session sets the SPI baudrate for register access once for a sequence
+# of reads and writes, restoring the data rate on exit. Sessions may be nested.
+class _Session:
+
+    def __init__(self, dev):
+        self._dev = dev
+        self._depth = 0
+
+    def __enter__(self):
+        if not self._depth:
+            d = self._dev
+            d._spi.init(baudrate = _INITIAL_BAUDRATE if d._slow_spi else _SCI_BAUDRATE)
+        self._depth += 1
+        return self
+
+    def __exit__(self, *_):
+        self._depth -= 1
+        if not self._depth:
+            self._dev._spi.init(baudrate=_DATA_BAUDRATE)
+
+
+# Complete a wav header template for nsamples 16 bit words recorded at sf.
+# Data 10.8.4. Stereo block is 256 words, mono 128.
+def _wav_header(buf, nsamples, sf, stereo):
+    chans = 2 if stereo else 1
+    nblocks = nsamples // (128 * chans)
+    buf[4:8] = int.to_bytes(nblocks * 256 * chans + 52, 4, 'little')  # ChunkSize
+    buf[22] = chans  # NumChannels
+    buf[24:28] = int.to_bytes(sf, 4, 'little')  # SampleRate
+    buf[28:32] = int.to_bytes(round(sf * 256 * chans / 505), 4, 'little')  # ByteRate
+    buf[33] = chans  # BlockAlign is 256 * chans
+    buf[48:52] = int.to_bytes(nblocks * 505, 4, 'little')  # NumOfSamples
+    buf[56:60] = int.to_bytes(nblocks * 256 * chans, 4, 'little')  # SubChunk3Size
+
+
+# Return the wav header for nsamples 16 bit words of IMA ADPCM data recorded at
+# sf. May be used with record_stream to create a wav file.
+def wav_header(nsamples=0, sf=8000, stereo=True):
+    buf = bytearray(_HEADER)
+    _wav_header(buf, nsamples, sf, stereo)
+    return buf
+
+# Identify the format of a track from its first bytes, leaving the stream
+# position unchanged. MP3 and AAC ADTS streams are sequences of self contained
+# frames which may be concatenated.
+def _format(s, buf=bytearray(4)):
+    n = s.readinto(buf)
+    s.seek(-n, 1)
+    if n < 4:
+        return None
+    if buf[0] == 0x49 and buf[1] == 0x44 and buf[2] == 0x33:  # ID3 tag
+        return 'mp3'
+    if buf[0] == 0xff and buf[1] & 0xe0 == 0xe0:  # Frame sync
+        return 'mp3' if buf[1] & 6 else 'aac'  # Layer bits are 0 for AAC
+    return bytes(buf)  # e.g. b'RIFF', b'fLaC', b'OggS'
+
+_GAPLESS = ('mp3', 'aac')
+
+# Metadata preceding the audio in a seekable stream is skipped by seeking
+# rather than being sent to the chip: ID3v2 and APEv2 tags, FLAC metadata
+# blocks other than STREAMINFO (e.g. PICTURE) and RIFF chunks other than fmt
+# and fact (e.g. LIST). Embedded album art can otherwise take seconds to send.
+# The stream is left at the start of the audio. Return the header which must
+# be sent before it: b'' unless a FLAC or RIFF header has been rebuilt. A
+# stream which is not seekable, or whose metadata is not understood, is
+# unchanged.
+def _skip(s, buf=bytearray(32)):
+    if not hasattr(s, 'seek'):  # e.g. a socket or a _Playlist
+        return b''
+    try:
+        start = s.tell()
+    except (AttributeError, OSError):
+        return b''
+    try:
+        pos, head = _scan(s, start, buf)
+    except ValueError:  # Truncated or malformed
+        pos, head = start, b''
+    if pos - start <= len(head):  # Nothing skipped: play the stream as it is
+        pos, head = start, b''
+    s.seek(pos)
+    return head
+
+# Return the position of the audio and the header to precede it.
+def _scan(s, pos, buf):
+    while True:  # Leading tags
+        s.seek(pos)
+        n = s.readinto(buf)
+        if n >= 10 and buf[0:3] == b'ID3' and not (buf[6] | buf[7] | buf[8] | buf[9]) & 0x80:
+            pos += 10 + (buf[6] << 21 | buf[7] << 14 | buf[8] << 7 | buf[9])  # Syncsafe size
+            if buf[5] & 0x10:  # Footer present
+                pos += 10
+        elif n == 32 and buf[0:8] == b'APETAGEX' and buf[23] & 0x20:  # APEv2 header
+            pos += 32 + int.from_bytes(buf[12:16], 'little')
+        else:
+            break
+    if n < 4:
+        raise ValueError
+    if buf[0:4] == b'fLaC':  # Retain STREAMINFO, flagged as the last block
+        pos += 4
+        head = b''
+        last = 0
+        while not last:
+            s.seek(pos)
+            if s.readinto(buf, 4) < 4:
+                raise ValueError
+            last = buf[0] & 0x80
+            size = buf[1] << 16 | buf[2] << 8 | buf[3]
+            if not buf[0] & 0x7f:  # STREAMINFO
+                if size > _MAXHEAD:
+                    raise ValueError
+                head = b'fLaC\x80' + bytes(buf[1:4]) + s.read(size)
+            pos += 4 + size
+        if not head:
+            raise ValueError
+        return pos, head
+    if n >= 12 and buf[0:4] == b'RIFF' and buf[8:12] == b'WAVE':
+        pos += 12
+        head = b''
+        while True:
+            s.seek(pos)
+            if s.readinto(buf, 8) < 8:
+                raise ValueError
+            cid = bytes(buf[0:4])
+            size = int.from_bytes(buf[4:8], 'little')
+            if cid == b'data':
+                break
+            if cid == b'fmt ' or cid == b'fact':
+                if size > _MAXHEAD:
+                    raise ValueError
+                head += bytes(buf[0:8]) + s.read(size + (size & 1))  # Chunks are word aligned
+            pos += 8 + size + (size & 1)
+        if not head.startswith(b'fmt '):
+            raise ValueError
+        head += bytes(buf[0:8])  # data chunk header
+        riff = min(4 + len(head) + size, 0xffffffff)
+        return pos + 8, b'RIFF' + riff.to_bytes(4, 'little') + b'WAVE' + head
+    return pos, b''
+
+# Presents a playlist to the player as a series of segments, each read as a
+# single stream. Consecutive tracks of the same framed format form one
+# segment: when a track reaches EOF the next is opened and read into the
+# remainder of the same buffer, so play is gapless. A track of another format
+# starts a new segment, requiring the end of stream procedure. Items are file
+# names or seekable streams. Files opened here are closed here. Leading
+# metadata is skipped: the player sends .head before each segment.
+class _Playlist:
+
+    def __init__(self, items):
+        self._it = iter(items)
+        self._s = None  # Current stream. None at end of segment.
+        self._fmt = None
+        self._opened = False  # Current stream was opened from a file name
+        self.head = b''  # Header preceding the segment's data (see _skip)
+        self._pend = self._open()  # First track of next segment
+
+    def _open(self):  # Return (stream, format, opened, head) for next track
+        for item in self._it:
+            opened = isinstance(item, str)
+            s = open(item, 'rb') if opened else item
+            head = _skip(s)
+            return s, bytes(head[:4]) if head else _format(s), opened, head
+        return None, None, False, b''
+
+    def _close(self):
+        if self._opened:
+            self._s.close()
+        self._s = None
+
+    def segment(self):  # Start next segment. Return False at end of list.
+        if self._s is None:
+            self._s, self._fmt, self._opened, self.head = self._pend
+            self._pend = None, None, False, b''
+        return self._s is not None
+
+    def ended(self):  # Segment has been read to its end
+        return self._s is None
+
+    def tell(self):
+        return self._s.tell()
+
+    def readinto(self, buf, nbytes=None):
+        s = self._s
+        if s is None:
+            return 0
+        n = len(buf) if nbytes is None else min(nbytes, len(buf))
+        got = s.readinto(buf, n)
+        while got < n:  # End of track
+            self._close()
+            nxt = self._open()
+            if nxt[1] not in _GAPLESS or nxt[1] != self._fmt:  # End of segment
+                self._pend = nxt
+                break
+            s, _, self._opened, _ = nxt
+            self._s = s
+            got += s.readinto(memoryview(buf)[got:n])
+        return got
+
+    def close(self):  # Close any files opened here
+        if self._s is not None:
+            self._close()
+        s, _, opened, _ = self._pend
+        if opened:
+            s.close()
+
+
+# Presents a source with an awaitable read(n), e.g. a StreamReader on firmware
+# lacking readinto, as one with an awaitable readinto.
+class _AReader:
+
+    def __init__(self, s):
+        self._s = s
+
+    async def readinto(self, buf):
+        data = await self._s.read(len(buf))
+        n = len(data)
+        buf[:n] = data
+        return n
+
 # xcs is chip XSS/
 # xdcs is chipXDCS/BSYNC/
 # sdcs is SD card CS/
 class VS1053:
 
-    def __init__(self, spi, reset, dreq, xdcs, xcs, sdcs=None, mp=None, buffered=False):
+    def __init__(self, spi, reset, dreq, xdcs, xcs, sdcs=None, mp=None, buffered=False,
+                 irq=False, watermarks=None):
         self._reset = reset
         self._dreq = dreq  # Data request
         self._xdcs = xdcs  # Data CS
         self._xcs = xcs  # Register CS
         self._mp = mp
+        bus = None
+        if hasattr(spi, 'device'):  # SPIBus: the chip and SD card each have a device
+            bus, spi = spi, spi.device('vs1053', _DATA_BAUDRATE)
         self._spi = spi
         self._cbuf = bytearray(4)  # Command buffer
+        self._wbuf = bytearray(2)  # Data word for SCI multiple write
+        self._hbuf = bytearray(4)  # Response to _HDAT0_READ
+        self._shadow = [None] * 16  # Cached register values
+        self._session = _Session(self)  # Usage: with self._session:
         self._slow_spi = True
         self.reset()
         if ((sdcs is not None) and (mp is not None)):
             import sdcard
             import os
-            sd = sdcard.SDCard(spi, sdcs)
+            sd = sdcard.SDCard(spi if bus is None else bus.device('sd'), sdcs)
             vfs = os.VfsFat(sd)
             os.mount(vfs, mp)
         self._cancnt = 0  # If >0 cancellation in progress
         self._playing = False
+        self._recording = False
+        self._overrun = 0  # Recording
+        self._nsamples = 0
+        self._flag = None  # Polled DREQ
+        if irq:  # Tasks waiting on DREQ are paused until it goes high
+            self._flag = asyncio.ThreadSafeFlag()
+            dreq.irq(handler=self._dreq_irq, trigger=dreq.IRQ_RISING)
         self._spi.init(baudrate=_DATA_BAUDRATE)
+        self._buf = None  # Play buffer
+        self._jitter = None, None  # Prebuffer and watermarks for asynchronous sources
+        self._health = None  # Returns buffer health dict
         if buffered:
-            self._buf = bytearray(_BUF_SIZE)
-            self._mvb = memoryview(self._buf)
-            self.play = self._bplay
+            size = _BUF_SIZE if buffered is True else buffered
+            if size < _BUF_SIZE or size & (size - 1):
+                raise ValueError('Buffer size must be a power of 2 >= 2048')
+            low, high = (size // 4, size) if watermarks is None else watermarks
+            # Reads are whole sectors: below low a sector of free space is needed
+            if not 32 <= low <= min(high, size - 512) or high > size:
+                raise ValueError('Watermarks must satisfy 32 <= low <= high <= buffer size '
+                                 'and low <= buffer size - 512')
+            self._low = low
+            self._high = high
+            self._bufinit(size)
+            self._play = self._bplay
         else:
-            self.play = self._uplay
+            self._play = self._uplay
+
+    def _bufinit(self, size):
+        self._buf = bytearray(size)
+        mvb = memoryview(self._buf)
+        # Precomputed views ensure that the play loop does not allocate.
+        self._chunks = tuple(mvb[n : n + 32] for n in range(0, size, 32))
+        self._blocks = tuple(mvb[n:] for n in range(0, size, 512))  # Refill
+
+    # While the VS1053 buffer is full the play methods yield if DREQ is polled,
+    # otherwise they wait on self._flag. The wait is coded inline: calling an
+    # async helper would allocate a coroutine each time.
+    def _dreq_irq(self, _):
+        self._flag.set()
 
     def _wait_ready(self):
         self._xdcs(1)
@@ -124,38 +427,54 @@ class VS1053:
 
     def _write_reg(self, addr, value):  # Datasheet 7.4
         self._wait_ready()
-        self._spi.init(baudrate = _INITIAL_BAUDRATE if self._slow_spi else _SCI_BAUDRATE)
         b = self._cbuf
         b[0] = 2  # WRITE
         b[1] = addr & 0xff
         b[2] = (value >> 8) & 0xff
         b[3] = value & 0xff
-        self._xcs(0)
-        self._spi.write(b)
-        self._xcs(1)
-        self._spi.init(baudrate=_DATA_BAUDRATE)
+        with self._session:
+            self._xcs(0)
+            self._spi.write(b)
+            self._xcs(1)
+        if (1 << addr) & _SHADOWED:
+            if addr == _SCI_MODE and value & _SM_RESET:
+                self._invalidate()  # Chip may revert to defaults
+            self._shadow[addr] = value & ~(_SM_RESET | _SM_CANCEL)  # Bits clear themselves
 
     def _read_reg(self, addr):  # Datasheet 7.4
         self._wait_ready()
-        self._spi.init(baudrate = _INITIAL_BAUDRATE if self._slow_spi else _SCI_BAUDRATE)
         b = self._cbuf
         b[0] = 3  # READ
         b[1] = addr & 0xff
         b[2] = 0xff
         b[3] = 0xff
-        self._xcs(0)
-        self._spi.write_readinto(b, b)
-        self._xcs(1)
-        self._spi.init(baudrate=_DATA_BAUDRATE)
-        return (b[2] << 8) | b[3]
+        with self._session:
+            self._xcs(0)
+            self._spi.write_readinto(b, b)
+            self._xcs(1)
+        v = (b[2] << 8) | b[3]
+        if (1 << addr) & _SHADOWED:
+            self._shadow[addr] = v & ~(_SM_RESET | _SM_CANCEL) if addr == _SCI_MODE else v
+        return v
+
+    # Registers written only by the driver are read from the cache. The bus is
+    # accessed only on the first read after a reset.
+    def _reg(self, addr):
+        v = self._shadow[addr]
+        return self._read_reg(addr) if v is None else v
+
+    def _invalidate(self):
+        self._shadow = [None] * 16
 
     def _read_ram(self, addr):
-        self._write_reg(_SCI_WRAMADDR, addr)
-        return self._read_reg(_SCI_WRAM)
+        with self._session:
+            self._write_reg(_SCI_WRAMADDR, addr)
+            return self._read_reg(_SCI_WRAM)
 
     def _write_ram(self, addr, data):
-        self._write_reg(_SCI_WRAMADDR, addr)
-        return self._write_reg(_SCI_WRAM, data)
+        with self._session:
+            self._write_reg(_SCI_WRAMADDR, addr)
+            self._write_reg(_SCI_WRAM, data)
 
     # Datasheet section 10.5.1: procedure for normal end of play
     async def _end_play(self, buf):
@@ -169,7 +488,7 @@ class VS1053:
         for _ in range(64):  # send up to 2048 bytes
             self.write(buf)
             await asyncio.sleep_ms(0)
-            if not self.mode() & _SM_CANCEL:
+            if not self._read_reg(_SCI_MODE) & _SM_CANCEL:
                 break
         else:  # Cancel has not been acknowledged
             self.soft_reset()
@@ -177,27 +496,85 @@ class VS1053:
         if self._read_reg(_SCI_HDAT0) or self._read_reg(_SCI_HDAT1):
             raise RuntimeError('Invalid HDAT value.')
 
+    # A plugin image is a sequence of records, each comprising little-endian
+    # words: register address, count, data. If count bit 15 is set the record
+    # is an RLE run: one data word is written count & 0x7fff times. Otherwise
+    # it is a copy run of count data words. The stream is read in large blocks
+    # and decoded in place. Long copy runs are written in pieces: this works
+    # because SCI_WRAM auto-increments.
     def _patch_stream(self, s):
-        def read_word(s, buf=bytearray(2)):
-            if s.readinto(buf) != 2:
-                raise RuntimeError('Invalid file')
-            return (buf[1] << 8) + buf[0]
+        buf = bytearray(_PATCH_BUF)
+        self._load(buf, s.readinto(buf), s)
 
+    # Load an image of n bytes in buf. If s is None buf holds the whole image,
+    # otherwise it is refilled from stream s.
+    def _load(self, buf, n, s):
+        mv = memoryview(buf)
+        i = 0  # Index of next record or data word
+        count = 0  # Words remaining in current copy run
         while True:
-            try:
-                addr = read_word(s)
-            except RuntimeError:  # Normal EOF
+            # Refill outside the SCI session as s may share the SPI bus
+            if n - i < 6 and s is not None:  # May not hold a complete RLE record
+                mv[: n - i] = mv[i : n]  # Move remainder to start
+                n -= i
+                i = 0
+                r = s.readinto(mv[n:])
+                n += r
+                if not r:  # EOF: buf holds the rest of the image
+                    s = None
+            with self._session:
+                while s is None or n - i >= 6:
+                    if count:  # Continue a copy run
+                        k = min(count, (n - i) >> 1)
+                        if not k:
+                            raise RuntimeError('Invalid file')
+                        self._write_words(addr, buf, i, k, 2)
+                        i += k << 1
+                        count -= k
+                        continue
+                    if i == n:  # Normal EOF
+                        break
+                    if n - i < 4:
+                        raise RuntimeError('Invalid file')
+                    addr = buf[i] | (buf[i + 1] << 8)
+                    count = buf[i + 2] | (buf[i + 3] << 8)
+                    i += 4
+                    if count & 0x8000:  # RLE run, replicate n samples
+                        if n - i < 2:
+                            raise RuntimeError('Invalid file')
+                        self._write_words(addr, buf, i, count & 0x7fff, 0)
+                        i += 2
+                        count = 0
+            if s is None:
                 break
-            count = read_word(s)
-            if (count & 0x8000):  # RLE run, replicate n samples
-                count &= 0x7fff
-                val = read_word(s)
-                for _ in range(count):
-                    self._write_reg(addr, val)
-            else:  # Copy run, copy n samples
-                for _ in range(count):
-                    val = read_word(s)
-                    self._write_reg(addr, val)
+        self._invalidate()  # A plugin may alter any register
+
+    # SCI multiple write (datasheet 7.4.4) of nwords little-endian words from
+    # buf[idx:] to one register. step is 2 for successive words or 0 to
+    # repeat one word. XCS stays low and DREQ is polled between words. Must be
+    # called in an SCI session.
+    def _write_words(self, addr, buf, idx, nwords, step):
+        if not nwords:
+            return
+        dreq = self._dreq
+        spi = self._spi
+        b = self._cbuf
+        w = self._wbuf
+        self._wait_ready()
+        b[0] = 2  # WRITE
+        b[1] = addr & 0xff
+        b[2] = buf[idx + 1]  # Data 7.4: MSB first
+        b[3] = buf[idx]
+        self._xcs(0)
+        spi.write(b)
+        for _ in range(nwords - 1):
+            idx += step
+            w[0] = buf[idx + 1]
+            w[1] = buf[idx]
+            while not dreq():
+                pass
+            spi.write(w)
+        self._xcs(1)
 
     def write(self, buf):
         while not self._dreq():  # minimise for speed
@@ -213,6 +590,7 @@ class VS1053:
         self._xcs(1)
         self._xdcs(1)
         self._reset(0)
+        self._invalidate()
         time.sleep_ms(20)
         self._reset(1)
         time.sleep_ms(20)
@@ -220,18 +598,19 @@ class VS1053:
 
     def soft_reset(self):
         self._slow_spi = True  # Use _INITIAL_BAUDRATE
-        self.mode_set(_SM_RESET)
-        # This has many interesting settings data P39
-        time.sleep_ms(20)  # Adafruit have a total of 200ms
-        # Data P42. P7 footnote 4 recommends xtal * 3.5 + 1: using that.
-        self._write_reg(_SCI_CLOCKF, 0x8800)
-        if self._read_reg(_SCI_CLOCKF) != 0x8800:
-            raise OSError('No VS1053 device found.')
-        time.sleep_ms(1)  # Clock setting can take 100us
-        # Datasheet suggests writing to SPI_BASS. 
-        self._write_reg(_SCI_BASS, 0)  # 0 is flat response
-        self.volume(0, 0)
-        self._wait_ready()
+        with self._session:
+            self.mode_set(_SM_RESET)
+            # This has many interesting settings data P39
+            time.sleep_ms(20)  # Adafruit have a total of 200ms
+            # Data P42. P7 footnote 4 recommends xtal * 3.5 + 1: using that.
+            self._write_reg(_SCI_CLOCKF, 0x8800)
+            if self._read_reg(_SCI_CLOCKF) != 0x8800:
+                raise OSError('No VS1053 device found.')
+            time.sleep_ms(1)  # Clock setting can take 100us
+            # Datasheet suggests writing to SPI_BASS. 
+            self._write_reg(_SCI_BASS, 0)  # 0 is flat response
+            self.volume(0, 0)
+            self._wait_ready()
         self._slow_spi = False
 
     # Range is 0 to -63.5 dB
@@ -264,9 +643,10 @@ class VS1053:
         self._write_ram(_IO_DIRECTION, bits & 0xff)
 
     def pins(self, data=None):
-        if data is not None:
-            self._write_ram(_IO_WRITE, data & 0xff)
-        return self._read_ram(_IO_READ) & 0x3FF
+        with self._session:
+            if data is not None:
+                self._write_ram(_IO_WRITE, data & 0xff)
+            return self._read_ram(_IO_READ) & 0x3FF
 
     def version(self):
         return (self._read_reg(_SCI_STATUS) >> 4) & 0x0F
@@ -277,16 +657,18 @@ class VS1053:
     def byte_rate(self):  # Data rate in bytes/sec
         return self._read_ram(_BYTE_RATE)
 
+    # Reads the chip so that transient bits such as SM_CANCEL are reported.
+    # Read-modify-write of the mode register uses the cached value.
     def mode(self):
         return self._read_reg(_SCI_MODE)
 
     def mode_set(self, bits):
-        bits |= self.mode() | _SM_SDINEW
+        bits |= self._reg(_SCI_MODE) | _SM_SDINEW
         self._write_reg(_SCI_MODE, bits)
 
     def mode_clear(self, bits):
         bits ^= 0xffff
-        bits &= self.mode()
+        bits &= self._reg(_SCI_MODE)
         self._write_reg(_SCI_MODE, _SM_SDINEW | bits)  # Ensure new bit always set
 
     def enable_i2s(self, rate=48, mclock=False):
@@ -295,64 +677,139 @@ class VS1053:
             v |= 1
         elif rate == 192:
             v |= 2
-        self._write_ram(0xC017, 0xF0)
-        self._write_ram(0xC040, v)
+        with self._session:
+            self._write_ram(0xC017, 0xF0)
+            self._write_ram(0xC040, v)
 
 # Doesn't return anything useful for MP3
 #    def pos_ms(self):  # Position into stream in ms
 #        return self._read_ram(_POS_MS_LS) | (self._read_ram(_POS_MS_MS) << 16)
 
-    async def cancel(self):
-        if self._playing:
+    # Play a stream. If its readinto method is awaitable, or it has only an
+    # awaitable read method, as with a StreamReader, data is read without
+    # blocking the scheduler. prebuffer and watermarks apply only to such
+    # sources: see _aplay. Leading metadata in a seekable stream is skipped.
+    async def play(self, s, prebuffer=None, watermarks=None):
+        if not hasattr(s, 'readinto'):
+            s = _AReader(s)
+        self._jitter = prebuffer, watermarks
+        self._head(_skip(s))
+        await self._play(s)
+
+    def _head(self, head):  # Send a header rebuilt by _skip
+        for n in range(0, len(head), 32):
+            self.write(head[n : n + 32])
+
+    # Buffer health of play from an asynchronous source: a dict, or None if
+    # there has been no such play. May be called while playing.
+    def buffer_stats(self):
+        return None if self._health is None else self._health()
+
+    async def cancel(self):  # Cancel playback or recording
+        if self._playing or self._recording:
             self._cancnt = 1  # Request
             while self._cancnt:  # In progress
                 await asyncio.sleep_ms(50)
 
+    # Play a sequence of tracks. items is an iterable of file names or seekable
+    # streams: a list may be extended while it plays. Consecutive tracks of the
+    # same framed format (MP3, AAC ADTS) are played without a gap: the next is
+    # opened and read as the current one reaches EOF. Otherwise the end of
+    # stream procedure is run between tracks. Cancellation ends the list.
+    async def play_list(self, items):
+        pl = _Playlist(items)
+        try:
+            while pl.segment():
+                self._head(pl.head)
+                await self.play(pl)
+                if not pl.ended():  # Cancelled
+                    break
+        finally:
+            pl.close()
+
+    # Data is read from the stream with readinto(buf, nbytes) using precomputed
+    # views. Buffer size is a multiple of 512. If the stream supports tell() the
+    # first read is placed so that buffer and file offsets are equal modulo 512,
+    # hence refills are in whole sectors at sector aligned file offsets even
+    # if play starts mid-sector (e.g. after skipping a header). A short read
+    # implies EOF.
     async def _bplay(self, s):  # No native decorator for max compatibility
         self._playing = True
         self._cancnt = 0
         dreq = self._dreq
-        mvb = self._mvb  # Memoryview into buffer
+        flag = self._flag  # None if DREQ is polled
+        chunks = self._chunks  # 32 byte views for SPI writes
+        blocks = self._blocks  # Views from each sector to end of buffer
+        low = self._low
+        high = self._high
+        size = len(self._buf)
+        mask = size - 1
         cnt = 0
         rptr = 0  # Buffer read pointer
-        bsize = s.readinto(self._buf)  # No. of bytes in buffer
-        wptr = bsize & _BUF_MASK  # write pointer (normally 0)
-        running = True
-        while running:
+        try:
+            rptr = s.tell() & 511
+        except (AttributeError, OSError):  # e.g. a socket
+            pass
+        bsize = s.readinto(blocks[0][rptr:]) if rptr else s.readinto(self._buf)  # No. of bytes in buffer
+        if not isinstance(bsize, int):  # Awaitable: an asynchronous source
+            bsize.close()
+            return await self._aplay(s)
+        wptr = (rptr + bsize) & mask  # write pointer (normally 0)
+        eof = bsize < size - rptr
+        if rptr & 31 and bsize > 0:  # Send the part chunk preceding a 32 byte boundary
+            n = min(32 - (rptr & 31), bsize)
+            while not dreq():
+                if flag is not None:
+                    flag.clear()  # Before testing dreq to avoid a race with the ISR
+                if flag is None or dreq():  # Polled, or the backstop: yield
+                    await asyncio.sleep_ms(0)
+                else:
+                    await flag.wait()
+            self._xdcs(0)
+            self._spi.write(chunks[rptr >> 5][rptr & 31 : (rptr & 31) + n])
+            self._xdcs(1)
+            rptr += n
+            bsize -= n
+        while bsize > 0:
             cnt += 1
             # When running, dreq goes True when on-chip buffer can hold about 640 bytes.
             # At 128Kbps dreq will be False for 40ms - at higher rates, less. So this code
             # will block for <= 40ms. The cnt ensures it can't lock the scheduler even
             # if dreq remains True forever. This is a failing condition where the
             # chip is consuming data faster than we can feed it.
-            while (not dreq()) or cnt > 30:  # 960 byte backstop
-                if cnt:  # Read once only.
-                    cnt = 0
-                    if wptr > rptr:  # Try to fill to end of buffer
-                        bsize += (n := s.readinto(mvb[wptr: _BUF_SIZE]))
-                        wptr = (wptr + n) & _BUF_MASK
-                    if wptr < rptr:
-                        bsize += (n := s.readinto(mvb[wptr:rptr]))
-                        wptr += n  
-                        # Now wptr == rptr but this can't persist for next outer loop pass
-                await asyncio.sleep_ms(0)  # Don't block while waiting on dreq
+            while (not dreq()) or cnt > 30 or (bsize < low and not eof):  # 960 byte backstop
+                cnt = 0
+                # Whole sectors of contiguous free space, up to _MAXREAD
+                n = min(size - bsize, size - wptr, _MAXREAD) & ~511
+                if n and bsize < high and not eof:
+                    bsize += (r := s.readinto(blocks[wptr >> 9], n))
+                    wptr = (wptr + r) & mask
+                    eof = r < n
+                    await asyncio.sleep_ms(0)
+                else:  # Don't block while waiting on dreq
+                    if flag is not None:
+                        flag.clear()  # Before testing dreq to avoid a race with the ISR
+                    if flag is None or dreq():  # Polled, or the backstop: yield
+                        await asyncio.sleep_ms(0)
+                    else:
+                        await flag.wait()
             self._xdcs(0)  # Fast write
-            self._spi.write(mvb[rptr : rptr + 32])
+            self._spi.write(chunks[rptr >> 5])
             self._xdcs(1)
-            rptr = (rptr + 32) & _BUF_MASK  # Bump read pointer modulo _BUF_SIZE
+            rptr = (rptr + 32) & mask  # Bump read pointer modulo buffer size
             bsize -= 32
-            running = bsize > 0
             # Check for cancelling. Datasheet section 10.5.2
             if self._cancnt:
                 if self._cancnt == 1:  # Just cancelled
                     self.mode_set(_SM_CANCEL)
-                if not self.mode() & _SM_CANCEL:  # Cancel done
+                if not self._read_reg(_SCI_MODE) & _SM_CANCEL:  # Cancel done
+                    buf = chunks[0]
                     efb = self._read_ram(_END_FILL_BYTE) & 0xff
                     for n in range(32):
-                        mvb[n] = efb
+                        buf[n] = efb
                     for n in range(64):  # send 2048 bytes of end fill byte
-                        self.write(mvb[:32])
-                    self.write(mvb[:4])  # Take to 2052 bytes
+                        self.write(buf)
+                    self.write(buf[:4])  # Take to 2052 bytes
                     if self._read_reg(_SCI_HDAT0) or self._read_reg(_SCI_HDAT1):
                         raise RuntimeError('Invalid HDAT value.')
                     break
@@ -361,7 +818,8 @@ class VS1053:
                     break
                 self._cancnt += 1  # keep feeding data from stream
         else:
-            await self._end_play(mvb[:32])
+            await self._end_play(chunks[0])
+        self._cancnt = 0
         self._playing = False
 
     @micropython.native
@@ -369,8 +827,13 @@ class VS1053:
         self._playing = True
         self._cancnt = 0
         dreq = self._dreq
+        flag = self._flag  # None if DREQ is polled
         cnt = 0
-        while s.readinto(buf):  # Read <=32 bytes
+        r = s.readinto(buf)  # Read <=32 bytes
+        if not isinstance(r, int):  # Awaitable: an asynchronous source
+            r.close()
+            return await self._aplay(s)
+        while r:
             cnt += 1
             # When running, dreq goes True when on-chip buffer can hold about 640 bytes.
             # At 128Kbps this will take 40ms - at higher rates, less. So this code
@@ -378,7 +841,12 @@ class VS1053:
             # if dreq remains True forever. This is a failing condition where the
             # chip is consuming data faster than we can feed it. 
             while (not dreq()) or cnt > 30:  # 960 byte backstop
-                await asyncio.sleep_ms(0)
+                if flag is not None:
+                    flag.clear()  # Before testing dreq to avoid a race with the ISR
+                if flag is None or dreq():  # Polled, or the backstop: yield
+                    await asyncio.sleep_ms(0)
+                else:
+                    await flag.wait()
                 cnt = 0
             self._xdcs(0)  # Fast write
             self._spi.write(buf)
@@ -387,7 +855,7 @@ class VS1053:
             if self._cancnt:
                 if self._cancnt == 1:  # Just cancelled
                     self.mode_set(_SM_CANCEL)
-                if not self.mode() & _SM_CANCEL:  # Cancel done
+                if not self._read_reg(_SCI_MODE) & _SM_CANCEL:  # Cancel done
                     efb = self._read_ram(_END_FILL_BYTE) & 0xff
                     for n in range(len(buf)):
                         buf[n] = efb
@@ -401,11 +869,175 @@ class VS1053:
                     self.soft_reset()
                     break
                 self._cancnt += 1  # keep feeding data from stream
+            r = s.readinto(buf)
         else:
             await self._end_play(buf)
         self._cancnt = 0
         self._playing = False
 
+    # Play from a source with an awaitable readinto. A read may return any
+    # number of bytes after any delay: only a read of 0 bytes implies EOF. A
+    # task reads the source into the buffer while this one feeds the VS1053, so
+    # a stalled source neither blocks the scheduler nor stops buffered data
+    # being played. The buffer is thus a jitter buffer. Play starts, and resumes
+    # after the buffer has run dry, when it holds prebuffer bytes or at EOF. The
+    # reader pauses when the buffer holds watermarks[1] bytes, resuming when it
+    # holds fewer than watermarks[0]. These are per-call settings, distinct from
+    # the constructor's watermarks which govern refills from a file. In
+    # unbuffered mode the buffer is allocated on first use.
+    async def _aplay(self, s):
+        if self._buf is None:
+            self._bufinit(_BUF_SIZE)
+        size = len(self._buf)
+        prebuffer, watermarks = self._jitter
+        low, high = (size, size) if watermarks is None else watermarks
+        # Play pauses with less than 32 bytes buffered: the reader must resume
+        # before then, and play must not restart until a whole chunk is held.
+        if not 32 <= low <= high <= size:
+            raise ValueError('Watermarks must satisfy 32 <= low <= high <= buffer size')
+        if prebuffer is not None and prebuffer < 32:
+            raise ValueError('prebuffer must be >= 32')
+        # The reader stops at high or with less than _MINREAD free, so play
+        # must start before either is reached.
+        prebuffer = min(size if prebuffer is None else prebuffer, high, size - _MINREAD)
+        self._playing = True
+        self._cancnt = 0
+        dreq = self._dreq
+        flag = self._flag  # None if DREQ is polled
+        chunks = self._chunks
+        mvb = memoryview(self._buf)
+        mask = size - 1
+        bsize = 0  # No. of bytes in buffer
+        wptr = 0
+        eof = False
+        err = None  # Exception raised by the source
+        nbytes = 0  # Bytes read from source
+        reads = 0
+        lmin = size  # Lowest level while playing, before EOF
+        dry = 0  # Times the buffer has run dry
+        t0 = time.ticks_ms()
+        tstart = None  # Time to first sound (ms)
+        tdry = 0  # Time at which buffer ran dry
+        rebuffer = 0  # Total time rebuffering (ms)
+
+        def health():
+            return {'size': size, 'level': bsize, 'min': lmin, 'bytes': nbytes,
+                    'reads': reads, 'underruns': dry, 'start_ms': tstart, 'rebuffer_ms': rebuffer,
+                    'eof': eof}
+
+        self._health = health
+
+        async def fill():
+            nonlocal bsize, wptr, eof, err, nbytes, reads
+            paused = False  # Buffer has reached high watermark
+            try:
+                while True:
+                    if bsize >= high:
+                        paused = True
+                    elif bsize < low:
+                        paused = False
+                    free = size - bsize
+                    if paused or free < _MINREAD:  # Await space
+                        await asyncio.sleep_ms(_STARVE_MS)
+                        continue
+                    n = min(free, size - wptr)
+                    r = await s.readinto(mvb[wptr : wptr + n])
+                    if not r:
+                        break
+                    bsize += r
+                    nbytes += r
+                    reads += 1
+                    wptr = (wptr + r) & mask
+            except Exception as e:
+                err = e
+            eof = True
+
+        reader = asyncio.create_task(fill())
+        rptr = 0  # Buffer read pointer
+        run = False  # Feeding the VS1053: False while buffering
+        sent = False  # Data has been sent
+        ended = False
+        cnt = 0
+        try:
+            while True:
+                if not run:
+                    if self._cancnt:  # Cancelled while buffering
+                        if sent:
+                            self.soft_reset()
+                        break
+                    if bsize < prebuffer and not eof:
+                        await asyncio.sleep_ms(_STARVE_MS)
+                        continue
+                    run = True
+                    if tstart is None:
+                        tstart = time.ticks_diff(time.ticks_ms(), t0)
+                    else:
+                        rebuffer += time.ticks_diff(time.ticks_ms(), tdry)
+                if bsize < 32:
+                    if not eof:  # Buffer has run dry
+                        run = False
+                        dry += 1
+                        tdry = time.ticks_ms()
+                        await asyncio.sleep_ms(_STARVE_MS)  # Let the reader run
+                        continue
+                    if bsize > 0:  # Part chunk at EOF
+                        while not dreq():
+                            if flag is not None:
+                                flag.clear()  # Before testing dreq to avoid a race with the ISR
+                            if flag is None or dreq():  # Polled, or the backstop: yield
+                                await asyncio.sleep_ms(0)
+                            else:
+                                await flag.wait()
+                        self._xdcs(0)
+                        self._spi.write(chunks[rptr >> 5][:bsize])
+                        self._xdcs(1)
+                    ended = True
+                    break
+                cnt += 1
+                while (not dreq()) or cnt > 30:  # 960 byte backstop
+                    cnt = 0
+                    if flag is not None:
+                        flag.clear()  # Before testing dreq to avoid a race with the ISR
+                    if flag is None or dreq():  # Polled, or the backstop: yield
+                        await asyncio.sleep_ms(0)
+                    else:
+                        await flag.wait()
+                self._xdcs(0)  # Fast write
+                self._spi.write(chunks[rptr >> 5])
+                self._xdcs(1)
+                sent = True
+                rptr = (rptr + 32) & mask
+                bsize -= 32
+                if bsize < lmin and not eof:
+                    lmin = bsize
+                # Check for cancelling. Datasheet section 10.5.2
+                if self._cancnt:
+                    if self._cancnt == 1:  # Just cancelled
+                        self.mode_set(_SM_CANCEL)
+                    if not self._read_reg(_SCI_MODE) & _SM_CANCEL:  # Cancel done
+                        buf = chunks[0]
+                        efb = self._read_ram(_END_FILL_BYTE) & 0xff
+                        for n in range(32):
+                            buf[n] = efb
+                        for n in range(64):  # send 2048 bytes of end fill byte
+                            self.write(buf)
+                        self.write(buf[:4])  # Take to 2052 bytes
+                        if self._read_reg(_SCI_HDAT0) or self._read_reg(_SCI_HDAT1):
+                            raise RuntimeError('Invalid HDAT value.')
+                        break
+                    if self._cancnt > 64:  # Cancel has failed
+                        self.soft_reset()
+                        break
+                    self._cancnt += 1  # keep feeding data from stream
+        finally:
+            reader.cancel()
+        if ended:
+            await self._end_play(chunks[0])
+        self._cancnt = 0
+        self._playing = False
+        if err is not None:
+            raise err
+
     # Produce a 517Hz sine wave
     async def sine_test(self, seconds=10):
         self.soft_reset()
@@ -416,6 +1048,12 @@ class VS1053:
         self.write(b'\x45\x78\x69\x74\0\0\0\0')
         self.mode_clear(_SM_TESTS)
 
+    # Apply a plugin image held in a buffer, typically a bytes object in a
+    # module frozen into firmware: see tools/plugin2py.py. The image is read
+    # in place so no RAM is used for a copy.
+    def patch_from_buffer(self, buf):
+        self._load(buf, len(buf), None)
+
     # Given a directory apply any patch files found. Applied in alphabetical
     # order.
     def patch(self, loc=None):
@@ -432,3 +1070,209 @@ class VS1053:
             with open(f, 'rb') as s:
                 self._patch_stream(s)
         print('Patching complete.')
+
+# *** RECORD API ***
+
+    # Drain nwords recorded words into buf[idx:], returning the new index.
+    # Data 10.8.4 MSB first. Each SCI read must be terminated by XCS going
+    # high, so the per word overhead is minimised by hoisting all lookups out
+    # of the loop and using a precomputed command and response buffer pair.
+    def _drain(self, buf, idx, nwords):
+        xcs = self._xcs
+        rw = self._spi.write_readinto
+        cmd = _HDAT0_READ
+        rbuf = self._hbuf
+        with self._session:
+            for _ in range(nwords):
+                xcs(0)
+                rw(cmd, rbuf)
+                xcs(1)
+                buf[idx] = rbuf[2]
+                buf[idx + 1] = rbuf[3]
+                idx += 2
+        return idx
+
+    # Patch for recording. Data 10.8.1
+    def _write_patch(self):
+        with self._session:
+            self._write_reg(_SCI_WRAMADDR, 0x8010)
+            for x in _PATCH:
+                self._write_reg(_SCI_WRAM, x)
+            self._write_reg(_SCI_WRAMADDR, 0x8028)
+            for x in _PATCH1:
+                self._write_reg(_SCI_WRAM, x)
+
+    # Convert a dB value to a linear gain as recognised by the chip. Unity gain
+    # is a value of 1024. Range is 1 <= gain <= 65535 with 0 having special
+    # meaning: this is represented by None
+    def from_db(self, db):
+        return 0 if db is None else max(min(round(1024*(10**(db/20))), 65535), 1)
+
+    # Return a coroutine writing a buffer to stream s. A uasyncio StreamWriter
+    # (e.g. a socket) is drained after each write, pausing recording while it
+    # is unable to accept data.
+    def _writer(self, s):
+        if hasattr(s, 'drain'):
+            async def write(buf):
+                s.write(buf)
+                await s.drain()
+        else:
+            async def write(buf):
+                s.write(buf)
+        return write
+
+    # Words are drained from the chip in bursts once _REC_BURST are available,
+    # sleeping until then. One of two buffers is filled while the other awaits
+    # writing: each pass performs a drain or a write, not both, limiting the
+    # time for which the scheduler is blocked. Runs until stop() returns True,
+    # then drains the words remaining in the chip. Capture starts in bufs[cur]
+    # at idx. On return all full buffers have been written: returns the buffer
+    # being filled and its index.
+    async def _capture(self, write, bufs, cur, idx, stop, wpms):
+        full = None  # Buffer awaiting write
+        while not stop():
+            n = self._read_reg(_SCI_HDAT1)
+            self._overrun = max(self._overrun, n)
+            if n >= _REC_BURST and not (full and idx == _REC_BUF):
+                if idx == _REC_BUF:  # Switch buffers
+                    full = bufs[cur]
+                    cur ^= 1
+                    idx = 0
+                k = min(n, (_REC_BUF - idx) >> 1)
+                idx = self._drain(bufs[cur], idx, k)
+                self._nsamples += k
+                await asyncio.sleep_ms(0)
+            elif full:
+                await write(full)
+                full = None
+                await asyncio.sleep_ms(0)
+            else:  # Wait for a burst to accumulate
+                await asyncio.sleep_ms(max(round((_REC_BURST - n) / wpms), 1))
+        if full:
+            await write(full)
+        buf = bufs[cur]
+        n = self._read_reg(_SCI_HDAT1)  # Words received before stop
+        self._overrun = max(self._overrun, n)
+        while n:
+            if idx == _REC_BUF:
+                await write(buf)
+                idx = 0
+            k = min(n, (_REC_BUF - idx) >> 1)
+            idx = self._drain(buf, idx, k)
+            self._nsamples += k
+            n -= k
+        return cur, idx
+
+    # Record to a file. This is a wav file whose header is written after the
+    # data so that it can specify the length.
+    async def record(self, fn, line, stop=10_000, sf=8000, agc_gain=None, gain=None, stereo=True,
+                     prealloc=False):
+        if prealloc and callable(stop):
+            raise ValueError('Preallocation requires a duration')
+        chans = 2 if stereo else 1
+        with open(fn, 'wb') as f:
+            if prealloc:  # Allocate clusters now rather than while recording
+                f.seek(len(_HEADER) + int(stop * sf * chans * 256 / 505_000) + _REC_BUF)
+                f.seek(0)
+            # Header template occupies the start of the first block: writes are sector aligned
+            overrun = await self.record_stream(f, line, stop, sf, agc_gain, gain, stereo, _HEADER)
+            if prealloc:
+                try:
+                    f.truncate()  # Discard unused space
+                except AttributeError:  # Unsupported: header defines data length
+                    pass
+            f.seek(0)
+            f.write(wav_header(self._nsamples, sf, stereo))  # Single pass header finalisation
+        return overrun
+
+    # Record IMA ADPCM data to any object with a write method. Data is written
+    # in 512 byte blocks, the last of which may be shorter. Any head data, e.g.
+    # a wav header template, occupies the start of the first block. The number
+    # of samples recorded is available from .nsamples() on completion.
+    async def record_stream(self, s, line, stop=10_000, sf=8000, agc_gain=None, gain=None,
+                            stereo=True, head=b''):
+        self._overrun = 0
+        self._nsamples = 0
+        self._recording = True
+        self._cancnt = 0
+        chans = 2 if stereo else 1
+        if not callable(stop):
+            t = time.ticks_add(time.ticks_ms(), stop)
+            stop = lambda : time.ticks_diff(time.ticks_ms(), t) >= 0
+        bufs = (bytearray(_REC_BUF), bytearray(_REC_BUF))
+        bufs[0][: len(head)] = head
+        write = self._writer(s)
+        try:
+            with self._session:
+                mode = self._reg(_SCI_MODE) | _SM_RESET | _SM_ADPCM
+                if line:
+                    mode |= SM_LINE_IN
+                self._write_reg(_SCI_AICTRL0, sf)  # Sampling freq
+                self._write_reg(_SCI_AICTRL1, self.from_db(gain))  # None == AGC
+                self._write_reg(_SCI_AICTRL2, self.from_db(agc_gain))  # Max AGC gain
+                self._write_reg(_SCI_AICTRL3, 0 if stereo else 2)  # Always ADPCM. Mono is left channel.
+                self._write_reg(_SCI_MODE, mode)  # Must start before patch.
+                self._write_patch()
+
+            wpms = sf * 128 * chans / 505_000  # Words per ms
+            halt = lambda : self._cancnt or stop()
+            cur, idx = await self._capture(write, bufs, 0, len(head), halt, wpms)
+            await write(memoryview(bufs[cur])[:idx])
+        finally:
+            self._cancnt = 0
+            self._recording = False
+        return self._overrun
+
+    # Number of 16 bit words in the most recent recording.
+    def nsamples(self):
+        return self._nsamples
+
+    # Record Ogg Vorbis using the VLSI encoder application: see "VS1053b Ogg
+    # Vorbis Encoder" application note. encoder is the path to the encoder
+    # plugin file or a buffer holding it. Sample rate, channels and quality
+    # are defined by the encoder profile. On stop or cancel the encoder is
+    # allowed to finish the stream so the file is always valid.
+    async def record_ogg(self, fn, line, encoder, stop=10_000, agc_gain=None, gain=None):
+        self._overrun = 0
+        self._nsamples = 0
+        self._recording = True
+        self._cancnt = 0
+        if not callable(stop):
+            t = time.ticks_add(time.ticks_ms(), stop)
+            stop = lambda : time.ticks_diff(time.ticks_ms(), t) >= 0
+        bufs = (bytearray(_REC_BUF), bytearray(_REC_BUF))
+        try:
+            with open(fn, 'wb') as f:
+                with self._session:
+                    self._write_reg(_SCI_BASS, 0)
+                    self._write_reg(_SCI_CLOCKF, 0xc000)  # 4.5x: required by encoder
+                    self._write_ram(_INT_ENABLE, 0x02)  # Disable all interrupts except SCI
+                if isinstance(encoder, str):  # The session is not held across file access
+                    with open(encoder, 'rb') as s:
+                        self._patch_stream(s)
+                else:
+                    self.patch_from_buffer(encoder)
+                with self._session:
+                    mode = self._reg(_SCI_MODE) | _SM_ADPCM
+                    if line:
+                        mode |= SM_LINE_IN
+                    self._write_reg(_SCI_MODE, mode)
+                    self._write_reg(_SCI_AICTRL1, self.from_db(gain))  # None == AGC
+                    self._write_reg(_SCI_AICTRL2, self.from_db(agc_gain))  # Max AGC gain
+                    self._write_reg(_SCI_AICTRL3, 0)
+                    self._write_reg(_SCI_AIADDR, 0x34)  # Start the encoder
+
+                halt = lambda : self._cancnt or stop()
+                write = self._writer(f)
+                cur, idx = await self._capture(write, bufs, 0, 0, halt, _OGG_WPMS)
+                with self._session:
+                    self._write_reg(_SCI_AICTRL3, self._read_reg(_SCI_AICTRL3) | 1)  # Request stop
+                done = lambda : self._read_reg(_SCI_AICTRL3) & 2  # Encoder has finished
+                cur, idx = await self._capture(write, bufs, cur, idx, done, _OGG_WPMS)
+                if idx and self._read_reg(_SCI_AICTRL3) & 4:  # Last word holds only one byte
+                    idx -= 1
+                await write(memoryview(bufs[cur])[:idx])
+        finally:
+            self._cancnt = 0
+            self._recording = False
+        return self._overrun
@@ -18,6 +18,34 @@ Example usage on ESP8266:
     os.mount(sd, '/sd')
     os.listdir('/')
 
+Sequential reads, as in audio playback, may be accelerated by passing
+readahead=N. When a read follows on from the previous one a further N
+sectors are fetched in the same multiple block transfer and held in a cache
+of N * 512 bytes, from which subsequent reads are served.
+
+Repeated reads of FAT and directory sectors may be avoided by passing lru=N.
+The N most recently used sectors read singly, other than those read
+sequentially, are retained. Writes update retained sectors (write-through).
+
+The hits and misses attributes count sectors read from the caches and from
+the card.
+
+A multiple block write is preceded by ACMD23 so that the card can erase the
+blocks before the data arrives. Pass preerase=False to disable this. With
+stream=True a write which follows on from the previous one continues the same
+CMD25 transfer: the stream is closed by a read, a non-contiguous write, a
+sync (ioctl op 3) or flush(). The card remains in the write state between
+calls, with its chip select released, so other devices may use the bus.
+ioctl op 6 and erase(block_num, count) erase blocks.
+
+The SPI clock is negotiated on initialisation. The card's maximum rate is
+read from the CSD (TRAN_SPEED) and, if highspeed=True and the card supports
+it, doubled by switching to high speed mode with CMD6. Sector 0 is then read
+repeatedly at decreasing rates, starting from the lower of that maximum and
+the baudrate arg, until the data and CRC are consistently correct. The
+chosen rate is available as the baudrate attribute. Pass a low baudrate, e.g.
+1320000, to avoid probing.
+
 """
 
 from micropython import const
@@ -36,16 +64,58 @@ _R1_ILLEGAL_COMMAND = const(1 << 2)
 _TOKEN_CMD25 = const(0xFC)
 _TOKEN_STOP_TRAN = const(0xFD)
 _TOKEN_DATA = const(0xFE)
+_SAFE_BAUDRATE = const(1320000)  # PGH rate known to be reliable
+_PROBE_READS = const(4)  # PGH reads which must succeed at a rate
+
+# PGH TRAN_SPEED time values (x10) and rate units (in units of 100kbit/s)
+_TRAN_VALUE = (0, 10, 12, 13, 15, 20, 25, 30, 35, 40, 45, 50, 55, 60, 70, 80)
+_TRAN_UNIT = (1, 10, 100, 1000)
+
+
+# PGH CRC16-CCITT as used for SD data blocks
+def crc16(buf):
+    crc = 0
+    for b in buf:
+        crc = ((crc >> 8) | (crc << 8)) & 0xFFFF
+        crc ^= b
+        crc ^= (crc & 0xFF) >> 4
+        crc ^= (crc << 12) & 0xFFFF
+        crc ^= ((crc & 0xFF) << 5) & 0xFFFF
+    return crc
 
 
 class SDCard:
-    def __init__(self, spi, cs):
+    def __init__(self, spi, cs, readahead=0, lru=0, preerase=True, stream=False, baudrate=50000000,
+                 highspeed=False):
         self.spi = spi
         self.cs = cs
 
+        # PGH read-ahead cache
+        self.readahead = readahead  # No. of sectors
+        if readahead:
+            self.cache = memoryview(bytearray(readahead * 512))
+        self.cstart = 0  # First sector in cache
+        self.cn = 0  # No. of valid sectors in cache
+        self.next = -1  # Sector following the most recent read
+        # PGH LRU cache. Lists are ordered least to most recently used.
+        self.lblocks = [-1] * lru  # Sector numbers
+        self.lbufs = [bytearray(512) for _ in range(lru)]
+        self.hits = 0  # Sectors read from cache
+        self.misses = 0  # Sectors read from card
+        # PGH writes
+        self.preerase = preerase  # Send ACMD23 before CMD25
+        self.stream = stream  # Leave CMD25 open between writes
+        self.wnext = -1  # Next block of open write stream
+        # PGH clock
+        self.maxbaud = baudrate  # Upper limit imposed by caller
+        self.highspeed = highspeed  # Attempt switch to high speed mode
+        self.baudrate = _SAFE_BAUDRATE  # Chosen rate
+        self.tran_speed = 0  # Card's maximum rate
+
         self.cmdbuf = bytearray(6)
         self.dummybuf = bytearray(512)
         self.tokenbuf = bytearray(1)
+        self.crcbuf = bytearray(2)  # PGH CRC of most recent data block
         for i in range(512):
             self.dummybuf[i] = 0xFF
         self.dummybuf_memoryview = memoryview(self.dummybuf)
@@ -92,10 +162,7 @@ class SDCard:
 
         # get the number of sectors
         # CMD9: response R2 (R1 byte + 16-byte block read)
-        if self.cmd(9, 0, 0, 0, False) != 0:
-            raise OSError("no response from SD card")
-        csd = bytearray(16)
-        self.readinto(csd)
+        csd = self.read_csd()
         if csd[0] & 0xC0 == 0x40:  # CSD version 2.0
             self.sectors = ((csd[8] << 8 | csd[9]) + 1) * 1024
         elif csd[0] & 0xC0 == 0x00:  # CSD version 1.0 (old, <=2GB)
@@ -110,8 +177,59 @@ class SDCard:
         if self.cmd(16, 512, 0) != 0:
             raise OSError("can't set 512 block size")
 
-        # set to high data rate now that it's initialised
-        self.init_spi(1320000)
+        # PGH negotiate the data rate now that it's initialised
+        self.tran_speed = self.tran(csd)
+        if self.highspeed and (csd[4] & 0x40) and self.switch_hs():  # CCC class 10
+            self.tran_speed = self.tran(self.read_csd())
+        self.baudrate = self.probe(min(self.tran_speed, self.maxbaud))
+        self.init_spi(self.baudrate)
+
+    def read_csd(self):
+        if self.cmd(9, 0, 0, 0, False) != 0:
+            raise OSError("no response from SD card")
+        csd = bytearray(16)
+        self.readinto(csd)
+        return csd
+
+    # PGH maximum clock rate in Hz from CSD TRAN_SPEED
+    @staticmethod
+    def tran(csd):
+        t = csd[3]
+        return _TRAN_VALUE[(t >> 3) & 0x0F] * _TRAN_UNIT[t & 0x03] * 10000
+
+    # PGH CMD6 switch to high speed mode. Returns True on success.
+    def switch_hs(self):
+        if self.cmd(6, 0x80FFFFF1, 0, release=False) != 0:
+            self.cs(1)
+            return False
+        status = bytearray(64)
+        self.readinto(status)
+        return status[16] & 0x0F == 1  # Function 1 selected in group 1
+
+    # PGH return the fastest clock <= limit at which reads are reliable. Sector
+    # 0 is read at a safe rate for reference then at each candidate rate.
+    def probe(self, limit):
+        if limit <= _SAFE_BAUDRATE:
+            return limit
+        ref = bytearray(512)
+        buf = bytearray(512)
+        self.init_spi(_SAFE_BAUDRATE)
+        self.read(0, ref, 0)
+        crc = crc16(ref)
+        rate = limit
+        while rate > _SAFE_BAUDRATE:
+            self.init_spi(rate)
+            for _ in range(_PROBE_READS):
+                try:
+                    self.read(0, buf, 0)
+                except OSError:
+                    break
+                if buf != ref or (self.crcbuf[0] << 8 | self.crcbuf[1]) != crc:
+                    break
+            else:
+                return rate
+            rate = rate * 2 // 3
+        return _SAFE_BAUDRATE
 
     def init_card_v1(self):
         for i in range(_CMD_TIMEOUT):
@@ -140,10 +258,10 @@ class SDCard:
         # create and send the command
         buf = self.cmdbuf
         buf[0] = 0x40 | cmd
-        buf[1] = arg >> 24
-        buf[2] = arg >> 16
-        buf[3] = arg >> 8
-        buf[4] = arg
+        buf[1] = (arg >> 24) & 0xff
+        buf[2] = (arg >> 16) & 0xff
+        buf[3] = (arg >> 8) & 0xff
+        buf[4] = arg & 0xff
         buf[5] = crc
         self.spi.write(buf)
 
@@ -187,8 +305,7 @@ class SDCard:
         self.spi.write_readinto(mv, buf)
 
         # read checksum
-        self.spi.write(b"\xff")
-        self.spi.write(b"\xff")
+        self.spi.readinto(self.crcbuf, 0xFF)  # PGH retain for probe
 
         self.cs(1)
         self.spi.write(b"\xff")
@@ -227,10 +344,47 @@ class SDCard:
         self.spi.write(b"\xff")
 
     def readblocks(self, block_num, buf):
-        self.spi.write(b'\xff')  # PGH https://github.com/micropython/micropython/pull/6007
         nblocks = len(buf) // 512
         assert nblocks and not len(buf) % 512, "Buffer length is invalid"
-        if nblocks == 1:
+        self.flush()
+        # PGH access is sequential if it follows the previous read or the
+        # read-ahead cache (interleaved FAT lookups break the former).
+        seq = block_num == self.next or (self.cn and block_num == self.cstart + self.cn)
+        self.next = block_num + nblocks
+        blocks = self.lblocks
+        if nblocks == 1 and block_num in blocks:
+            i = blocks.index(block_num)
+            b = self.lbufs.pop(i)  # Move to most recently used
+            blocks.append(blocks.pop(i))
+            self.lbufs.append(b)
+            buf[:] = b
+            self.hits += 1
+            return
+        # Serve leading sectors from the read-ahead cache
+        n = 0
+        offset = block_num - self.cstart
+        if 0 <= offset < self.cn:
+            n = min(nblocks, self.cn - offset)
+            buf[: n * 512] = self.cache[offset * 512 : (offset + n) * 512]
+            self.hits += n
+        if n < nblocks:
+            self.misses += nblocks - n
+            self.read(block_num + n, memoryview(buf)[n * 512 :], self.readahead if seq else 0)
+            if nblocks == 1 and blocks and not seq:  # Retain, replacing least recently used
+                blocks.pop(0)
+                b = self.lbufs.pop(0)
+                b[:] = buf
+                blocks.append(block_num)
+                self.lbufs.append(b)
+
+    # Read into buf then, if ahead > 0, read up to that many further sectors
+    # into the cache in the same transfer.
+    def read(self, block_num, buf, ahead):
+        self.spi.write(b'\xff')  # PGH https://github.com/micropython/micropython/pull/6007
+        nblocks = len(buf) // 512
+        if ahead:
+            ahead = min(ahead, self.sectors - block_num - nblocks)
+        if nblocks == 1 and not ahead:
             # CMD17: set read address for single block
             if self.cmd(17, block_num * self.cdv, 0, release=False) != 0:
                 # release the card
@@ -251,14 +405,39 @@ class SDCard:
                 self.readinto(mv[offset : offset + 512])
                 offset += 512
                 nblocks -= 1
+            if ahead > 0:
+                self.cn = 0  # Invalid until read
+                cache = self.cache
+                for offset in range(0, ahead * 512, 512):
+                    self.readinto(cache[offset : offset + 512])
+                self.cstart = block_num + len(buf) // 512
+                self.cn = ahead
             if self.cmd(12, 0, 0xFF, skip1=True):
                 raise OSError(5)  # EIO
 
     def writeblocks(self, block_num, buf):
-        # clock card at least 100 cycles with cs high
-        self.spi.write(b'\xff')  # PGH
         nblocks, err = divmod(len(buf), 512)
         assert nblocks and not err, "Buffer length is invalid"
+        # PGH discard read-ahead cache if overwritten, update LRU cache
+        if self.cn and block_num < self.cstart + self.cn and block_num + nblocks > self.cstart:
+            self.cn = 0
+        for i, b in enumerate(self.lblocks):
+            if block_num <= b < block_num + nblocks:
+                offset = (b - block_num) * 512
+                self.lbufs[i][:] = buf[offset : offset + 512]
+        if self.stream:
+            if block_num != self.wnext:  # Start a new stream
+                self.flush()
+                self.spi.write(b'\xff')
+                if self.cmd(25, block_num * self.cdv, 0) != 0:
+                    raise OSError(5)  # EIO
+            mv = memoryview(buf)
+            for offset in range(0, nblocks * 512, 512):
+                self.write(_TOKEN_CMD25, mv[offset : offset + 512])
+            self.wnext = block_num + nblocks
+            return
+        # clock card at least 100 cycles with cs high
+        self.spi.write(b'\xff')  # PGH
         if nblocks == 1:
             # CMD24: set write address for single block
             if self.cmd(24, block_num * self.cdv, 0) != 0:
@@ -267,6 +446,10 @@ class SDCard:
             # send the data
             self.write(_TOKEN_DATA, buf)
         else:
+            # PGH ACMD23: pre-erase the blocks to be written
+            if self.preerase:
+                self.cmd(55, 0, 0)
+                self.cmd(23, nblocks, 0)
             # CMD25: set write address for first block
             if self.cmd(25, block_num * self.cdv, 0) != 0:
                 raise OSError(5)  # EIO
@@ -279,6 +462,43 @@ class SDCard:
                 nblocks -= 1
             self.write_token(_TOKEN_STOP_TRAN)
 
+    # PGH close an open write stream
+    def flush(self):
+        if self.wnext >= 0:
+            self.wnext = -1
+            self.write_token(_TOKEN_STOP_TRAN)
+
+    # PGH erase count blocks. Erased blocks read as 0x00 or 0xff depending on
+    # the card.
+    def erase(self, block_num, count=1):
+        self.flush()
+        self.spi.write(b'\xff')
+        if self.cmd(32, block_num * self.cdv, 0) or self.cmd(33, (block_num + count - 1) * self.cdv, 0):
+            raise OSError(5)  # EIO
+        if self.cmd(38, 0, 0, release=False):
+            self.cs(1)
+            raise OSError(5)  # EIO
+        # wait for erase to finish
+        while self.spi.read(1, 0xFF)[0] == 0:
+            pass
+        self.cs(1)
+        self.spi.write(b"\xff")
+        # discard cached copies
+        if self.cn and block_num < self.cstart + self.cn and block_num + count > self.cstart:
+            self.cn = 0
+        blocks = self.lblocks
+        for i, b in enumerate(blocks):
+            if block_num <= b < block_num + count:
+                blocks[i] = -1
+
     def ioctl(self, op, arg):
         if op == 4:  # get number of blocks
             return self.sectors
+        if op == 5:  # PGH block size
+            return 512
+        if op == 2 or op == 3:  # PGH deinit, sync
+            self.flush()
+            return 0
+        if op == 6:  # PGH erase block
+            self.erase(arg)
+            return 0
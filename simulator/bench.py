@@ -0,0 +1,1169 @@
+# bench.py Benchmarks of the VS1053 drivers running on the simulator
+# (C) Peter Hinch 2020-2022
+# Released under the MIT licence
+
+# Usage: python3 simulator/bench.py [name ...]
+# With no args all benchmarks are run. Times are virtual: see SIMULATOR.md.
+
+import sys
+import dis
+import inspect
+import simenv
+simenv.install()
+
+import random
+import uasyncio as asyncio
+from simenv import clock, SimFile, SimFS
+from chip import rig
+
+_KBPS = 128
+
+
+def audio(nbytes, seed=1):  # Synthetic audio data containing no end fill bytes
+    rnd = random.Random(seed)
+    return bytes(rnd.randrange(1, 256) for _ in range(nbytes))
+
+
+def report(title, t0, chip, f=None):
+    secs = (clock.us - t0) / 1e6
+    spi = chip.spi
+    print(title)
+    print('  virtual time {:.3f}s  idle {:.3f}s'.format(secs, clock.idle_us / 1e6))
+    print('  SPI calls {}  spi.init {}  SCI reads {}  SCI writes {}'.format(
+        spi.calls, spi.init_calls, chip.sci_reads, chip.sci_writes))
+    print('  underruns {} ({:.1f}ms)  overflows {}  baud errors {}'.format(
+        chip.underruns, chip.underrun_us / 1000, chip.overflows, chip.baud_errors))
+    if f is not None:
+        s = f.stats()
+        print('  file reads {}  readblocks {}  sectors {}  longest read {:.1f}ms'.format(
+            s['calls'], s['block_calls'], s['sectors'], s['max_us'] / 1000))
+
+
+def clear(chip, f=None):
+    chip.clear_stats()
+    chip.spi.clear_stats()
+    clock.idle_us = 0
+    if f is not None:
+        f.clear_stats()
+    return clock.us
+
+
+def _player(module, chip, **kwargs):
+    mod = __import__(module)
+    return mod.VS1053(chip.spi, *chip.args, **kwargs)
+
+
+# Play 128KiB of 128Kbps audio with each driver and play mode. Buffered play
+# is also run with extreme legal watermarks; illegal ones must raise.
+def playback(nbytes=128 * 1024):
+    data = audio(nbytes)
+    for module in ('vs1053', 'vs1053_syn'):
+        for wm in ((16, 2048), (1600, 2048), (1024, 512), (32, 4096)):
+            try:
+                _player(module, rig(), buffered=True, watermarks=wm)
+            except ValueError:
+                continue
+            raise AssertionError('{} accepted watermarks {}'.format(module, wm))
+    print('Illegal watermarks raise ValueError')
+    for title, module, kwargs in (('Async unbuffered', 'vs1053', {}),
+                                  ('Async buffered', 'vs1053', {'buffered': True}),
+                                  ('Async buffered, watermarks 32/1536', 'vs1053',
+                                   {'buffered': True, 'watermarks': (32, 1536)}),
+                                  ('Synchronous', 'vs1053_syn', {}),
+                                  ('Synchronous buffered', 'vs1053_syn', {'buffered': True}),
+                                  ('Synchronous buffered, watermarks 1536/1536', 'vs1053_syn',
+                                   {'buffered': True, 'watermarks': (1536, 1536)})):
+        chip = rig(byte_rate=_KBPS * 125)
+        player = _player(module, chip, **kwargs)
+        f = SimFile(data)
+        t0 = clear(chip, f)
+        if module == 'vs1053':
+            asyncio.run(player.play(f))
+        else:
+            player.play(f)
+        report('{} play {}KiB at {}Kbps'.format(title, nbytes // 1024, _KBPS), t0, chip, f)
+
+
+# Compare polled and interrupt driven DREQ waits. A concurrent task sleeps
+# for 10ms repeatedly and measures how late it is scheduled.
+def dreq_irq(nbytes=64 * 1024):
+    data = audio(nbytes)
+
+    async def other(late):
+        while True:
+            t = clock.us + 10_000
+            await asyncio.sleep_ms(10)
+            late.append(clock.us - t)
+
+    async def run(player, f, late):
+        asyncio.create_task(other(late))
+        await player.play(f)
+
+    for buffered in (False, True):
+        for irq in (False, True):
+            chip = rig(byte_rate=_KBPS * 125)
+            player = _player('vs1053', chip, buffered=buffered, irq=irq)
+            f = SimFile(data)
+            late = []
+            t0 = clear(chip, f)
+            asyncio.run(run(player, f, late))
+            secs = (clock.us - t0) / 1e6
+            print('{} {}: CPU idle {:.1f}%  DREQ to data mean {:.0f}μs max {:.0f}μs  '
+                  'other task late mean {:.0f}μs max {:.0f}μs  underruns {}'.format(
+                  'Buffered' if buffered else 'Unbuffered', 'IRQ' if irq else 'polled',
+                  100 * clock.idle_us / 1e6 / secs, chip.stats()['lat_mean'], chip.lat_max,
+                  sum(late) / len(late), max(late), chip.underruns))
+
+
+# Count heap allocations made by the buffered async player's code, as they
+# would occur on MicroPython. Opcodes which allocate (building a tuple, list,
+# dict, slice or string, making a function, true division) are counted in the
+# driver's frames, as are coroutines and generators started from them: each
+# call of an async def creates an object. uasyncio.sleep_ms is excluded: on
+# MicroPython it returns a preallocated singleton. ThreadSafeFlag.wait, used
+# when irq=True, is counted separately as it allocates within uasyncio. Counts
+# for two stream lengths are compared, so one-off allocations at the start and
+# end of play cancel: the steady state must not allocate.
+def alloc():
+    import vs1053
+    driver = vs1053.__file__
+    ops = {dis.opmap[name] for name in ('BUILD_TUPLE', 'BUILD_LIST', 'BUILD_SET', 'BUILD_MAP',
+           'BUILD_CONST_KEY_MAP', 'BUILD_SLICE', 'BUILD_STRING', 'FORMAT_VALUE', 'MAKE_FUNCTION',
+           'LIST_TO_TUPLE')}
+    binop = dis.opmap['BINARY_OP']
+    divide = dis._nb_ops.index(('NB_TRUE_DIVIDE', '/'))
+    resume = {}  # Offset of the first RESUME of each coroutine code object
+
+    def fresh(frame):  # A coroutine or generator frame starting, not resuming
+        code = frame.f_code
+        if code not in resume:
+            resume[code] = next(i.offset for i in dis.get_instructions(code) if i.opname == 'RESUME')
+        return frame.f_lasti == resume[code]
+
+    def run(kib, irq):
+        counts = {'driver': 0, 'flag': 0}
+        sites = {}
+
+        def local(frame, event, arg):
+            if event == 'opcode':
+                code = frame.f_code.co_code
+                op = code[frame.f_lasti]
+                if op in ops or (op == binop and code[frame.f_lasti + 1] == divide):
+                    counts['driver'] += 1
+                    key = (frame.f_lineno, dis.opname[op])
+                    sites[key] = sites.get(key, 0) + 1
+            return local
+
+        def tracer(frame, event, arg):
+            code = frame.f_code
+            caller = frame.f_back
+            if (caller is not None and caller.f_code.co_filename == driver
+                    and code.co_flags & (inspect.CO_COROUTINE | inspect.CO_GENERATOR)
+                    and code.co_name != 'sleep_ms' and fresh(frame)):
+                key = 'flag' if code.co_name == 'wait' else 'driver'
+                counts[key] += 1
+                if key == 'driver':
+                    sites[(caller.f_lineno, code.co_name)] = sites.get((caller.f_lineno, code.co_name), 0) + 1
+            if code.co_filename == driver:
+                frame.f_trace_opcodes = True
+                return local
+            return None
+
+        chip = rig(byte_rate=88_200)
+        player = _player('vs1053', chip, buffered=True, irq=irq)
+        f = SimFile(audio(kib * 1024))
+        sys.settrace(tracer)
+        try:
+            asyncio.run(player.play(f))
+        finally:
+            sys.settrace(None)
+        return counts, sites
+
+    for irq in (False, True):
+        (c0, s0), (c1, s1) = run(256, irq), run(1024, irq)
+        driver_mib = (c1['driver'] - c0['driver']) / 0.75
+        flag_mib = (c1['flag'] - c0['flag']) / 0.75
+        print('Buffered play, {}: allocations per MiB by the driver {:.0f}  by ThreadSafeFlag.wait {:.0f}'.format(
+              'DREQ interrupt' if irq else 'DREQ polled', driver_mib, flag_mib))
+        growing = {k: v - s0.get(k, 0) for k, v in s1.items() if v != s0.get(k, 0)}
+        assert not driver_mib, 'Allocations in the play loop (line, cause: count): {}'.format(growing)
+
+
+# Find the highest byte rate sustainable without underruns for each buffer
+# size. Cards are modelled with steady reads and with a 15ms stall every 32KiB.
+def sweep(nbytes=192 * 1024):
+    data = audio(nbytes)
+
+    def ok(size, rate, stall):
+        chip = rig(byte_rate=rate)
+        player = _player('vs1053', chip, buffered=size, irq=True)
+        f = SimFile(data, stall_every=64 if stall else 0, stall_us=15_000)
+        clear(chip, f)
+        asyncio.run(player.play(f))
+        return not chip.underruns
+
+    print('Buffer  Max rate (Kbps)')
+    print('        Steady  Stalling')
+    for size in (2048, 4096, 8192, 16384, 32768):
+        res = [_maxrate(lambda rate: ok(size, rate, stall)) for stall in (False, True)]
+        print('{:6d}  {:6d}  {:8d}'.format(size, *res))
+
+
+# Highest rate sustainable by the synchronous driver, unbuffered and buffered,
+# on a slow host where each file read costs 300μs of VFS overhead (ESP8266).
+def sync_rate(nbytes=128 * 1024):
+    data = audio(nbytes)
+
+    def ok(buffered, rate):
+        chip = rig(byte_rate=rate)
+        player = _player('vs1053_syn', chip, buffered=buffered)
+        f = SimFile(data, call_us=300)
+        clear(chip, f)
+        player.play(f)
+        return not chip.underruns
+
+    for buffered in (False, True):
+        chip = rig(byte_rate=_KBPS * 125)
+        player = _player('vs1053_syn', chip, buffered=buffered)
+        f = SimFile(data, call_us=300)
+        clear(chip, f)
+        player.play(f)
+        s = f.stats()
+        mib = s['bytes'] / 1024 / 1024
+        print('{}: {:.0f} file reads/MiB, {:.0f} readblocks/MiB, max rate {}Kbps'.format(
+              'Buffered' if buffered else 'Unbuffered', s['calls'] / mib,
+              s['block_calls'] / mib, _maxrate(lambda rate: ok(buffered, rate))))
+
+
+# SCI traffic for a typical session: adjust settings, play a track to the end,
+# play another and cancel it.
+def sci_traffic():
+    for module in ('vs1053', 'vs1053_syn'):
+        chip = rig(byte_rate=_KBPS * 125)
+        flag = [False]
+        kwargs = {'buffered': True}
+        if module == 'vs1053_syn':
+            kwargs['cancb'] = lambda: flag[0] and clock.us > flag[0]
+        player = _player(module, chip, **kwargs)
+        t0 = clear(chip)
+        player.volume(-10, -10)
+        player.mode_set(0x90)  # EarSpeaker
+        player.response(bass_amp=10)
+        player.mode_clear(0x90)
+
+        async def run():
+            await player.play(SimFile(audio(16 * 1024)))
+            asyncio.create_task(player.play(SimFile(audio(64 * 1024))))
+            await asyncio.sleep(1)
+            await player.cancel()
+
+        if module == 'vs1053':
+            asyncio.run(run())
+        else:
+            player.play(SimFile(audio(16 * 1024)))
+            flag[0] = clock.us + 1e6
+            player.play(SimFile(audio(64 * 1024)))
+        print('{}: SCI reads {} (SCI_MODE {})  SCI writes {}  spi.init calls {}'.format(
+              module, chip.sci_reads, chip.reg_reads[0], chip.sci_writes, chip.spi.init_calls))
+
+
+# spi.init calls made by individual driver operations.
+def spi_init():
+    import os
+    import tempfile
+    tmp = os.path.join(tempfile.mkdtemp(), 'rec.wav')
+    for module in ('vs1053', 'vs1053_syn'):
+        chip = rig(byte_rate=_KBPS * 125)
+        player = _player(module, chip)
+        ops = [('soft_reset', player.soft_reset),
+               ('volume', lambda: player.volume(-10, -10)),
+               ('response', lambda: player.response(bass_amp=10)),
+               ('mode_set', lambda: player.mode_set(0x90)),
+               ('enable_i2s', player.enable_i2s),
+               ('pins', lambda: player.pins(0))]
+        if module == 'vs1053_syn':
+            ops.append(('_write_patch', player._write_patch))
+            ops.append(('record 1s', lambda: player.record(tmp, True, 1000)))
+        print('{}: '.format(module) + '  '.join(
+              '{} {}'.format(name, _inits(chip, op)) for name, op in ops))
+
+
+def _inits(chip, op):
+    chip.spi.clear_stats()
+    op()
+    return chip.spi.init_calls
+
+
+# Time to load each plugin in the plugins directory from a file and from a
+# buffer. The chip's RAM contents are checked against a reference decode of
+# the image. The file is on an SD card sharing the VS1053 bus.
+def plugin():
+    import os
+    loc = os.path.join(os.path.dirname(simenv._SIMDIR), 'plugins')
+    for name in sorted(os.listdir(loc)):
+        with open(os.path.join(loc, name), 'rb') as f:
+            data = f.read()
+        for module in ('vs1053', 'vs1053_syn'):
+            for src in ('file', 'buffer'):
+                chip = rig()
+                player = _player(module, chip)
+                f = SimFile(data, spi=chip.spi)  # SD card on the VS1053 bus
+                t0 = clear(chip, f)
+                if src == 'file':
+                    player._patch_stream(f)
+                else:
+                    player.patch_from_buffer(data)
+                ms = (clock.us - t0) / 1000
+                print('{} {} from {}: {:.1f}ms  file reads {}  SCI writes {}  spi.init {}  baud errors {}  '
+                      'RAM {}'.format(module, name, src, ms, f.calls, chip.sci_writes, chip.spi.init_calls,
+                      chip.baud_errors, 'OK' if chip.ram == _plugin_ram(data) else 'ERROR'))
+
+
+def _plugin_ram(data):  # Expected RAM contents after loading a plugin
+    words = [data[i] | data[i + 1] << 8 for i in range(0, len(data), 2)]
+    ram = {}
+    addr = 0
+    i = 0
+    while i < len(words):
+        reg, count = words[i : i + 2]
+        i += 2
+        rle = count & 0x8000
+        vals = [words[i]] * (count & 0x7fff) if rle else words[i : i + count]
+        i += 1 if rle else count
+        for v in vals:
+            if reg == 7:  # SCI_WRAMADDR
+                addr = v
+            elif reg == 6:  # SCI_WRAM
+                ram[addr] = v
+                addr = (addr + 1) & 0xffff
+    return ram
+
+
+# Record with the async driver to a simulated SD card file while another task
+# sleeps for 10ms repeatedly and measures how late it is scheduled.
+def async_record(secs=5):
+    async def other(late):
+        while True:
+            t = clock.us + 10_000
+            await asyncio.sleep_ms(10)
+            late.append(clock.us - t)
+
+    async def run(player, sf, late):
+        asyncio.create_task(other(late))
+        return await player.record('rec.wav', True, secs * 1000, sf)
+
+    for sf in (8000, 16000, 24000, 48000):
+        chip = rig()
+        player = _player('vs1053', chip)
+        fs = SimFS()
+        sys.modules['vs1053'].open = fs.open
+        late = []
+        t0 = clear(chip)
+        overrun = asyncio.run(run(player, sf, late))
+        s = fs.files['rec.wav'].stats()
+        print('{}sps stereo: overrun {}  words lost {}  file writes {}  CPU idle {:.1f}%  '
+              'other task late mean {:.0f}μs max {:.0f}μs'.format(
+              sf, overrun, chip.rec_lost, s['wcalls'],
+              100 * clock.idle_us / (clock.us - t0), sum(late) / len(late), max(late)))
+
+
+# Record 5s of stereo with the synchronous driver to a simulated SD card file
+# at several sample rates, and at 16Ksps with a player built for buffered play.
+def sync_record(secs=5):
+    for sf, kwargs in ((8000, {}), (16000, {}), (24000, {}), (32000, {}), (48000, {}),
+                       (16000, {'buffered': True})):
+        chip = rig()
+        player = _player('vs1053_syn', chip, **kwargs)
+        fs = SimFS()
+        sys.modules['vs1053_syn'].open = fs.open
+        t0 = clear(chip)
+        overrun = player.record('rec.wav', True, secs * 1000, sf)
+        s = fs.files['rec.wav'].stats()
+        print('{}sps stereo{}: overrun {}  words lost {}  file writes {}  writeblocks {}  '
+              'longest write {:.1f}ms'.format(sf, ' (buffered player)' if kwargs else '',
+              overrun, chip.rec_lost, s['wcalls'], s['wblock_calls'], s['max_us'] / 1000))
+
+
+# Rate at which recorded words are read from the chip. The chip's 1024 word
+# buffer is allowed to fill, then emptied by the driver's drain code. The
+# implied maximum sample rates ignore the time spent writing the data.
+def drain():
+    class Sink:  # Stream with zero write cost
+        def write(self, buf):
+            return len(buf)
+
+    for module in ('vs1053', 'vs1053_syn'):
+        chip = rig()
+        player = _player(module, chip)
+        player._write_reg(0x0c, 48000)  # SCI_AICTRL0 sample rate
+        player._write_reg(0x00, 0x1804)  # SCI_MODE SM_ADPCM | SM_SDINEW | SM_RESET
+        simenv.time.sleep_ms(200)  # Fill the buffer
+        chip.clear_stats()
+        ops = [0]
+        sys.settrace(_optracer(ops, ('_drain', '_rec_blocks')))
+        with player._session:
+            t0 = clock.us
+            if module == 'vs1053':
+                nwords = player._read_reg(0x09)  # SCI_HDAT1
+                player._drain(bytearray(2 * nwords), 0, nwords)
+            else:
+                player._rbuf = bytearray(1024)
+                player._ridx = 0
+                sink = Sink()
+                for buf in player._rec_blocks(lambda : True):  # Single pass
+                    sink.write(buf)
+                nwords = player.nsamples()
+            us = clock.us - t0
+        sys.settrace(None)
+        wps = nwords * 1e6 / us
+        print('{}: {} words in {:.1f}ms, {:.0f} words/s, {:.1f} bytecodes/word. Max sample rate '
+              'stereo {:.0f}sps, mono {:.0f}sps'.format(module, nwords, us / 1000, wps,
+              ops[0] / nwords, wps * 505 / 256, wps * 505 / 128))
+
+
+# Return a trace function counting bytecodes executed by the named functions,
+# excluding their callees. Virtual time does not include interpreter overhead:
+# the bytecode count is a proxy for it.
+def _optracer(ops, names):
+    def local(frame, event, arg):
+        if event == 'opcode':
+            ops[0] += 1
+        return local
+
+    def tracer(frame, event, arg):
+        if frame.f_code.co_name in names:
+            frame.f_trace_opcodes = True
+            return local
+        return None
+    return tracer
+
+
+# Worst case file write latency when recording 20s of 24Ksps stereo with the
+# synchronous driver, with and without a preallocated file.
+def rec_latency(secs=20, sf=24000):
+    for prealloc in (False, True):
+        chip = rig()
+        player = _player('vs1053_syn', chip)
+        fs = SimFS()
+        sys.modules['vs1053_syn'].open = fs.open
+        clear(chip)
+        kwargs = {'prealloc': True} if prealloc else {}
+        overrun = player.record('rec.wav', True, secs * 1000, sf, **kwargs)
+        f = fs.files['rec.wav']
+        s = f.stats()
+        print('{}: longest write {:.1f}ms  clusters allocated {}  overrun {}  words lost {}  '
+              'file {} bytes'.format('Preallocated' if prealloc else 'Normal', s['wmax_us'] / 1000,
+              s['allocs'], overrun, chip.rec_lost, len(f.getvalue())))
+
+
+
+# Record 10s with each driver in ADPCM (16Ksps stereo) and Ogg Vorbis modes
+# comparing file size. The chip models the encoder's output at its ogg_rate:
+# the figures are assumed profile rates. A dummy encoder image is loaded, from
+# a file by the synchronous driver and from a buffer by the async one. Ogg file
+# length is checked against the words produced, less the final odd byte. The
+# SD card shares the VS1053 bus, setting its own clock on each file access:
+# baud errors show SCI transfers made at the card's clock.
+def ogg_record(secs=10):
+    enc = bytes((7, 0, 1, 0, 0x00, 0x18, 6, 0, 2, 0, 0x34, 0x12, 0x78, 0x56))  # Dummy image
+    for module, kwargs in (('vs1053', {}), ('vs1053_syn', {}), ('vs1053_syn', {'buffered': True})):
+        for ogg_rate in (None, 2500, 20_000):
+            chip = rig(ogg_rate=ogg_rate or 2500)
+            player = _player(module, chip, **kwargs)
+            fs = SimFS(spi=chip.spi)  # SD card on the VS1053 bus
+            fs.files['enc.bin'] = SimFile(enc, spi=chip.spi)
+            sys.modules[module].open = fs.open
+            clear(chip)
+            if ogg_rate is None:
+                args = ('rec.wav', True, secs * 1000, 16000)
+                func = player.record
+            else:
+                args = ('rec.ogg', True, 'enc.bin' if module == 'vs1053_syn' else enc, secs * 1000)
+                func = player.record_ogg
+            overrun = asyncio.run(func(*args)) if module == 'vs1053' else func(*args)
+            fn = args[0]
+            size = len(fs.files[fn].getvalue())
+            check = ''
+            if ogg_rate is not None:
+                check = '  length {}'.format('OK' if size == 2 * chip._rec_read - 1 else 'ERROR')
+            print('{}{} {}: {} bytes ({:.1f}KB/s)  overrun {}  words lost {}  baud errors {}{}'.format(
+                  module, ' buffered' if kwargs else '', 'ADPCM' if ogg_rate is None else 'Ogg {}B/s'.format(ogg_rate),
+                  size, size / secs / 1000, overrun, chip.rec_lost, chip.baud_errors, check))
+
+
+# Record 5s of 16Ksps stereo to sinks other than files. The synchronous driver
+# records to a nonblocking stream which accepts at most 256 bytes per call and
+# sometimes none (modelling a socket), and via record_blocks to a consumer
+# computing a peak level. The async driver records to a StreamWriter whose
+# drain models a link of limited throughput. Lost words show when the sink's
+# backpressure exceeds the chip's buffering. Finally a consumer abandons
+# record_blocks: the SPI clock must revert to the data rate, allowing play.
+def rec_sink(secs=5, sf=16000):
+    class Socket:  # Nonblocking stream
+        def __init__(self, rate):
+            self.data = bytearray()
+            self.calls = 0
+            self.us = 1e6 / rate  # Per byte
+
+        def write(self, buf):
+            self.calls += 1
+            if self.calls % 3 == 0:
+                clock.advance(50)
+                return None  # EAGAIN
+            n = min(len(buf), 256)
+            self.data.extend(buf[:n])
+            clock.advance(50 + n * self.us)
+            return n
+
+    class Writer:  # uasyncio StreamWriter
+        def __init__(self, rate):
+            self.data = bytearray()
+            self.rate = rate
+            self.pend = 0
+
+        def write(self, buf):
+            self.data.extend(buf)
+            self.pend += len(buf)
+
+        async def drain(self):
+            await asyncio.sleep_ms(round(self.pend * 1000 / self.rate))
+            self.pend = 0
+
+    nbytes = round(secs * sf * 2 * 256 / 505)
+    for rate in (100_000, 30_000, 10_000):  # Sink throughput bytes/s
+        chip = rig()
+        player = _player('vs1053_syn', chip)
+        sock = Socket(rate)
+        overrun = player.record_stream(sock, True, secs * 1000, sf)
+        print('Sync to socket at {}KB/s: {} bytes  write calls {}  overrun {}  words lost {}'.format(
+              rate // 1000, len(sock.data), sock.calls, overrun, chip.rec_lost))
+        chip = rig()
+        player = _player('vs1053', chip)
+        w = Writer(rate)
+        overrun = asyncio.run(player.record_stream(w, True, secs * 1000, sf))
+        print('Async to StreamWriter at {}KB/s: {} bytes  overrun {}  words lost {}'.format(
+              rate // 1000, len(w.data), overrun, chip.rec_lost))
+    chip = rig()
+    player = _player('vs1053_syn', chip)
+    peak = nblocks = 0
+    for buf in player.record_blocks(True, secs * 1000, sf):
+        peak = max(peak, max(buf))  # Stand-in for level analysis
+        nblocks += 1
+    print('Sync record_blocks: {} blocks  {} samples (expected ~{})  words lost {}'.format(
+          nblocks, player.nsamples(), nbytes // 2, chip.rec_lost))
+    chip = rig()
+    player = _player('vs1053_syn', chip, buffered=True)
+    for nblocks, buf in enumerate(player.record_blocks(True, secs * 1000, sf)):
+        if nblocks == 4:
+            break
+    print('Sync record_blocks abandoned after 4 blocks: session depth {}  SPI clock {:.3f}MHz'.format(
+          player._session._depth, chip.spi.baudrate / 1e6))
+
+
+
+# Sequential read of 1MiB from a simulated SD card using sdcard.py, in
+# requests of 1 sector (as FatFs makes for small reads) and 8 sectors (a
+# cluster), with read-ahead caches of 0, 8 and 32 sectors. Runs at the
+# sdcard.py default clock and at the VS1053 data rate used on a shared bus.
+def sd_read(nbytes=1024 * 1024):
+    import sdcard
+    import card
+    for baud in (1_320_000, 10_752_000):
+        for req in (1, 8):
+            for ra in (0, 8, 32):
+                c = card.rig()
+                sd = sdcard.SDCard(c.spi, c.cs, readahead=ra)
+                c.spi.init(baudrate=baud)
+                buf = bytearray(req * 512)
+                ok = True
+                c.clear_stats()
+                t0 = clock.us
+                for block in range(1000, 1000 + nbytes // 512, req):
+                    sd.readblocks(block, buf)
+                    ok = ok and buf[-512:] == card.pattern(block + req - 1)
+                secs = (clock.us - t0) / 1e6
+                ncmds = c.cmds.get(17, 0) + c.cmds.get(18, 0)
+                nsec = sd.hits + sd.misses
+                print('{:.2f}MHz {} sector reads, read-ahead {:2d}: {:.3f}MB/s  read commands {:4d}  '
+                      'hit rate {:4.1f}%  data {}'.format(baud / 1e6, req, ra, nbytes / secs / 1e6,
+                      ncmds, 100 * sd.hits / nsec if nsec else 0, 'OK' if ok else 'ERROR'))
+
+
+# Replay a FatFs-like trace against sdcard.py with read-ahead and LRU caches
+# of various sizes. For each of 8 tracks the directory is read, 32 clusters of
+# data are read each preceded by a FAT lookup, then the track is sought back
+# to its midpoint which walks the FAT chain. Data is read as single sectors
+# (small reads through the FatFs window) or as clusters (buffered play).
+def sd_meta():
+    import sdcard
+    import card
+
+    def trace(single):
+        fat = 100  # First FAT sector
+        dirs = range(2000, 2004)  # Directory sectors
+        for track in range(8):
+            cluster = track * 1280  # 5MiB tracks, 4KiB clusters
+            yield from ((s, 1) for s in dirs)  # Open
+            for c in range(cluster, cluster + 32):
+                if c % 16 == 8:  # Seek back: walk chain from start
+                    yield from ((s, 1) for s in range(fat + cluster // 128, fat + (c + 640) // 128 + 1))
+                yield fat + c // 128, 1  # Next cluster
+                sector = 10_000 + 8 * c
+                if single:
+                    yield from ((s, 1) for s in range(sector, sector + 8))
+                else:
+                    yield sector, 8
+
+    for single in (True, False):
+        for ra, lru in ((0, 0), (0, 8), (8, 0), (8, 8), (8, 16)):
+            c = card.rig()
+            sd = sdcard.SDCard(c.spi, c.cs, readahead=ra, lru=lru)
+            c.spi.init(baudrate=10_752_000)
+            bufs = {1: bytearray(512), 8: bytearray(4096)}
+            ok = True
+            c.clear_stats()
+            c.spi.clear_stats()
+            for sector, n in trace(single):
+                buf = bufs[n]
+                sd.readblocks(sector, buf)
+                ok = ok and buf[:512] == card.pattern(sector)
+            nsec = sd.hits + sd.misses
+            print('{} reads, read-ahead {} LRU {:2d}: read commands {:4d}  SD bus time {:5.1f}ms  '
+                  'hits {:4d} misses {:4d} ({:4.1f}%)  data {}'.format(
+                  'Sector' if single else 'Cluster', ra, lru, c.cmds.get(17, 0) + c.cmds.get(18, 0),
+                  c.spi.busy_us / 1000, sd.hits, sd.misses, 100 * sd.hits / nsec,
+                  'OK' if ok else 'ERROR'))
+
+
+# Write 1MiB sequentially with sdcard.py, as recording does, in requests of 1,
+# 2 and 8 sectors. The card stalls for 40ms every 256 blocks written to sectors
+# which were not erased beforehand. Compares plain writes, ACMD23 pre-erase of
+# multiple block writes, an open-ended CMD25 stream and erasing the region
+# before writing (as when the length is known in advance).
+def sd_write(nbytes=1024 * 1024):
+    import sdcard
+    import card
+    start = 20_000
+    nsec = nbytes // 512
+    for req in (1, 2, 8):
+        for mode in ('plain', 'ACMD23', 'stream', 'erased'):
+            c = card.rig(stall_every=256, stall_us=40_000)
+            sd = sdcard.SDCard(c.spi, c.cs, preerase=mode != 'plain', stream=mode == 'stream')
+            c.spi.init(baudrate=10_752_000)
+            buf = bytearray(req * 512)
+            c.clear_stats()
+            t0 = clock.us
+            if mode == 'erased':
+                sd.ioctl(6, start)  # Exercise the ioctl
+                sd.erase(start + 1, nsec - 1)
+            tmax = 0
+            for block in range(start, start + nsec, req):
+                buf[:4] = block.to_bytes(4, 'little')
+                t = clock.us
+                sd.writeblocks(block, buf)
+                tmax = max(tmax, clock.us - t)
+            sd.ioctl(3, 0)  # Sync closes a stream
+            secs = (clock.us - t0) / 1e6
+            ok = all(c.data[block][:4] == block.to_bytes(4, 'little') for block in range(start, start + nsec, req))
+            print('{} sector writes, {:6s}: {:.3f}MB/s  longest write {:5.1f}ms  write commands {:4d}  '
+                  'stalls {}  data {}'.format(req, mode, nbytes / secs / 1e6, tmax / 1000,
+                  c.cmds.get(24, 0) + c.cmds.get(25, 0), c.stalls, 'OK' if ok else 'ERROR'))
+
+
+# Clock negotiation by sdcard.py: the rate chosen, the time taken to
+# initialise the card and the resulting sequential read rate (1MiB in cluster
+# sized requests). Cards with and without high speed support are combined with
+# ideal wiring and wiring which corrupts data above 18MHz. The first line is
+# the former fixed 1.32MHz rate.
+def sd_clock(nbytes=1024 * 1024):
+    import sdcard
+    import card
+    for title, ckw, skw in (('Fixed 1.32MHz', {}, {'baudrate': 1_320_000}),
+                            ('Default speed', {}, {}),
+                            ('High speed', {}, {'highspeed': True}),
+                            ('High speed, card lacks it', {'hs': False}, {'highspeed': True}),
+                            ('High speed, 18MHz wiring', {'wire_baud': 18_000_000}, {'highspeed': True}),
+                            ('Default speed, 18MHz wiring', {'wire_baud': 18_000_000}, {})):
+        c = card.rig(**ckw)
+        t0 = clock.us
+        sd = sdcard.SDCard(c.spi, c.cs, **skw)
+        init_ms = (clock.us - t0) / 1000
+        c.clear_stats()
+        buf = bytearray(4096)
+        ok = True
+        t0 = clock.us
+        for block in range(1000, 1000 + nbytes // 512, 8):
+            sd.readblocks(block, buf)
+            ok = ok and buf[-512:] == card.pattern(block + 7)
+        secs = (clock.us - t0) / 1e6
+        print('{:28s} TRAN_SPEED {:2d}MHz  chosen {:6.3f}MHz  init {:5.1f}ms  read {:.3f}MB/s  '
+              'baud errors {}  data {}'.format(title + ':', sd.tran_speed // 1_000_000,
+              sd.baudrate / 1e6, init_ms, nbytes / secs / 1e6, c.baud_errors, 'OK' if ok else 'ERROR'))
+
+# Silences between three 64KiB tracks played by separate play() calls and by
+# play_list(), gapless (all MP3) and with a change of format. A gap runs from
+# the decoding of the last audio byte of a track to that of the first byte of
+# the next. Underruns within tracks are also gaps.
+def gapless(nbytes=64 * 1024):
+    mp3 = b'\xff\xfb\x90\x64'  # Frame header
+    flac = b'fLaC'
+    for module in ('vs1053', 'vs1053_syn'):
+        mod = __import__(module)
+        for title, heads, listed in (('play() per track', (mp3, mp3, mp3), False),
+                                     ('play_list(), MP3 only', (mp3, mp3, mp3), True),
+                                     ('play_list(), MP3 FLAC MP3', (mp3, flac, mp3), True)):
+            chip = rig(byte_rate=_KBPS * 125)
+            player = _player(module, chip, buffered=True)
+            fs = SimFS()
+            names = []
+            for n, head in enumerate(heads):
+                names.append('track{}'.format(n))
+                fs.files[names[-1]] = SimFile(head + audio(nbytes - 4, n))
+            mod.open = fs.open
+            t0 = clear(chip)
+
+            async def each():
+                for name in names:
+                    with fs.open(name) as f:
+                        await player.play(f)
+
+            def each_syn():
+                for name in names:
+                    with fs.open(name) as f:
+                        player.play(f)
+
+            if listed:
+                r = player.play_list(names)
+            else:
+                r = each() if module == 'vs1053' else each_syn()
+            if module == 'vs1053':
+                asyncio.run(r)
+            secs = (clock.us - t0) / 1e6
+            print('{:10s} {:26s} gaps {}ms  underruns {} ({:.1f}ms)  total {:.3f}s'.format(
+                  module, title + ':', ' '.join('{:.1f}'.format(g / 1000) for g in chip.gaps) or '-',
+                  chip.underruns, chip.underrun_us / 1000, secs))
+
+
+# Stand-in for a socket delivering data in bursts separated by random delays.
+# Reads return at most one packet. With blocking=True readinto blocks until the
+# requested number of bytes has arrived, as a synchronous source must when a
+# short read implies EOF. Otherwise it is awaitable; with stream=True only an
+# awaitable read(n) is provided, as by a StreamReader.
+class _Socket:
+
+    def __init__(self, data, blocking=False, burst=4096, delay=(20, 400), seed=1):
+        self._data = data
+        self._pos = 0
+        self._avail = 0  # Bytes of current burst not yet read
+        self._burst = burst
+        self._rnd = random.Random(seed)
+        self._delay = delay
+        self.stalls = 0
+        if blocking:
+            self.readinto = self._breadinto
+
+    def _get(self, buf, n):
+        n = min(n, self._avail, 1460, len(self._data) - self._pos)
+        buf[:n] = self._data[self._pos : self._pos + n]
+        self._pos += n
+        self._avail -= n
+        clock.advance(50 + n / 10)  # Stack overhead and copy
+        return n
+
+    def _wait(self):  # ms until next burst
+        self._avail = self._burst
+        self.stalls += 1
+        return self._rnd.randint(*self._delay)
+
+    async def readinto(self, buf):
+        if self._pos >= len(self._data):
+            return 0
+        if not self._avail:
+            await asyncio.sleep_ms(self._wait())
+        return self._get(buf, len(buf))
+
+    def _breadinto(self, buf, nbytes=None):
+        n = len(buf) if nbytes is None else min(nbytes, len(buf))
+        mv = memoryview(buf)
+        got = 0
+        while got < n and self._pos < len(self._data):
+            if not self._avail:
+                clock.advance(self._wait() * 1000)  # Scheduler is blocked
+            got += self._get(mv[got:], n - got)
+        return got
+
+
+class _StreamReader:
+
+    def __init__(self, sock):
+        self._sock = sock
+
+    async def read(self, n):
+        buf = bytearray(n)
+        n = await self._sock.readinto(buf)
+        return bytes(buf[:n])
+
+
+# Async play of 256KiB at 128Kbps from a bursty network source averaging
+# around 19KB/s, with a 16KiB buffer. A concurrent task sleeps for 10ms
+# repeatedly and measures how late it is scheduled. The smallest legal
+# prebuffer and watermarks must play without hanging; smaller ones must raise.
+def async_source(nbytes=256 * 1024):
+    data = audio(nbytes)
+    for play in ({'prebuffer': 0}, {'watermarks': (0, 2048)}, {'watermarks': (16, 2048)},
+                 {'watermarks': (0, 16)}):
+        player = _player('vs1053', rig(), buffered=16384)
+        try:
+            asyncio.run(player.play(_Socket(data[:4096], blocking=False), **play))
+        except ValueError:
+            continue
+        raise AssertionError('play accepted {}'.format(play))
+    print('Illegal prebuffer and watermarks raise ValueError')
+    for title, kwargs, src, play in (
+            ('Blocking readinto', {'buffered': 16384}, 'blocking', {}),
+            ('Awaitable readinto', {'buffered': 16384}, 'async', {}),
+            ('Awaitable read (StreamReader)', {'buffered': 16384}, 'stream', {}),
+            ('Awaitable readinto, unbuffered', {}, 'async', {}),
+            ('Awaitable readinto, prebuffer 32, watermarks 32/32', {'buffered': 16384}, 'async',
+             {'prebuffer': 32, 'watermarks': (32, 32)}),
+            ('Awaitable readinto, prebuffer 32, watermarks 32/2KiB', {'buffered': 16384}, 'async',
+             {'prebuffer': 32, 'watermarks': (32, 2048)})):
+        chip = rig(byte_rate=_KBPS * 125)
+        player = _player('vs1053', chip, **kwargs)
+        sock = _Socket(data, blocking=src == 'blocking')
+        s = _StreamReader(sock) if src == 'stream' else sock
+        t0 = clear(chip)
+        late = [0]
+
+        async def other():
+            while True:
+                t = clock.us + 10_000
+                await asyncio.sleep_ms(10)
+                late[0] = max(late[0], clock.us - t)
+
+        async def main():
+            task = asyncio.create_task(other())
+            await player.play(s, **play)
+            task.cancel()
+
+        asyncio.run(main())
+        report('{}: {} bursts'.format(title, sock.stalls), t0, chip)
+        print('  data played {}/{}  concurrent task max latency {:.1f}ms'.format(
+              min(chip.sdi_bytes, nbytes), nbytes, late[0] / 1000))
+
+
+# Local HTTP server streaming audio in bursts separated by random delays in
+# virtual time. With metaint it is an ICY server interleaving metadata blocks
+# whose title changes every 4 blocks. Some blocks have a StreamUrl after the
+# title, others omit the final ; terminator. A request for /old is redirected
+# to an absolute URL, one for /rel to a path.
+def _radio_server(data, metaint, burst=4096, delay=(20, 420), seed=1):
+    rnd = random.Random(seed)
+
+    async def handler(reader, writer):
+        req = await reader.readuntil(b'\r\n\r\n')
+        if req.startswith(b'GET /old '):
+            port = writer.get_extra_info('sockname')[1]
+            writer.write('HTTP/1.0 302 Found\r\nLocation: http://127.0.0.1:{}/new\r\n\r\n'.format(
+                         port).encode())
+            writer.close()
+            return
+        if req.startswith(b'GET /rel '):
+            writer.write(b'HTTP/1.0 301 Moved Permanently\r\nLocation: /new\r\n\r\n')
+            writer.close()
+            return
+        if metaint:
+            writer.write('ICY 200 OK\r\nicy-name:Sim FM\r\nicy-br:128\r\n'
+                         'icy-metaint:{}\r\n\r\n'.format(metaint).encode())
+        else:
+            writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: audio/mpeg\r\n\r\n')
+        pos = 0
+        sent = 0  # Bytes of current burst
+        left = metaint  # Bytes before next metadata block
+        block = 0
+        while pos < len(data):
+            n = min(burst - sent, len(data) - pos)
+            if metaint:
+                n = min(n, left)
+            writer.write(data[pos : pos + n])
+            pos += n
+            sent += n
+            if metaint:
+                left -= n
+                if not left and pos < len(data):
+                    fmt = ("StreamTitle='Track {}';StreamUrl='';", "StreamTitle='Track {}'",
+                           "StreamTitle='Track {}'\r\n")[block % 3]
+                    meta = fmt.format(block // 4).encode()
+                    meta += bytes(-len(meta) % 16)
+                    writer.write(bytes((len(meta) // 16,)) + meta)
+                    block += 1
+                    left = metaint
+            if sent >= burst:
+                sent = 0
+                await writer.drain()
+                await asyncio.sleep_ms(rnd.randint(*delay))
+        await writer.drain()
+        writer.close()
+
+    return handler
+
+
+# Internet radio: play 128KiB at 128Kbps from a local server delivering data
+# in bursts, with a 16KiB jitter buffer and various prebuffer and watermark
+# settings. The audio reaching the VS1053 is checked against the source.
+def radio(nbytes=128 * 1024):
+    import vs1053
+    from radio import Radio
+    data = audio(nbytes)
+    for title, metaint, path, pre, wm in (('ICY, prebuffer 2KiB', 8192, '/new', 2048, None),
+                                          ('ICY, prebuffer 12KiB', 8192, '/new', 12288, None),
+                                          ('ICY, 12KiB, watermarks 12/15KiB', 8192, '/new', 12288, (12288, 15360)),
+                                          ('ICY, watermarks 4/8KiB', 8192, '/new', None, (4096, 8192)),
+                                          ('HTTP via redirect, 12KiB', 0, '/old', 12288, None),
+                                          ('ICY, relative redirect, 12KiB', 8192, '/rel', 12288, None)):
+        chip = rig(byte_rate=_KBPS * 125)
+        got = bytearray()
+
+        def hook(spi, wbuf, rbuf, sdi=chip._sdi_transfer):
+            if bytes(wbuf).count(chip.end_fill) != len(wbuf):
+                got.extend(wbuf)
+            sdi(spi, wbuf, rbuf)
+
+        chip._sdi_transfer = hook
+        player = vs1053.VS1053(chip.spi, *chip.args, buffered=16384)
+        titles = []
+        t0 = clear(chip)
+
+        async def main():
+            server = await asyncio.start_server(_radio_server(data, metaint), '127.0.0.1', 0)
+            port = server.sockets[0].getsockname()[1]
+            r = Radio(player, 'http://127.0.0.1:{}{}'.format(port, path), pre, wm, titles.append)
+            await r.play()
+            server.close()
+            return r
+
+        r = asyncio.run(main())
+        st = r.stats()
+        print('{:32s} start {:4.0f}ms  underruns {:2d} (rebuffering {:5.0f}ms)  min level {:5d}  '
+              'reads {:3d}  titles {} {}  metadata blocks {}  data {}'.format(title + ':', st['start_ms'],
+              st['underruns'], st['rebuffer_ms'], st['min'], st['reads'], len(titles),
+              'OK' if titles == ['Track {}'.format(n) for n in range(len(titles))] else 'ERROR',
+              st['metadata'], 'OK' if bytes(got) == data else 'ERROR'))
+
+
+# Stream lacking tell(): the buffered players cannot align their reads.
+class _NoTell:
+
+    def __init__(self, f):
+        self.readinto = f.readinto
+
+
+# SD card reads per MiB by the buffered players with playback starting at
+# sector aligned and unaligned file offsets (the latter e.g. after skipping an
+# ID3 tag). A stream without tell() shows the behaviour prior to alignment.
+def refill_align(nbytes=1024 * 1024):
+    data = audio(nbytes + 1024)
+    for module in ('vs1053', 'vs1053_syn'):
+        for offs, aligned in ((0, True), (417, False), (417, True)):
+            chip = rig(byte_rate=_KBPS * 125 * 4)
+            player = _player(module, chip, buffered=True)
+            f = SimFile(data)
+            f.seek(offs)
+            t0 = clear(chip, f)
+            s = f if aligned else _NoTell(f)
+            if module == 'vs1053':
+                asyncio.run(player.play(s))
+            else:
+                player.play(s)
+            st = f.stats()
+            mib = st['bytes'] / (1024 * 1024)
+            print('{:10s} offset {:3d} {:9s}: per MiB file reads {:4.0f}  readblocks {:5.0f}  '
+                  'sectors {:5.0f}  longest read {:.1f}ms  underruns {}'.format(
+                  module, offs, 'aligned' if aligned else 'no tell', st['calls'] / mib,
+                  st['block_calls'] / mib, st['sectors'] / mib, st['max_us'] / 1000, chip.underruns))
+
+
+# Stream reading contiguous sectors directly from an SD card, standing in for a
+# file on a mounted card.
+class _SDStream:
+
+    def __init__(self, sd, start, nbytes):
+        self._sd = sd
+        self._pos = start * 512
+        self._end = self._pos + nbytes
+        self._sec = bytearray(512)
+
+    def readinto(self, buf, nbytes=None):
+        n = len(buf) if nbytes is None else min(nbytes, len(buf))
+        n = min(n, self._end - self._pos)
+        mv = memoryview(buf)
+        whole = n & ~511
+        if whole:
+            self._sd.readblocks(self._pos // 512, mv[:whole])
+        if n > whole:  # Final part sector
+            self._sd.readblocks((self._pos + whole) // 512, self._sec)
+            mv[whole:n] = self._sec[: n - whole]
+        self._pos += n
+        return n
+
+
+# Buffered async play from an SD card sharing the bus with the VS1053, with a
+# concurrent task reading a sector every 50ms. With a raw SPI instance the
+# last device to call spi.init() sets the clock for both. With an SPIBus each
+# runs at its own rate.
+def spi_bus(nbytes=256 * 1024):
+    import card
+    import sdcard
+    from spibus import SPIBus
+    import vs1053
+    data = audio(nbytes)
+    start = 20000
+    for title in ('Raw SPI, card initialised first', 'Raw SPI, card initialised last', 'SPIBus'):
+        chip = rig(byte_rate=_KBPS * 125 * 2)
+        c = card.rig(spi=chip.spi)
+        for n in range(nbytes // 512):
+            c.data[start + n] = data[n * 512 : (n + 1) * 512]
+        bus = None
+        if title == 'SPIBus':
+            bus = SPIBus(chip.spi)
+            sd = sdcard.SDCard(bus.device('sd'), c.cs)
+            player = vs1053.VS1053(bus, *chip.args, buffered=True)
+        elif title.endswith('first'):
+            sd = sdcard.SDCard(chip.spi, c.cs)
+            player = vs1053.VS1053(chip.spi, *chip.args, buffered=True)
+        else:
+            player = vs1053.VS1053(chip.spi, *chip.args, buffered=True)
+            sd = sdcard.SDCard(chip.spi, c.cs)
+        c.clear_stats()
+        t0 = clear(chip)
+        if bus is not None:
+            bus.clear_stats()
+        late = [0]
+
+        async def meta(buf=bytearray(512)):
+            while player._playing:
+                t = clock.us + 50_000
+                await asyncio.sleep_ms(50)
+                late[0] = max(late[0], clock.us - t)
+                sd.readblocks(10, buf)
+
+        async def main():
+            asyncio.create_task(meta())
+            await player.play(_SDStream(sd, start, nbytes))
+
+        asyncio.run(main())
+        report('{}: play {}KiB at {}Kbps'.format(title, nbytes // 1024, _KBPS * 2), t0, chip)
+        print('  card: blocks read {}  baud errors {}  meta task max latency {:.1f}ms'.format(
+              c.blocks_read, c.baud_errors, late[0] / 1000))
+        if bus is not None:
+            print('  SD clock {:.3f}MHz  VS1053 data clock {:.3f}MHz'.format(
+                  sd.baudrate / 1e6, player._spi._cfg[0] / 1e6))
+            for name, st in bus.stats().items():
+                print('  {:8s} calls {:6d}  bytes {:7d}  takes {:4d}  spi.init {:4d}  '
+                      'bus time {:6.1f}ms  utilisation {:4.1f}%'.format(name, st['calls'],
+                      st['bytes'], st['takes'], st['inits'], st['bus_us'] / 1000, st['util']))
+
+
+# Until marker has been sent, SDI data is treated by the chip as metadata which
+# the decoder discards.
+def _metadata(chip, marker):
+    sdi = chip._sdi_transfer
+    tail = [b'']  # End of data sent, None once marker is found
+
+    def transfer(spi, wbuf, rbuf):
+        if tail[0] is not None:
+            data = tail[0] + bytes(wbuf)
+            i = data.find(marker)
+            if i < 0:
+                chip.discard = len(wbuf)
+                tail[0] = data[1 - len(marker):]
+            else:
+                chip.discard = max(i - len(tail[0]), 0)
+                tail[0] = None
+        sdi(spi, wbuf, rbuf)
+
+    chip._sdi_transfer = transfer
+
+
+class _NoSeek:  # A stream whose metadata cannot be skipped
+
+    def __init__(self, f):
+        self.readinto = f.readinto
+        self.tell = f.tell
+
+
+def _syncsafe(n):
+    return bytes(((n >> 21) & 0x7f, (n >> 14) & 0x7f, (n >> 7) & 0x7f, n & 0x7f))
+
+
+# Files with large embedded images: (title, bytes preceding the audio).
+def _tagged(art):
+    id3 = b'ID3\x04\x00\x00' + _syncsafe(len(art) + 20) + b'APIC' + _syncsafe(len(art) + 10) + b'\x00\x00' + bytes(10) + art
+    ape = (b'APETAGEX' + (2000).to_bytes(4, 'little') + (len(art) + 32).to_bytes(4, 'little')
+           + (1).to_bytes(4, 'little') + (0xa0000000).to_bytes(4, 'little') + bytes(8))
+    ape += art + ape[:20] + (0x80000000).to_bytes(4, 'little') + bytes(8)  # Footer
+    info = bytes(34)  # STREAMINFO
+    flac = (b'fLaC\x00\x00\x00\x22' + info + b'\x04\x00\x00\x08' + bytes(8)  # VORBIS_COMMENT
+            + b'\x86' + len(art).to_bytes(3, 'big') + art)  # Last: PICTURE
+    fmt = b'fmt \x10\x00\x00\x00' + bytes(16)
+    lst = b'LIST' + len(art).to_bytes(4, 'little') + art
+    return (('MP3, ID3v2 APIC', id3), ('MP3, APEv2 tag', ape), ('FLAC, PICTURE', flac),
+            ('WAV, LIST chunk', (fmt, lst)))
+
+
+# Time to first sound and bytes sent to the chip when playing files whose
+# audio is preceded by a 256KiB image, with and without skipping metadata.
+# The chip discards metadata as fast as it arrives, so the time is spent
+# reading it from the file and sending it.
+def first_sound(nbytes=32 * 1024, art=256 * 1024):
+    marker = b'\x00\x00AUDIO\x00\x00'
+    data = marker + audio(nbytes)
+    for title, head in _tagged(audio(art, 2)):
+        if isinstance(head, tuple):  # RIFF: chunks precede data chunk header
+            chunks = b''.join(head) + b'data' + len(data).to_bytes(4, 'little')
+            head = b'RIFF' + (4 + len(chunks) + len(data)).to_bytes(4, 'little') + b'WAVE' + chunks
+        for module, kwargs in (('vs1053', {'buffered': True}), ('vs1053_syn', {}),
+                               ('vs1053_syn', {'buffered': True})):
+            for skip in (False, True):
+                chip = rig(byte_rate=_KBPS * 125)
+                player = _player(module, chip, **kwargs)
+                _metadata(chip, marker)
+                f = SimFile(head + data)
+                t0 = clear(chip, f)
+                s = f if skip else _NoSeek(f)
+                if module == 'vs1053':
+                    asyncio.run(player.play(s))
+                else:
+                    player.play(s)
+                print('{:16s} {:10s} {:8s} {:7s}: first sound {:6.0f}ms  SDI bytes {:6d}  '
+                      'file bytes {:6d}  discarded {:6d}'.format(title, module,
+                      'buffered' if kwargs else '', 'skip' if skip else 'no skip',
+                      (chip.first_sound - t0) / 1000, chip.sdi_bytes, f.stats()['bytes'],
+                      chip.discarded))
+
+
+def _maxrate(ok, lo=8000, hi=200_000):  # Binary search on byte rate
+    while hi - lo > 2000:
+        mid = (lo + hi) // 2
+        if ok(mid):
+            lo = mid
+        else:
+            hi = mid
+    return lo * 8 // 1000  # Kbps
+
+
+BENCHES = {'playback': playback, 'dreq_irq': dreq_irq, 'alloc': alloc, 'sweep': sweep, 'sync_rate': sync_rate,
+           'sci_traffic': sci_traffic, 'spi_init': spi_init,
+           'plugin': plugin, 'async_record': async_record,
+           'sync_record': sync_record, 'drain': drain,
+           'rec_latency': rec_latency, 'ogg_record': ogg_record,
+           'rec_sink': rec_sink, 'sd_read': sd_read,
+           'sd_meta': sd_meta, 'sd_write': sd_write,
+           'sd_clock': sd_clock, 'spi_bus': spi_bus,
+           'refill_align': refill_align, 'gapless': gapless,
+           'async_source': async_source, 'radio': radio,
+           'first_sound': first_sound}
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or BENCHES:
+        BENCHES[name]()
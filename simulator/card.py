@@ -0,0 +1,323 @@
+# card.py Behavioural model of an SD card in SPI mode for host-side testing
+# (C) Peter Hinch 2020-2022
+# Released under the MIT licence
+
+# Models the SPI mode command set used by sdcard.py: initialisation (CMD0, 8,
+# 55, ACMD41, 58), CSD read (CMD9), single and multiple block reads (CMD17,
+# 18, 12) and writes (CMD24, 25 with start and stop tokens), pre-erase
+# (ACMD23) and erase (CMD32, 33, 38). Timing is modelled by the card
+# withholding data tokens (reads) and holding MISO low (writes) until the
+# relevant delay has elapsed. Writes to sectors which have not been erased
+# periodically incur a long stall, modelling the card erasing a new block
+# internally. Unwritten sectors hold a pattern derived from the sector number
+# so that reads may be verified; erased sectors read as zeros. Data blocks
+# carry a valid CRC16. CMD6 switches a card supporting it to high speed mode,
+# doubling its maximum clock. Above wire_baud, modelling the limit of the
+# wiring rather than the card, data read is corrupted.
+
+from binascii import crc_hqx
+from simenv import clock
+from machine import SPI, Pin
+
+_TOKEN_CMD25 = 0xfc
+_TOKEN_STOP_TRAN = 0xfd
+_TOKEN_DATA = 0xfe
+
+
+def pattern(sector):  # Contents of an unwritten sector
+    return sector.to_bytes(4, 'little') * 128
+
+
+class Card:
+
+    def __init__(self, spi, cs, *, nsectors=15160 * 1024, access_us=500, block_us=40,
+                 write_us=1500, mwrite_us=600, erased_us=250, stop_us=800, erase_us=2000,
+                 stall_every=0, stall_us=0, max_baud=25_000_000, hs=True, wire_baud=None):
+        self.spi = spi
+        self.cs = cs
+        self.nsectors = nsectors
+        self.access_us = access_us  # Delay from read command to first data token
+        self.block_us = block_us  # Delay between blocks of a multiple block read
+        self.write_us = write_us  # Busy time after a single block write
+        self.mwrite_us = mwrite_us  # Busy time per block of a multiple block write
+        self.erased_us = erased_us  # Busy time per block written to an erased sector
+        self.stop_us = stop_us  # Busy time after a stop transmission token
+        self.erase_us = erase_us  # Busy time after CMD38
+        self.stall_every = stall_every  # Blocks written to unerased sectors per stall
+        self.stall_us = stall_us  # Additional busy time of a stall
+        self.max_baud = max_baud  # Maximum SPI clock (TRAN_SPEED)
+        self.hs = hs  # Supports high speed mode
+        self.wire_baud = wire_baud  # Data is corrupted above this clock
+        self.data = {}  # Written sectors
+        self.erased = set()  # Sectors erased and not since written
+        self._unerased = 0  # Blocks written to unerased sectors
+        spi._attach(self)
+        cs._watch(self._cs_change)
+        self.clear_stats()
+        self._power_on()
+
+    def clear_stats(self):
+        self.cmds = {}  # Count of each command. ACMDs are keyed 100 + n
+        self.blocks_read = 0
+        self.blocks_written = 0
+        self.stalls = 0
+        self.max_busy = 0  # Longest busy period after a block write (μs)
+        self.baud_errors = 0  # Transfers above max_baud
+        self.corrupted = 0  # Data blocks corrupted by exceeding wire_baud
+        self.mode_errors = 0  # Transfers with wrong SPI polarity or phase
+
+    def stats(self):
+        return {'cmds': dict(self.cmds), 'blocks_read': self.blocks_read,
+                'blocks_written': self.blocks_written, 'stalls': self.stalls,
+                'max_busy': self.max_busy, 'baud_errors': self.baud_errors,
+                'corrupted': self.corrupted,
+                'mode_errors': self.mode_errors}
+
+    def _power_on(self):
+        self._idle = True
+        self._baud = self.max_baud  # Limit in current speed mode
+        self._app = False  # Next command is an ACMD
+        self._cmd = bytearray(6)
+        self._cidx = -1  # Index into command frame, -1 if none in progress
+        self._out = bytearray()  # Pending response bytes
+        self._busy_until = 0.0
+        self._rblock = None  # Next block of a read. None if not reading.
+        self._rmulti = False
+        self._rready = 0.0  # Time when next data token may be sent
+        self._rdata = None  # Block being sent: token, data and CRC
+        self._special = None  # Data of a register read (CSD, CMD6 status)
+        self._ridx = 0
+        self._wblock = None  # Next block of a write. None if not writing.
+        self._wmulti = False
+        self._wrx = None  # Data block being received
+        self._preerase = 0  # Blocks of next CMD25 pre-erased by ACMD23
+        self._erase_start = 0
+        self._erase_end = 0
+
+    def block(self, sector):
+        if sector in self.erased:
+            return bytes(512)
+        return self.data.get(sector) or pattern(sector)
+
+    def _csd(self):
+        csd = bytearray(16)
+        csd[0] = 0x40  # CSD version 2.0
+        csd[3] = 0x5a if self._baud > 25_000_000 else 0x32  # TRAN_SPEED
+        ccc = 0x5b5 if self.hs else 0x1b5  # Command classes: 10 is switch function
+        csd[4] = ccc >> 4
+        csd[5] = (ccc & 0x0f) << 4 | 9  # READ_BL_LEN 512 bytes
+        c_size = self.nsectors // 1024 - 1
+        csd[7] = (c_size >> 16) & 0x3f
+        csd[8] = (c_size >> 8) & 0xff
+        csd[9] = c_size & 0xff
+        return csd
+
+    def _selected(self):
+        return not self.cs._v
+
+    def _cs_change(self, v):
+        if v:  # Deselected: unclocked responses are lost
+            self._out = bytearray()
+            self._cidx = -1
+
+    def _transfer(self, spi, wbuf, rbuf):
+        if spi.polarity or spi.phase:
+            self.mode_errors += 1
+        if spi.baudrate > self._baud:
+            self.baud_errors += 1
+        corrupt = self.wire_baud is not None and spi.baudrate > self.wire_baud
+        n = len(wbuf)
+        i = 0
+        while i < n:
+            # Fast path for the body of a data block being read
+            rdata = self._rdata
+            if rdata is not None and self._ridx and self._cidx < 0 and not self._out:
+                k = min(n - i, len(rdata) - self._ridx)
+                if wbuf[i : i + k].count(0xff) == k:
+                    if rbuf is not None:
+                        rbuf[i : i + k] = rdata[self._ridx : self._ridx + k]
+                        if corrupt:  # One bit error per transfer
+                            rbuf[i] ^= 0x10
+                            self.corrupted += 1
+                    self._ridx += k
+                    i += k
+                    if self._ridx == len(rdata):
+                        self._end_block()
+                    continue
+            if self._wrx is not None:  # Data block being written
+                k = min(n - i, 514 - len(self._wrx))
+                self._wrx.extend(wbuf[i : i + k])
+                if rbuf is not None:
+                    rbuf[i : i + k] = b'\xff' * k
+                i += k
+                if len(self._wrx) == 514:  # Data and CRC
+                    self._write_block()
+                continue
+            v = self._step(wbuf[i])
+            if rbuf is not None:
+                rbuf[i] = v
+            i += 1
+
+    def _step(self, b):
+        if self._cidx >= 0 or 0x40 <= b < 0x80:  # Command frame
+            if self._cidx < 0:
+                self._cidx = 0
+            self._cmd[self._cidx] = b
+            self._cidx += 1
+            if self._cidx == 6:
+                self._cidx = -1
+                self._command()
+            return 0xff
+        if self._out:
+            v = self._out[0]
+            del self._out[0]
+            return v
+        now = clock.us
+        if now < self._busy_until:
+            return 0
+        if self._wblock is not None:  # Awaiting data token
+            if b == _TOKEN_DATA or (b == _TOKEN_CMD25 and self._wmulti):
+                self._wrx = bytearray()
+            elif b == _TOKEN_STOP_TRAN and self._wmulti:
+                self._wblock = None
+                self._preerase = 0
+                self._busy_until = now + self.stop_us
+            return 0xff
+        if self._rblock is not None:
+            if self._rdata is None:
+                if now < self._rready:
+                    return 0xff
+                self._start_block()
+            v = self._rdata[self._ridx]
+            self._ridx += 1
+            if self._ridx == len(self._rdata):
+                self._end_block()
+            return v
+        return 0xff
+
+    def _start_block(self):
+        data = self._special if self._rblock < 0 else self.block(self._rblock)
+        crc = crc_hqx(data, 0).to_bytes(2, 'big')
+        self._rdata = b''.join((bytes((_TOKEN_DATA,)), data, crc))
+        self._ridx = 0
+
+    def _end_block(self):
+        self._rdata = None
+        if self._rblock >= 0:
+            self.blocks_read += 1
+        if self._rmulti:
+            self._rblock += 1
+            self._rready = clock.us + self.block_us
+        else:
+            self._rblock = None
+
+    def _write_block(self):
+        sector = self._wblock
+        self.data[sector] = bytes(self._wrx[:512])
+        self.blocks_written += 1
+        self._wrx = None
+        self._out.append(0xe5)  # Data accepted
+        if sector in self.erased or self._preerase:
+            self.erased.discard(sector)
+            us = self.erased_us
+            self._preerase = max(self._preerase - 1, 0)
+        else:
+            us = self.mwrite_us if self._wmulti else self.write_us
+            self._unerased += 1
+            if self.stall_every and not self._unerased % self.stall_every:
+                us += self.stall_us
+                self.stalls += 1
+        self.max_busy = max(self.max_busy, us)
+        self._busy_until = clock.us + us
+        if self._wmulti:
+            self._wblock += 1
+        else:
+            self._wblock = None
+
+    def _command(self):
+        c = self._cmd
+        cmd = c[0] & 0x3f
+        arg = int.from_bytes(c[1:5], 'big')
+        key = cmd + 100 if self._app else cmd
+        self.cmds[key] = self.cmds.get(key, 0) + 1
+        app = self._app
+        self._app = False
+        r1 = 0x01 if self._idle else 0
+        extra = b''
+        if cmd == 0:
+            self._power_on()
+            r1 = 0x01
+        elif cmd == 8:
+            extra = bytes((0, 0, (arg >> 8) & 0x0f, arg & 0xff))
+        elif cmd == 55:
+            self._app = True
+        elif cmd == 41 and app:
+            self._idle = False
+            r1 = 0
+        elif cmd == 58:
+            extra = b'\xc0\xff\x80\x00'  # Powered up, SDHC
+        elif cmd == 9:
+            self._special = bytes(self._csd())
+            self._read(-1, False, 0)
+        elif cmd == 6:  # Switch function: only group 1 (access mode) is modelled
+            status = bytearray(64)
+            fn = arg & 0x0f
+            ok = fn == 0 or (fn == 1 and self.hs)
+            status[16] = fn if ok else 0x0f  # Function selected in group 1
+            if ok and fn == 1 and arg & 0x80000000:  # Switch to high speed
+                self._baud = 2 * self.max_baud
+            self._special = bytes(status)
+            self._read(-1, False, 0)
+        elif cmd == 12:
+            self._rblock = None
+            self._rdata = None
+            self._out.append(0xff)  # Stuff byte
+        elif cmd in (17, 18):
+            if arg >= self.nsectors:
+                r1 = 0x20  # Address error
+            else:
+                self._read(arg, cmd == 18, self.access_us)
+        elif cmd in (24, 25):
+            if arg >= self.nsectors:
+                r1 = 0x20
+            else:
+                self._wblock = arg
+                self._wmulti = cmd == 25
+                if cmd == 24:
+                    self._preerase = 0
+        elif cmd == 13:
+            extra = b'\x00'
+        elif cmd == 23 and app:
+            self._preerase = arg & 0x7fffff
+        elif cmd == 32:
+            self._erase_start = arg
+        elif cmd == 33:
+            self._erase_end = arg
+        elif cmd == 38:
+            for sector in range(self._erase_start, self._erase_end + 1):
+                self.data.pop(sector, None)
+                self.erased.add(sector)
+            self._out.append(0xff)  # NCR
+            self._out.append(r1)
+            self._busy_until = clock.us + self.erase_us  # R1b: busy follows R1
+            return
+        elif cmd not in (16, 59):
+            r1 |= 0x04  # Illegal command
+        self._out.append(0xff)  # NCR
+        self._out.append(r1)
+        self._out.extend(extra)
+
+    def _read(self, block, multi, us):
+        self._rblock = block
+        self._rmulti = multi
+        self._rdata = None
+        self._rready = clock.us + us
+
+
+# Create an SPI bus and chip select with an attached card. Pass spi to share a
+# bus with another device.
+def rig(spi=None, **kwargs):
+    if spi is None:
+        spi = SPI(1)
+    cs = Pin('sdcs', Pin.OUT, value=1)
+    return Card(spi, cs, **kwargs)
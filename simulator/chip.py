@@ -0,0 +1,403 @@
+# chip.py Behavioural model of a VS1053b for host-side testing of the drivers
+# (C) Peter Hinch 2020-2022
+# Released under the MIT licence
+
+# Models the SCI register file and WRAM, the 2048 byte SDI FIFO draining at a
+# configurable byte rate and driving DREQ, the SM_CANCEL/end-fill protocol and
+# the HDAT0/HDAT1 recording FIFO. Audio is not decoded: the model tracks FIFO
+# occupancy and reports underruns, overflows and bus protocol violations.
+# The Ogg Vorbis encoder application is modelled by its SCI protocol: once
+# started it produces data at ogg_rate bytes/s; a stop request is honoured
+# after ogg_finish_us. Silences between tracks are measured: audio ends when
+# the FIFO content preceding end fill has been decoded and resumes when the
+# fill preceding new audio has been decoded. Metadata such as ID3 tags is
+# parsed and discarded by the decoder far faster than audio is decoded: a test
+# sets discard to the number of bytes of following SDI data to treat as such.
+# These do not enter the FIFO. The time at which the first audio is decoded is
+# recorded.
+
+from simenv import clock
+from machine import SPI, Pin
+
+_FIFO_SIZE = 2048
+_REC_SIZE = 1024  # Words in recording FIFO
+_XTAL = 12_288_000
+_MULT = (1.0, 2.0, 2.5, 3.0, 3.5, 4.0, 4.5, 5.0)  # SC_MULT field of CLOCKF
+
+_SCI_MODE = 0x0
+_SCI_STATUS = 0x1
+_SCI_CLOCKF = 0x3
+_SCI_DECODE_TIME = 0x4
+_SCI_WRAM = 0x6
+_SCI_WRAMADDR = 0x7
+_SCI_HDAT0 = 0x8
+_SCI_HDAT1 = 0x9
+_SCI_AIADDR = 0xa
+_SCI_AICTRL0 = 0xc
+_SCI_AICTRL3 = 0xf
+
+_SM_RESET = 0x04
+_SM_CANCEL = 0x08
+_SM_ADPCM = 0x1000
+
+_END_FILL_BYTE = 0x1e06
+_BYTE_RATE = 0x1e05
+_IO_DIRECTION = 0xc017
+_IO_READ = 0xc018
+_IO_WRITE = 0xc019
+
+
+class VS1053Chip:
+
+    def __init__(self, spi, reset, dreq, xdcs, xcs, *, byte_rate=16_000,
+                 dreq_low=32, dreq_high=640, cancel_bytes=512, end_fill=0,
+                 hdat=(0x0080, 0xfffb), sci_busy_us=2, reset_us=1800, ogg_rate=2500,
+                 ogg_finish_us=20_000):
+        self.spi = spi
+        self.args = (reset, dreq, xdcs, xcs)  # Driver constructor order
+        self._reset = reset
+        self._dreq = dreq
+        self._xdcs = xdcs
+        self._xcs = xcs
+        self.byte_rate = byte_rate  # Rate at which the decoder consumes data
+        self.dreq_low = dreq_low  # DREQ falls when free space < this
+        self.dreq_high = dreq_high  # and rises when free space >= this
+        self.cancel_bytes = cancel_bytes  # Bytes consumed before cancel ack
+        self.end_fill = end_fill
+        self.hdat = hdat  # HDAT0, HDAT1 values while decoding
+        self.sci_busy_us = sci_busy_us
+        self.reset_us = reset_us
+        self.ogg_rate = ogg_rate  # Encoder output bytes/s
+        self.ogg_finish_us = ogg_finish_us  # Time to finish after stop request
+        self._t = clock.us
+        self._sci = bytearray(4)  # SCI command in progress
+        self._sci_idx = 0
+        spi._attach(self)
+        xcs._watch(self._xcs_change)
+        reset._watch(self._reset_change)
+        dreq._nexthigh = self._nexthigh
+        clock.listen(self._update)
+        clock.event(self._nexthigh)
+        self._rise_t = None
+        self._audio_end = None  # Time at which the FIFO content preceding end fill is decoded
+        self.discard = 0  # Bytes of following SDI data discarded as metadata
+        self.clear_stats()
+        self._power_on()
+
+    def clear_stats(self):
+        self.sci_reads = 0
+        self.sci_writes = 0
+        self.reg_reads = [0] * 16
+        self.reg_writes = [0] * 16
+        self.sdi_calls = 0
+        self.sdi_bytes = 0
+        self.underruns = 0
+        self.underrun_us = 0.0
+        self.overflows = 0  # Bytes lost writing to a full FIFO
+        self.baud_errors = 0  # Transfers faster than the chip allows
+        self.busy_errors = 0  # SCI access while chip busy
+        self.rec_lost = 0  # Recorded words lost to FIFO overrun
+        self.rec_max = 0  # Peak recording FIFO occupancy
+        self.lat_n = 0  # Latency from DREQ rising to next SDI write
+        self.lat_us = 0.0
+        self.lat_max = 0.0
+        self.gaps = []  # Silences between tracks (μs): end of audio to its resumption
+        self.first_sound = None  # Time at which the first audio is decoded (μs)
+        self.discarded = 0  # Bytes discarded as metadata
+
+    def stats(self):
+        return {'sci_reads': self.sci_reads, 'sci_writes': self.sci_writes,
+                'sdi_calls': self.sdi_calls, 'sdi_bytes': self.sdi_bytes,
+                'underruns': self.underruns, 'underrun_us': self.underrun_us,
+                'overflows': self.overflows, 'baud_errors': self.baud_errors,
+                'busy_errors': self.busy_errors, 'rec_lost': self.rec_lost,
+                'rec_max': self.rec_max, 'lat_max': self.lat_max,
+                'lat_mean': self.lat_us / self.lat_n if self.lat_n else 0,
+                'gaps': list(self.gaps), 'first_sound': self.first_sound,
+                'discarded': self.discarded}
+
+    def _power_on(self):
+        self.regs = [0] * 16
+        self.ram = {}
+        self.wramaddr = 0
+        self._hw_reset()
+
+    def _hw_reset(self):
+        r = self.regs
+        r[2:4] = [0] * 2  # BASS CLOCKF
+        r[0xb] = 0  # VOL
+        r[_SCI_AICTRL0:] = [0] * 4
+        self._soft_reset(0x4800)
+
+    def _soft_reset(self, mode):
+        r = self.regs
+        r[_SCI_MODE] = mode & ~(_SM_RESET | _SM_CANCEL)
+        r[_SCI_STATUS] = 0x40  # Version 4
+        r[_SCI_DECODE_TIME] = 0
+        r[_SCI_HDAT0] = 0
+        r[_SCI_HDAT1] = 0
+        r[_SCI_AIADDR] = 0
+        self.level = 0.0  # FIFO occupancy
+        self.consumed = 0.0  # Bytes decoded since reset
+        self.streaming = False
+        self._cancel_at = None
+        self._fifo_ok = True
+        self._busy_until = clock.us + self.reset_us
+        self._rec_rate = 0.0
+        self._rec_made = 0.0
+        self._rec_read = 0
+        self._rec_on = False  # HDAT registers return recorded data
+        self._ogg_end = None  # Time at which Ogg encoder will finish
+        if mode & _SM_ADPCM:
+            self._rec_on = True
+            sf = r[_SCI_AICTRL0] or 8000
+            chans = 1 if (r[_SCI_AICTRL3] & 7) >= 2 else 2
+            self._rec_rate = sf * 128 * chans / 505  # IMA ADPCM words/s
+        self._drive()
+
+    def _clki(self):
+        return _XTAL * _MULT[self.regs[_SCI_CLOCKF] >> 13]
+
+    # *** Time ***
+
+    def _update(self, now):
+        dt = now - self._t
+        self._t = now
+        if dt <= 0:
+            return
+        if self._rec_rate and now > self._busy_until:
+            self._rec_made += dt * self._rec_rate / 1e6
+            if self._ogg_end is not None and now >= self._ogg_end:
+                self._rec_rate = 0.0
+                self._rec_made = int(self._rec_made)
+                self.regs[_SCI_AICTRL3] |= 6  # Finished. Last word has 1 byte.
+        if self.level > 0:
+            n = min(self.level, dt * self.byte_rate / 1e6)
+            self.level -= n
+            self.consumed += n
+            if self.level < 1e-6:
+                self.level = 0.0
+                if self.streaming:
+                    self.underruns += 1
+                    self.underrun_us += dt - n * 1e6 / self.byte_rate
+            if self._cancel_at is not None and self.consumed >= self._cancel_at:
+                self._cancel_done()
+        elif self.streaming:
+            self.underrun_us += dt
+        self._drive()
+
+    def _cancel_done(self):
+        self._cancel_at = None
+        self.regs[_SCI_MODE] &= ~_SM_CANCEL
+        self.streaming = False
+
+    def _dreq_value(self):
+        if not self._reset._v or clock.us < self._busy_until:
+            return 0
+        free = _FIFO_SIZE - self.level
+        if self._fifo_ok:
+            self._fifo_ok = free >= self.dreq_low
+        else:
+            self._fifo_ok = free >= self.dreq_high - 1e-6
+        return int(self._fifo_ok)
+
+    def _drive(self):
+        v = self._dreq_value()
+        if v and not self._dreq._v and self.streaming:
+            self._rise_t = clock.us
+        self._dreq._drive(v)
+
+    def _nexthigh(self):  # μs until DREQ will rise, None if unknown
+        if not self._reset._v:
+            return None
+        t = self._busy_until - clock.us
+        if not self._fifo_ok:
+            t = max(t, (self.level - (_FIFO_SIZE - self.dreq_high)) * 1e6 / self.byte_rate)
+        return t if t > 0 else None
+
+    # *** Bus interface ***
+
+    def _selected(self):
+        return not (self._xcs._v and self._xdcs._v)
+
+    def _reset_change(self, v):
+        if v:
+            self._hw_reset()
+        else:
+            self._drive()
+
+    def _xcs_change(self, v):
+        if v:  # End of SCI transaction
+            self._sci_idx = 0
+
+    def _transfer(self, spi, wbuf, rbuf):
+        if spi.polarity or spi.phase:
+            self.baud_errors += 1
+        if not self._xcs._v:
+            if not self._xdcs._v:
+                spi.cs_errors += 1
+            self._sci_transfer(spi, wbuf, rbuf)
+        else:
+            self._sdi_transfer(spi, wbuf, rbuf)
+
+    def _sdi_transfer(self, spi, wbuf, rbuf):
+        n = len(wbuf)
+        if spi.baudrate > self._clki() / 4:
+            self.baud_errors += 1
+        self.sdi_calls += 1
+        self.sdi_bytes += n
+        if self._rise_t is not None:
+            lat = clock.us - self._rise_t
+            self._rise_t = None
+            self.lat_n += 1
+            self.lat_us += lat
+            self.lat_max = max(self.lat_max, lat)
+        k = min(n, self.discard)  # Metadata
+        self.discard -= k
+        self.discarded += k
+        fill = bytes(wbuf).count(self.end_fill) == n
+        if fill:
+            if self.streaming and self._audio_end is None:  # Audio ends when FIFO is decoded
+                self._audio_end = clock.us + self.level * 1e6 / self.byte_rate
+        elif k < n:  # Audio data rather than end fill
+            self.streaming = True
+            if self.first_sound is None:
+                self.first_sound = clock.us + self.level * 1e6 / self.byte_rate
+            if self._audio_end is not None:  # Resumes after FIFO content
+                self.gaps.append(clock.us + self.level * 1e6 / self.byte_rate - self._audio_end)
+                self._audio_end = None
+        self.level += n - k
+        if self.level > _FIFO_SIZE:
+            self.overflows += self.level - _FIFO_SIZE
+            self.level = _FIFO_SIZE
+        if rbuf is not None:
+            for i in range(n):
+                rbuf[i] = 0
+        self._drive()
+
+    def _sci_transfer(self, spi, wbuf, rbuf):
+        b = self._sci
+        for i, x in enumerate(wbuf):
+            idx = self._sci_idx
+            self._sci_idx += 1
+            out = 0
+            if idx < 4:
+                b[idx] = x
+            if idx == 1:
+                if clock.us < self._busy_until:
+                    self.busy_errors += 1
+                lim = 7 if b[0] == 3 else 4
+                if spi.baudrate > self._clki() / lim:
+                    self.baud_errors += 1
+                if b[0] == 3:
+                    self._rv = self._read(b[1] & 0x0f)
+            elif idx >= 2:
+                if b[0] == 3:
+                    if idx == 2:
+                        out = self._rv >> 8
+                    elif idx == 3:
+                        out = self._rv & 0xff
+                elif b[0] == 2:  # Multiple write: successive words to same register
+                    if idx & 1:
+                        b[3] = x
+                        self._write(b[1] & 0x0f, b[2] << 8 | x)
+                    else:
+                        if idx > 2 and clock.us < self._busy_until:
+                            self.busy_errors += 1
+                        b[2] = x
+            if rbuf is not None:
+                rbuf[i] = out
+
+    # *** Registers ***
+
+    def _read(self, addr):
+        self.sci_reads += 1
+        self.reg_reads[addr] += 1
+        r = self.regs
+        if addr == _SCI_HDAT1:
+            if self._rec_on:
+                return self._rec_avail()
+            return self.hdat[1] if self.streaming else 0
+        if addr == _SCI_HDAT0:
+            if self._rec_on:
+                if self._rec_avail():
+                    v = self._rec_read & 0xffff
+                    self._rec_read += 1
+                    return v
+                return 0
+            return self.hdat[0] if self.streaming else 0
+        if addr == _SCI_DECODE_TIME:
+            return int(self.consumed / self.byte_rate) & 0xffff
+        if addr == _SCI_WRAM:
+            v = self._ram_read(self.wramaddr)
+            self.wramaddr = (self.wramaddr + 1) & 0xffff
+            return v
+        if addr == _SCI_WRAMADDR:
+            return self.wramaddr
+        return r[addr]
+
+    def _write(self, addr, value):
+        self.sci_writes += 1
+        self.reg_writes[addr] += 1
+        self._busy_until = clock.us + self.sci_busy_us
+        if addr == _SCI_MODE:
+            old = self.regs[_SCI_MODE]
+            if value & _SM_RESET:
+                self._soft_reset(value)
+                return
+            self.regs[_SCI_MODE] = value
+            if value & _SM_CANCEL and not old & _SM_CANCEL:
+                if self.streaming:
+                    self._cancel_at = self.consumed + self.cancel_bytes
+                else:
+                    self._cancel_done()
+        elif addr == _SCI_CLOCKF:
+            self.regs[addr] = value
+            self._busy_until = clock.us + 100  # Clock setting can take 100μs
+        elif addr == _SCI_WRAM:
+            self.ram[self.wramaddr] = value
+            self.wramaddr = (self.wramaddr + 1) & 0xffff
+        elif addr == _SCI_WRAMADDR:
+            self.wramaddr = value
+        elif addr == _SCI_AIADDR:
+            self.regs[addr] = value
+            if value == 0x34 and self.regs[_SCI_MODE] & _SM_ADPCM:  # Start encoder
+                self.regs[_SCI_AICTRL3] &= ~6
+                self._rec_on = True
+                self._rec_rate = self.ogg_rate / 2
+        elif addr == _SCI_AICTRL3:
+            self.regs[addr] = value
+            if value & 1 and self._rec_rate and self.regs[_SCI_AIADDR] == 0x34:
+                self._ogg_end = clock.us + self.ogg_finish_us
+        elif addr not in (_SCI_STATUS, _SCI_HDAT0, _SCI_HDAT1, _SCI_DECODE_TIME):
+            self.regs[addr] = value
+        self._drive()
+
+    def _ram_read(self, addr):
+        if addr == _END_FILL_BYTE:
+            return self.end_fill
+        if addr == _BYTE_RATE:
+            return self.byte_rate if self.streaming else 0
+        if addr == _IO_READ:
+            return self.ram.get(_IO_WRITE, 0) & self.ram.get(_IO_DIRECTION, 0)
+        return self.ram.get(addr, 0)
+
+    def _rec_avail(self):
+        n = int(self._rec_made) - self._rec_read
+        if n > _REC_SIZE:
+            self.rec_lost += n - _REC_SIZE
+            self._rec_read += n - _REC_SIZE
+            n = _REC_SIZE
+        self.rec_max = max(self.rec_max, n)
+        return n
+
+
+# Create a simulated SPI bus and pins with a chip attached. Instantiate a
+# driver with VS1053(chip.spi, *chip.args, ...)
+def rig(**kwargs):
+    spi = SPI(1)
+    reset = Pin('reset', Pin.OUT, value=1)
+    dreq = Pin('dreq', Pin.IN)
+    xdcs = Pin('xdcs', Pin.OUT, value=1)
+    xcs = Pin('xcs', Pin.OUT, value=1)
+    return VS1053Chip(spi, reset, dreq, xdcs, xcs, **kwargs)
@@ -0,0 +1,167 @@
+# machine.py CPython shim providing simulated Pin and SPI classes.
+# Released under the MIT licence
+
+# Devices (see chip.py) attach themselves to an SPI instance and to the Pin
+# instances wired to them. Transfers are routed to whichever device has its
+# chip select asserted.
+
+import sys
+from simenv import clock, COSTS
+
+
+class Pin:
+    IN = 0
+    OUT = 1
+    OPEN_DRAIN = 2
+    PULL_UP = 1
+    PULL_DOWN = 2
+    IRQ_FALLING = 1
+    IRQ_RISING = 2
+
+    def __init__(self, id, mode=-1, pull=-1, *, value=None):
+        self.id = id
+        self._mode = self.IN
+        self._v = 0
+        self._handler = None
+        self._trigger = 0
+        self._watchers = []  # Called on output change
+        self._nexthigh = None  # Device callback: μs until input goes high
+        self._site = None  # Code location of latest read
+        self.init(mode, pull, value=value)
+
+    def __repr__(self):
+        return 'Pin({})'.format(self.id)
+
+    def init(self, mode=-1, pull=-1, *, value=None):
+        if mode != -1:
+            self._mode = mode
+        if pull == self.PULL_UP and self._mode == self.IN:
+            self._v = 1
+        if value is not None:
+            self._set(value)
+
+    def _set(self, v):
+        v = 1 if v else 0
+        if v != self._v:
+            self._v = v
+            for func in self._watchers:
+                func(v)
+
+    def __call__(self, x=None):
+        if x is None:
+            if self._mode == self.IN:
+                f = sys._getframe(1)
+                site = (f.f_code, f.f_lineno)
+                spin = clock.tag is self and site == self._site
+                self._site = site
+                clock.advance(COSTS['pin_read'], self)
+                # A device may predict when a busy-wait will end. If nothing
+                # else happened since the last read of this pin from the same
+                # line of code, skip ahead.
+                if spin and not self._v and self._nexthigh is not None:
+                    us = self._nexthigh()
+                    if us:
+                        n = -(-us // COSTS['pin_read'])
+                        clock.advance(n * COSTS['pin_read'], self)
+            return self._v
+        clock.advance(COSTS['pin_write'])
+        self._set(x)
+
+    value = __call__
+
+    def on(self):
+        self(1)
+
+    def off(self):
+        self(0)
+
+    def irq(self, handler=None, trigger=IRQ_FALLING | IRQ_RISING, hard=False):
+        self._handler = handler
+        self._trigger = trigger if handler is not None else 0
+
+    # Simulation interface: external drive of an input pin.
+    def _drive(self, v):
+        v = 1 if v else 0
+        if v != self._v:
+            self._v = v
+            if self._trigger & (self.IRQ_RISING if v else self.IRQ_FALLING):
+                self._handler(self)
+
+    def _watch(self, func):
+        self._watchers.append(func)
+
+
+class SPI:
+    MSB = 0
+    LSB = 1
+
+    def __init__(self, id=0, baudrate=1_000_000, *, polarity=0, phase=0, bits=8,
+                 firstbit=MSB, sck=None, mosi=None, miso=None):
+        self.id = id
+        self._devices = []
+        self.clear_stats()
+        self._config(baudrate, polarity, phase)
+
+    def __repr__(self):
+        return 'SPI({}, baudrate={}, polarity={}, phase={})'.format(
+            self.id, self.baudrate, self.polarity, self.phase)
+
+    def _config(self, baudrate, polarity, phase):
+        self.baudrate = baudrate
+        self.polarity = polarity
+        self.phase = phase
+
+    def clear_stats(self):
+        self.init_calls = 0
+        self.calls = 0  # Transfer method calls
+        self.nbytes = 0
+        self.busy_us = 0.0  # Time spent in transfers and inits
+        self.cs_errors = 0  # Transfers with more than one device selected
+
+    def stats(self):
+        return {'init_calls': self.init_calls, 'calls': self.calls,
+                'bytes': self.nbytes, 'busy_us': self.busy_us,
+                'cs_errors': self.cs_errors}
+
+    def init(self, baudrate=1_000_000, *, polarity=0, phase=0, bits=8,
+             firstbit=MSB, sck=None, mosi=None, miso=None):
+        self.init_calls += 1
+        self.busy_us += COSTS['spi_init']
+        clock.advance(COSTS['spi_init'])
+        self._config(baudrate, polarity, phase)
+
+    def deinit(self):
+        pass
+
+    def _attach(self, device):
+        self._devices.append(device)
+
+    def _xfer(self, wbuf, rbuf):
+        n = len(wbuf)
+        us = COSTS['spi_call'] + n * 8e6 / self.baudrate
+        self.calls += 1
+        self.nbytes += n
+        self.busy_us += us
+        clock.advance(us)
+        sel = [d for d in self._devices if d._selected()]
+        if len(sel) > 1:
+            self.cs_errors += 1
+        if sel:
+            sel[0]._transfer(self, wbuf, rbuf)
+        elif rbuf is not None:  # No device drives MISO
+            for i in range(n):
+                rbuf[i] = 0xff
+
+    def write(self, buf):
+        self._xfer(buf, None)
+
+    def read(self, nbytes, write=0):
+        buf = bytearray(nbytes)
+        self._xfer(bytes((write,)) * nbytes, buf)
+        return bytes(buf)
+
+    def readinto(self, buf, write=0):
+        self._xfer(bytes((write,)) * len(buf), buf)
+
+    def write_readinto(self, write_buf, read_buf):
+        self._xfer(bytes(write_buf), read_buf)
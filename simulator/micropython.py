@@ -0,0 +1,21 @@
+# micropython.py CPython shim for the micropython module.
+# Released under the MIT licence
+
+
+def const(x):
+    return x
+
+
+def native(f):
+    return f
+
+
+viper = native
+
+
+def alloc_emergency_exception_buf(size):
+    pass
+
+
+def schedule(func, arg):
+    func(arg)
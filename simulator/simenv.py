@@ -0,0 +1,321 @@
+# simenv.py Host-side simulation environment for the VS1053 drivers
+# (C) Peter Hinch 2020-2022
+# Released under the MIT licence
+
+# Enables the drivers in async/ and synchronous/ to be imported and run
+# unchanged under CPython. Time is virtual: it advances only when the code
+# under test performs an operation which would take time on real hardware
+# (SPI transfers, pin accesses, sleeps). Results are thus deterministic and
+# independent of the speed of the host.
+
+import builtins
+import os
+import sys
+import time
+
+_SIMDIR = os.path.dirname(os.path.abspath(__file__))
+_ROOT = os.path.dirname(_SIMDIR)
+
+# Costs of MicroPython operations in μs. Figures are representative of a
+# Pyboard 1.x or Pico and may be adjusted to model other platforms.
+COSTS = {
+    'pin_read': 1.0,  # Read an input pin (e.g. dreq())
+    'pin_write': 1.0,  # Set an output pin
+    'spi_call': 4.0,  # Fixed overhead of an SPI read/write method call
+    'spi_init': 15.0,  # spi.init() call
+    'sched': 20.0,  # One pass through the uasyncio scheduler
+    'idle': 100.0,  # Quantum by which time advances when all tasks wait
+}
+
+
+class Clock:
+    def __init__(self):
+        self.us = 0.0  # Virtual time
+        self.idle_us = 0.0  # Time when no task was ready to run
+        self.seq = 0  # Incremented on every advance
+        self.tag = None  # Source of latest advance
+        self._listeners = []
+        self._events = []
+
+    def listen(self, func):
+        self._listeners.append(func)
+
+    # Register a device callback returning μs until its next state change (or
+    # None). Idle periods end at that time.
+    def event(self, func):
+        self._events.append(func)
+
+    def advance(self, us, tag=None):
+        self.us += us
+        self.seq += 1
+        self.tag = tag
+        for func in self._listeners:
+            func(self.us)
+
+    def idle(self, us):
+        for func in self._events:
+            t = func()
+            if t is not None and t < us:
+                us = t
+        self.idle_us += us
+        self.advance(us)
+
+    def ticks_ms(self):
+        return int(self.us // 1000)
+
+    def ticks_us(self):
+        return int(self.us)
+
+
+clock = Clock()
+
+
+def _sleep_ms(ms):
+    clock.advance(ms * 1000)
+
+
+def _sleep_us(us):
+    clock.advance(us)
+
+
+def _ticks_diff(a, b):
+    return a - b
+
+
+def _ticks_add(a, b):
+    return a + b
+
+
+# Patch the time module and builtins to provide the MicroPython extensions
+# used by the drivers, and put the drivers on sys.path.
+def install():
+    import micropython
+    builtins.const = micropython.const
+    builtins.micropython = micropython
+    time.sleep_ms = _sleep_ms
+    time.sleep_us = _sleep_us
+    time.ticks_ms = clock.ticks_ms
+    time.ticks_us = clock.ticks_us
+    time.ticks_cpu = clock.ticks_us
+    time.ticks_diff = _ticks_diff
+    time.ticks_add = _ticks_add
+    for d in (_ROOT, os.path.join(_ROOT, 'synchronous'), os.path.join(_ROOT, 'async')):
+        if d not in sys.path:
+            sys.path.insert(0, d)
+    if _SIMDIR in sys.path:  # Shims must take precedence
+        sys.path.remove(_SIMDIR)
+    sys.path.insert(0, _SIMDIR)
+
+
+# Stream modelling a file on an SD card accessed via FatFs. Partial sector
+# reads and writes use a single sector window buffer, written back when another
+# sector is needed or on close. Runs of whole aligned sectors are transferred
+# directly with one multi-block call per cluster. Writes extending the file
+# allocate clusters, each costing a FAT update. A writable file may be extended
+# by seeking beyond its end: as with FatFs f_lseek this allocates clusters
+# in bulk, with one FAT update per 128 clusters, but writes no data.
+class SimFile:
+
+    def __init__(self, data=b'', *, call_us=50, block_us=500, sector_us=3100,
+                 write_us=4000, alloc_us=8000, cluster=4096, stall_every=0, stall_us=0,
+                 spi=None, spi_baud=25_000_000):
+        self._data = data
+        self._pos = 0
+        self._window = -1  # Sector currently in window buffer
+        self._dirty = False  # Window has unwritten data
+        self._clusters = -(-len(data) // cluster)  # Clusters allocated
+        self.writable = False
+        self.call_us = call_us  # VFS overhead per readinto or write call
+        self.block_us = block_us  # Command overhead per readblocks or writeblocks call
+        self.sector_us = sector_us  # Read time per sector
+        self.write_us = write_us  # Write time per sector including card busy time
+        self.alloc_us = alloc_us  # Cluster allocation
+        self.cluster = cluster
+        self.stall_every = stall_every  # Card stalls every N sectors
+        self.stall_us = stall_us
+        self.spi = spi  # Bus shared with the card: its clock is set on each access
+        self.spi_baud = spi_baud
+        self.clear_stats()
+
+    def clear_stats(self):
+        self.calls = 0  # readinto calls
+        self.block_calls = 0  # readblocks calls
+        self.sectors = 0  # Sectors transferred
+        self.nbytes = 0
+        self.wcalls = 0  # write calls
+        self.wblock_calls = 0  # writeblocks calls
+        self.wsectors = 0
+        self.wbytes = 0
+        self.allocs = 0  # Clusters allocated
+        self.max_us = 0  # Longest single call
+        self.wmax_us = 0  # Longest write call
+
+    def stats(self):
+        return {'calls': self.calls, 'block_calls': self.block_calls,
+                'sectors': self.sectors, 'bytes': self.nbytes,
+                'wcalls': self.wcalls, 'wblock_calls': self.wblock_calls,
+                'wsectors': self.wsectors, 'wbytes': self.wbytes,
+                'allocs': self.allocs, 'max_us': self.max_us, 'wmax_us': self.wmax_us}
+
+    def _stall(self, nsec):
+        if self.stall_every:
+            n = self.wsectors + self.sectors
+            return (n // self.stall_every - (n - nsec) // self.stall_every) * self.stall_us
+        return 0
+
+    def _writeblocks(self, nsec):
+        self.wblock_calls += 1
+        self.wsectors += nsec
+        return self.block_us + nsec * self.write_us + self._stall(nsec)
+
+    def _flush(self):  # Write back the window
+        us = 0
+        if self._dirty:
+            us = self._writeblocks(1)
+            self._dirty = False
+        return us
+
+    def _load(self, sec):  # Ensure sector is in window
+        us = 0
+        if sec != self._window:
+            us = self._flush()
+            if sec * 512 < len(self._data):  # Existing data must be read
+                us += self._readblocks(1)
+            self._window = sec
+        return us
+
+    def write(self, buf):
+        self.wcalls += 1
+        if self.spi is not None:
+            self.spi.init(baudrate=self.spi_baud)
+        n = len(buf)
+        us = self.call_us
+        pos = self._pos
+        end = pos + n
+        nclusters = -(-end // self.cluster)
+        if nclusters > self._clusters:
+            self.allocs += nclusters - self._clusters
+            us += (nclusters - self._clusters) * self.alloc_us
+            self._clusters = nclusters
+        while pos < end:
+            sec, offs = divmod(pos, 512)
+            if offs or end - pos < 512:  # Partial sector via window
+                us += self._load(sec)
+                self._dirty = True
+                pos = min(end, (sec + 1) * 512)
+            else:  # Whole sectors direct from caller's buffer
+                nsec = (end - pos) // 512
+                csec = self.cluster // 512
+                nsec = min(nsec, csec - sec % csec)
+                if sec <= self._window < sec + nsec:
+                    self._window = -1
+                    self._dirty = False
+                us += self._writeblocks(nsec)
+                pos += nsec * 512
+        if not isinstance(self._data, bytearray):
+            self._data = bytearray(self._data)
+        if end > len(self._data):
+            self._data.extend(bytes(end - len(self._data)))
+        self._data[self._pos : end] = buf
+        self._pos = end
+        self.wbytes += n
+        self.max_us = max(self.max_us, us)
+        self.wmax_us = max(self.wmax_us, us)
+        clock.advance(us)
+        return n
+
+    def truncate(self):  # Discard data beyond current position
+        del self._data[self._pos:]
+        self._clusters = -(-self._pos // self.cluster)
+
+    def getvalue(self):
+        return bytes(self._data)
+
+    def _readblocks(self, nsec):
+        self.block_calls += 1
+        self.sectors += nsec
+        return self.block_us + nsec * self.sector_us + self._stall(nsec)
+
+    def readinto(self, buf, nbytes=None):  # MicroPython stream signature
+        self.calls += 1
+        if self.spi is not None:
+            self.spi.init(baudrate=self.spi_baud)
+        n = len(buf) if nbytes is None else min(nbytes, len(buf))
+        n = min(n, len(self._data) - self._pos)
+        us = self.call_us
+        pos = self._pos
+        end = pos + n
+        while pos < end:
+            sec, offs = divmod(pos, 512)
+            if offs or end - pos < 512:  # Partial sector via window
+                us += self._load(sec)
+                pos = min(end, (sec + 1) * 512)
+            else:  # Whole sectors direct to caller's buffer
+                nsec = (end - pos) // 512
+                csec = self.cluster // 512
+                nsec = min(nsec, csec - sec % csec)
+                us += self._readblocks(nsec)
+                pos += nsec * 512
+        buf[:n] = self._data[self._pos : end]
+        self._pos = end
+        self.nbytes += n
+        self.max_us = max(self.max_us, us)
+        clock.advance(us)
+        return n
+
+    def read(self, n=-1):
+        if n < 0:
+            n = len(self._data) - self._pos
+        buf = bytearray(n)
+        n = self.readinto(buf)
+        return bytes(buf[:n])
+
+    def seek(self, offs, whence=0):
+        if whence == 1:
+            offs += self._pos
+        elif whence == 2:
+            offs += len(self._data)
+        if offs > len(self._data) and self.writable:  # Extend the file
+            nclusters = -(-offs // self.cluster)
+            us = self.call_us + -(-(nclusters - self._clusters) // 128) * self.alloc_us
+            self.allocs += nclusters - self._clusters
+            self._clusters = nclusters
+            if not isinstance(self._data, bytearray):
+                self._data = bytearray(self._data)
+            self._data.extend(bytes(offs - len(self._data)))
+            self.max_us = max(self.max_us, us)
+            clock.advance(us)
+        self._pos = max(0, min(offs, len(self._data)))
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def close(self):  # Write back the window and update the directory entry
+        if self.wcalls:
+            us = self._flush() + self._writeblocks(1)
+            self.max_us = max(self.max_us, us)
+            clock.advance(us)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Filesystem of SimFile instances keyed by name. Assign its open method to a
+# driver module's open to redirect file access, e.g. vs1053_syn.open = fs.open
+class SimFS:
+
+    def __init__(self, **kwargs):
+        self.files = {}
+        self._kwargs = kwargs  # SimFile args
+
+    def open(self, fn, mode='r'):
+        if 'w' in mode:
+            self.files[fn] = SimFile(bytearray(), **self._kwargs)
+        f = self.files[fn]  # KeyError if nonexistent
+        f.writable = 'w' in mode or '+' in mode
+        f.seek(0)
+        return f
@@ -0,0 +1,50 @@
+# uasyncio.py CPython shim for uasyncio running in simulated time.
+# Released under the MIT licence
+
+# Tasks run under CPython asyncio. A sleep_ms(0) costs one scheduler pass of
+# virtual time. Longer sleeps wait until the virtual clock reaches the target;
+# if a complete scheduler pass occurs with no task advancing the clock, the
+# system is idle and the clock is advanced by an idle quantum.
+
+from asyncio import *
+from asyncio import sleep as _sleep
+from simenv import clock, COSTS
+
+
+async def _idle_until(pred, left=lambda: COSTS['idle']):
+    seq = -1
+    while not pred():
+        if clock.seq == seq:  # Nothing happened in a whole pass
+            clock.idle(min(COSTS['idle'], left()))
+        seq = clock.seq
+        await _sleep(0)
+    clock.advance(COSTS['sched'])
+
+
+async def sleep_ms(ms):
+    if ms <= 0:
+        clock.advance(COSTS['sched'])
+        await _sleep(0)
+    else:
+        t = clock.us + ms * 1000
+        await _idle_until(lambda: clock.us >= t, lambda: t - clock.us)
+
+
+async def sleep(s):
+    await sleep_ms(s * 1000)
+
+
+# May be set from a Pin IRQ handler.
+class ThreadSafeFlag:
+    def __init__(self):
+        self._flag = False
+
+    def set(self):
+        self._flag = True
+
+    def clear(self):
+        self._flag = False
+
+    async def wait(self):
+        await _idle_until(lambda: self._flag)
+        self._flag = False
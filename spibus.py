@@ -0,0 +1,149 @@
+# spibus.py Share an SPI bus between devices with differing clock requirements
+# (C) Peter Hinch 2020-2022
+# Released under the MIT licence
+
+# An SPIBus owns an SPI instance. Each device on the bus is given a BusDevice
+# by SPIBus.device(). This has the SPI methods used by device drivers and is
+# passed to a driver in place of the SPI instance. A device's init() call
+# records its baudrate, polarity and phase without touching the hardware. The
+# bus is reconfigured only when a device makes a transfer with settings which
+# differ from those in force. Devices may thus use their own clock rates with
+# no knowledge of each other and no redundant spi.init() calls.
+
+# Usage:
+# bus = SPIBus(SPI(2))
+# sd = sdcard.SDCard(bus.device('sd'), Pin('Y5'))  # Runs at its negotiated rate
+# player = VS1053(bus, reset, dreq, xdcs, xcs)  # Creates its own device
+
+# A transfer is atomic with respect to uasyncio tasks, but a sequence of
+# transfers interrupted by an await is not. A task performing such a sequence
+# should hold the bus lock, as should any other task needing to exclude it:
+# async with dev:  # dev is a BusDevice
+#     ...
+
+# Usage statistics are maintained for each device: transfer calls, bytes,
+# the number of times it took the bus from another device and the spi.init()
+# calls this caused. Time on the bus is computed from bytes and baudrate.
+
+from time import ticks_ms, ticks_diff
+
+
+class BusDevice:
+
+    def __init__(self, bus, name, baudrate, polarity, phase):
+        self._bus = bus
+        self._spi = bus.spi
+        self.name = name
+        self._cfg = (baudrate, polarity, phase)
+        self.clear_stats()
+
+    def clear_stats(self):
+        self.calls = 0  # Transfer method calls
+        self.nbytes = 0
+        self.takes = 0  # Bus taken from another device
+        self.inits = 0  # spi.init() calls made on behalf of this device
+        self._us = 0  # Bus time of bytes transferred at previous baudrates
+        self._mark = 0  # nbytes at last baudrate change
+
+    def _fold(self):  # Accumulate bus time at the current baudrate
+        self._us += (self.nbytes - self._mark) * 8_000_000 // self._cfg[0]
+        self._mark = self.nbytes
+
+    def bus_us(self):  # Estimated μs spent transferring data
+        self._fold()
+        return self._us
+
+    # Signature compatible with machine.SPI. Other args are ignored.
+    def init(self, baudrate=1_000_000, *, polarity=0, phase=0, **_):
+        self._fold()
+        self._cfg = (baudrate, polarity, phase)
+
+    def read(self, nbytes, write=0x00):
+        if self._bus._cfg is not self._cfg:
+            self._bus._take(self)
+        self.calls += 1
+        self.nbytes += nbytes
+        return self._spi.read(nbytes, write)
+
+    def readinto(self, buf, write=0x00):
+        if self._bus._cfg is not self._cfg:
+            self._bus._take(self)
+        self.calls += 1
+        self.nbytes += len(buf)
+        self._spi.readinto(buf, write)
+
+    def write(self, buf):
+        if self._bus._cfg is not self._cfg:
+            self._bus._take(self)
+        self.calls += 1
+        self.nbytes += len(buf)
+        self._spi.write(buf)
+
+    def write_readinto(self, wbuf, rbuf):
+        if self._bus._cfg is not self._cfg:
+            self._bus._take(self)
+        self.calls += 1
+        self.nbytes += len(wbuf)
+        self._spi.write_readinto(wbuf, rbuf)
+
+    async def __aenter__(self):
+        await self._bus.lock().acquire()
+        return self
+
+    async def __aexit__(self, *_):
+        self._bus.lock().release()
+
+
+class SPIBus:
+
+    def __init__(self, spi):
+        self.spi = spi
+        self._devices = []
+        self._owner = None  # Device which made the latest transfer
+        self._cfg = None  # Settings in force: the owner's tuple
+        self._lock = None  # Created on first use: synchronous code needs no uasyncio
+        try:
+            self._master = (spi.MASTER,)  # Pyboard
+        except AttributeError:
+            self._master = ()
+        self.clear_stats()
+
+    def device(self, name, baudrate=1_000_000, polarity=0, phase=0):
+        dev = BusDevice(self, name, baudrate, polarity, phase)
+        self._devices.append(dev)
+        return dev
+
+    def lock(self):
+        if self._lock is None:
+            import uasyncio as asyncio
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    # Called when the settings in force are not the device's own: either the
+    # device has changed them or another device has used the bus.
+    def _take(self, dev):
+        cfg = dev._cfg
+        if self._cfg is None or cfg != self._cfg:
+            baudrate, polarity, phase = cfg
+            self.spi.init(*self._master, baudrate=baudrate, polarity=polarity, phase=phase)
+            dev.inits += 1
+        if dev is not self._owner:
+            dev.takes += 1
+            self._owner = dev
+        self._cfg = cfg
+
+    def clear_stats(self):
+        self._t0 = ticks_ms()
+        for dev in self._devices:
+            dev.clear_stats()
+
+    # Return a dict of per-device statistics keyed by device name. util is the
+    # percentage of elapsed time since the bus was created or cleared.
+    def stats(self):
+        ms = max(ticks_diff(ticks_ms(), self._t0), 1)
+        res = {}
+        for dev in self._devices:
+            us = dev.bus_us()
+            res[dev.name] = {'calls': dev.calls, 'bytes': dev.nbytes, 'takes': dev.takes,
+                             'inits': dev.inits, 'bus_us': us, 'util': us / (ms * 10)}
+        return res
@@ -12,10 +12,20 @@ import time
 import os
 from array import array
 
+# V0.1.12 play skips leading metadata (tags, album art) by seeking.
+# V0.1.11 Gapless play_list.
+# V0.1.10 Accept an SPIBus to share the SPI bus with the SD card at its own rate.
+# V0.1.9 Record to any stream or as a generator of blocks. wav_header is public.
+# V0.1.8 Ogg Vorbis recording using the VLSI encoder plugin.
+# V0.1.7 Recorded data is written in whole sectors and read in batches.
+#        Optional preallocation of recording files.
+# V0.1.6 Cache register values and batch SCI accesses to reduce SPI traffic.
+#        Fast plugin loading. Load plugins from a buffer.
+# V0.1.5 Optional buffered play.
 # V0.1.4 .play efficiency improvements, test with Pico
 # V0.1.3 Support recording
 # V0.1.2 Add patch facility
-__version__ = (0, 1, 4)
+__version__ = (0, 1, 12)
 
 # Before setting, the internal clock runs at 12.288MHz. Data P7: "the
 # maximum speed for SCI reads is CLKI/7" hence max initial baudrate is
@@ -23,7 +33,7 @@ __version__ = (0, 1, 4)
 _INITIAL_BAUDRATE = const(1_000_000)
 # 12.288*3.5/4 = 10.752MHz for data read (using _SCI_CLOCKF,0x8800)
 _DATA_BAUDRATE = const(10_752_000)  # Speed for data transfers. On Pyboard D
-# actual rate is 9MHz shared with SD card - sdcard.py uses 1.32MHz.
+# actual rate is 9MHz. sdcard.py negotiates its own rate: see spibus.py.
 _SCI_BAUDRATE = const(5_000_000)
 
 # SCI Registers
@@ -37,13 +47,16 @@ _SCI_WRAM = const(0x6)
 _SCI_WRAMADDR = const(0x7)
 _SCI_HDAT0 = const(0x8)
 _SCI_HDAT1 = const(0x9)
-# _SCI_AIADDR = const(0xa)
+_SCI_AIADDR = const(0xa)
 _SCI_VOL = const(0xb)
 _SCI_AICTRL0 = const(0xc)
 _SCI_AICTRL1 = const(0xd)
 _SCI_AICTRL2 = const(0xe)
 _SCI_AICTRL3 = const(0xf)
 
+# Registers whose values are cached: MODE BASS CLOCKF VOL AICTRL0-3
+_SHADOWED = const(0xf80d)
+
 # Mode register bits: Public
 SM_DIFF = const(0x01)  # Invert left channel (why?)
 SM_LAYER12 = const(0x02)  # Enable MPEG
@@ -72,6 +85,9 @@ _POS_MS_MS = const(0x1e28)
 _IO_DIRECTION = const(0xc017)  # Datasheet 11.10
 _IO_READ = const(0xc018)
 _IO_WRITE = const(0xc019)
+_INT_ENABLE = const(0xc01a)
+
+_PATCH_BUF = const(1024)  # Plugin loader read buffer
 
 # Recording patches. RAM-efficient storage.
 _PATCH = array('H', (0x3e12, 0xb817, 0x3e14, 0xf812, 0x3e01, 0xb811, 0x0007, 0x9717,
@@ -79,11 +95,230 @@ _PATCH = array('H', (0x3e12, 0xb817, 0x3e14, 0xf812, 0x3e01, 0xb811, 0x0007, 0x9
             0x3b81, 0x8024, 0x3101, 0x8024, 0x3b81, 0x8024, 0x3f04, 0xc024,
             0x2808, 0x4800, 0x36f1, 0x9811))
 _PATCH1 = array('H', (0x2a00, 0x040e))
+
+_REC_BUF = const(1024)  # Recording block buffer: a multiple of 512
+_BUF_SIZE = 2048  # Default buffer size
+_MAXREAD = const(2048)  # Maximum bytes per refill read: limits blocking time
+"""
+Buffered play reads the stream in whole 512 byte sectors while the VS1053 is
+unable to accept data, rather than reading 32 bytes for each SPI write. While
+the buffer holds less than the high watermark, one read is done on each pass
+while dreq is low. If it falls below the low watermark, reads are done
+regardless of dreq.
+"""
+
+_HDAT0_READ = b'\x03\x08\xff\xff'  # SCI read of SCI_HDAT0
+
 # Header for 
 _HEADER = (b'RIFF\x00\x00\x00\x00WAVEfmt '
             b'\x14\x00\x00\x00\x11\x00\x02\x00\x40\x1f\x00\x00\xae\x1f\x00\x00'
             b'\x00\x02\x04\x00\x02\x00\xf9\x01fact\x04\x00\x00\x00'
             b'\x00\x00\x00\x00data\x00\x00\x00\x00')  # Template.
+_MAXHEAD = const(64)  # Longest FLAC or RIFF header block retained when skipping metadata
+
+# An SCI session sets the SPI baudrate for register access once for a sequence
+# of reads and writes, restoring the data rate on exit. Sessions may be nested.
+class _Session:
+
+    def __init__(self, dev):
+        self._dev = dev
+        self._depth = 0
+
+    def __enter__(self):
+        if not self._depth:
+            d = self._dev
+            d._spi.init(baudrate = _INITIAL_BAUDRATE if d._slow_spi else _SCI_BAUDRATE)
+        self._depth += 1
+        return self
+
+    def __exit__(self, *_):
+        self._depth -= 1
+        if not self._depth:
+            self._dev._spi.init(baudrate=_DATA_BAUDRATE)
+
+
+# Complete a wav header template for nsamples 16 bit words recorded at sf.
+# Data 10.8.4. Stereo block is 256 words, mono 128.
+def _wav_header(buf, nsamples, sf, stereo):
+    chans = 2 if stereo else 1
+    nblocks = nsamples // (128 * chans)
+    buf[4:8] = int.to_bytes(nblocks * 256 * chans + 52, 4, 'little')  # ChunkSize
+    buf[22] = chans  # NumChannels
+    buf[24:28] = int.to_bytes(sf, 4, 'little')  # SampleRate
+    buf[28:32] = int.to_bytes(round(sf * 256 * chans / 505), 4, 'little')  # ByteRate
+    buf[33] = chans  # BlockAlign is 256 * chans
+    buf[48:52] = int.to_bytes(nblocks * 505, 4, 'little')  # NumOfSamples
+    buf[56:60] = int.to_bytes(nblocks * 256 * chans, 4, 'little')  # SubChunk3Size
+
+
+# Return the wav header for nsamples 16 bit words of IMA ADPCM data recorded at
+# sf. May be used with record_blocks or record_stream to create a wav file.
+def wav_header(nsamples=0, sf=8000, stereo=True):
+    buf = bytearray(_HEADER)
+    _wav_header(buf, nsamples, sf, stereo)
+    return buf
+
+# Identify the format of a track from its first bytes, leaving the stream
+# position unchanged. MP3 and AAC ADTS streams are sequences of self contained
+# frames which may be concatenated.
+def _format(s, buf=bytearray(4)):
+    n = s.readinto(buf)
+    s.seek(-n, 1)
+    if n < 4:
+        return None
+    if buf[0] == 0x49 and buf[1] == 0x44 and buf[2] == 0x33:  # ID3 tag
+        return 'mp3'
+    if buf[0] == 0xff and buf[1] & 0xe0 == 0xe0:  # Frame sync
+        return 'mp3' if buf[1] & 6 else 'aac'  # Layer bits are 0 for AAC
+    return bytes(buf)  # e.g. b'RIFF', b'fLaC', b'OggS'
+
+_GAPLESS = ('mp3', 'aac')
+
+# Metadata preceding the audio in a seekable stream is skipped by seeking
+# rather than being sent to the chip: ID3v2 and APEv2 tags, FLAC metadata
+# blocks other than STREAMINFO (e.g. PICTURE) and RIFF chunks other than fmt
+# and fact (e.g. LIST). Embedded album art can otherwise take seconds to send.
+# The stream is left at the start of the audio. Return the header which must
+# be sent before it: b'' unless a FLAC or RIFF header has been rebuilt. A
+# stream which is not seekable, or whose metadata is not understood, is
+# unchanged.
+def _skip(s, buf=bytearray(32)):
+    if not hasattr(s, 'seek'):  # e.g. a socket or a _Playlist
+        return b''
+    try:
+        start = s.tell()
+    except (AttributeError, OSError):
+        return b''
+    try:
+        pos, head = _scan(s, start, buf)
+    except ValueError:  # Truncated or malformed
+        pos, head = start, b''
+    if pos - start <= len(head):  # Nothing skipped: play the stream as it is
+        pos, head = start, b''
+    s.seek(pos)
+    return head
+
+# Return the position of the audio and the header to precede it.
+def _scan(s, pos, buf):
+    while True:  # Leading tags
+        s.seek(pos)
+        n = s.readinto(buf)
+        if n >= 10 and buf[0:3] == b'ID3' and not (buf[6] | buf[7] | buf[8] | buf[9]) & 0x80:
+            pos += 10 + (buf[6] << 21 | buf[7] << 14 | buf[8] << 7 | buf[9])  # Syncsafe size
+            if buf[5] & 0x10:  # Footer present
+                pos += 10
+        elif n == 32 and buf[0:8] == b'APETAGEX' and buf[23] & 0x20:  # APEv2 header
+            pos += 32 + int.from_bytes(buf[12:16], 'little')
+        else:
+            break
+    if n < 4:
+        raise ValueError
+    if buf[0:4] == b'fLaC':  # Retain STREAMINFO, flagged as the last block
+        pos += 4
+        head = b''
+        last = 0
+        while not last:
+            s.seek(pos)
+            if s.readinto(buf, 4) < 4:
+                raise ValueError
+            last = buf[0] & 0x80
+            size = buf[1] << 16 | buf[2] << 8 | buf[3]
+            if not buf[0] & 0x7f:  # STREAMINFO
+                if size > _MAXHEAD:
+                    raise ValueError
+                head = b'fLaC\x80' + bytes(buf[1:4]) + s.read(size)
+            pos += 4 + size
+        if not head:
+            raise ValueError
+        return pos, head
+    if n >= 12 and buf[0:4] == b'RIFF' and buf[8:12] == b'WAVE':
+        pos += 12
+        head = b''
+        while True:
+            s.seek(pos)
+            if s.readinto(buf, 8) < 8:
+                raise ValueError
+            cid = bytes(buf[0:4])
+            size = int.from_bytes(buf[4:8], 'little')
+            if cid == b'data':
+                break
+            if cid == b'fmt ' or cid == b'fact':
+                if size > _MAXHEAD:
+                    raise ValueError
+                head += bytes(buf[0:8]) + s.read(size + (size & 1))  # Chunks are word aligned
+            pos += 8 + size + (size & 1)
+        if not head.startswith(b'fmt '):
+            raise ValueError
+        head += bytes(buf[0:8])  # data chunk header
+        riff = min(4 + len(head) + size, 0xffffffff)
+        return pos + 8, b'RIFF' + riff.to_bytes(4, 'little') + b'WAVE' + head
+    return pos, b''
+
+# Presents a playlist to the player as a series of segments, each read as a
+# single stream. Consecutive tracks of the same framed format form one
+# segment: when a track reaches EOF the next is opened and read into the
+# remainder of the same buffer, so play is gapless. A track of another format
+# starts a new segment, requiring the end of stream procedure. Items are file
+# names or seekable streams. Files opened here are closed here. Leading
+# metadata is skipped: the player sends .head before each segment.
+class _Playlist:
+
+    def __init__(self, items):
+        self._it = iter(items)
+        self._s = None  # Current stream. None at end of segment.
+        self._fmt = None
+        self._opened = False  # Current stream was opened from a file name
+        self.head = b''  # Header preceding the segment's data (see _skip)
+        self._pend = self._open()  # First track of next segment
+
+    def _open(self):  # Return (stream, format, opened, head) for next track
+        for item in self._it:
+            opened = isinstance(item, str)
+            s = open(item, 'rb') if opened else item
+            head = _skip(s)
+            return s, bytes(head[:4]) if head else _format(s), opened, head
+        return None, None, False, b''
+
+    def _close(self):
+        if self._opened:
+            self._s.close()
+        self._s = None
+
+    def segment(self):  # Start next segment. Return False at end of list.
+        if self._s is None:
+            self._s, self._fmt, self._opened, self.head = self._pend
+            self._pend = None, None, False, b''
+        return self._s is not None
+
+    def ended(self):  # Segment has been read to its end
+        return self._s is None
+
+    def tell(self):
+        return self._s.tell()
+
+    def readinto(self, buf, nbytes=None):
+        s = self._s
+        if s is None:
+            return 0
+        n = len(buf) if nbytes is None else min(nbytes, len(buf))
+        got = s.readinto(buf, n)
+        while got < n:  # End of track
+            self._close()
+            nxt = self._open()
+            if nxt[1] not in _GAPLESS or nxt[1] != self._fmt:  # End of segment
+                self._pend = nxt
+                break
+            s, _, self._opened, _ = nxt
+            self._s = s
+            got += s.readinto(memoryview(buf)[got:n])
+        return got
+
+    def close(self):  # Close any files opened here
+        if self._s is not None:
+            self._close()
+        s, _, opened, _ = self._pend
+        if opened:
+            s.close()
 
 # xcs is chip XSS/
 # xdcs is chipXDCS/BSYNC/
@@ -91,25 +326,54 @@ _HEADER = (b'RIFF\x00\x00\x00\x00WAVEfmt '
 class VS1053:
 
 
-    def __init__(self, spi, reset, dreq, xdcs, xcs, sdcs=None, mp=None, cancb=lambda : False):
+    def __init__(self, spi, reset, dreq, xdcs, xcs, sdcs=None, mp=None, cancb=lambda : False,
+                 buffered=False, watermarks=None):
         self._reset = reset
         self._dreq = dreq  # Data request
         self._xdcs = xdcs  # Data CS
         self._xcs = xcs  # Register CS
         self._mp = mp
+        bus = None
+        if hasattr(spi, 'device'):  # SPIBus: the chip and SD card each have a device
+            bus, spi = spi, spi.device('vs1053', _DATA_BAUDRATE)
         self._spi = spi
         self._cbuf = bytearray(4)  # Command buffer
+        self._wbuf = bytearray(2)  # Data word for SCI multiple write
+        self._hbuf = bytearray(4)  # Response to _HDAT0_READ
+        self._shadow = [None] * 16  # Cached register values
+        self._session = _Session(self)  # Usage: with self._session:
         self._cancb = cancb  # Cancellation callback
         self._slow_spi = True  # Start on low baudrate
         self._overrun = 0  # Recording
+        self._nsamples = 0
+        self._rbuf = None  # Recording block buffer
+        self._ridx = 0
         self.reset()
         if ((sdcs is not None) and (mp is not None)):
             import sdcard
             import os
-            sd = sdcard.SDCard(spi, sdcs)
+            sd = sdcard.SDCard(spi if bus is None else bus.device('sd'), sdcs)
             vfs = os.VfsFat(sd)
             os.mount(vfs, mp)
         self._spi.init(baudrate=_DATA_BAUDRATE)
+        self._play = self._uplay
+        if buffered:
+            size = _BUF_SIZE if buffered is True else buffered
+            if size < _BUF_SIZE or size & (size - 1):
+                raise ValueError('Buffer size must be a power of 2 >= 2048')
+            low, high = (size // 4, size) if watermarks is None else watermarks
+            # Reads are whole sectors: below low a sector of free space is needed
+            if not 32 <= low <= min(high, size - 512) or high > size:
+                raise ValueError('Watermarks must satisfy 32 <= low <= high <= buffer size '
+                                 'and low <= buffer size - 512')
+            self._low = low
+            self._high = high
+            self._buf = bytearray(size)
+            mvb = memoryview(self._buf)
+            # Precomputed views ensure that the play loop does not allocate.
+            self._chunks = tuple(mvb[n : n + 32] for n in range(0, size, 32))
+            self._blocks = tuple(mvb[n:] for n in range(0, size, 512))  # Refill
+            self._play = self._bplay
 
     def _wait_ready(self):
         self._xdcs(1)
@@ -119,38 +383,54 @@ class VS1053:
 
     def _write_reg(self, addr, value):  # Datasheet 7.4
         self._wait_ready()
-        self._spi.init(baudrate = _INITIAL_BAUDRATE if self._slow_spi else _SCI_BAUDRATE)
         b = self._cbuf
         b[0] = 2  # WRITE
         b[1] = addr & 0xff
         b[2] = (value >> 8) & 0xff
         b[3] = value & 0xff
-        self._xcs(0)
-        self._spi.write(b)
-        self._xcs(1)
-        self._spi.init(baudrate=_DATA_BAUDRATE)
+        with self._session:
+            self._xcs(0)
+            self._spi.write(b)
+            self._xcs(1)
+        if (1 << addr) & _SHADOWED:
+            if addr == _SCI_MODE and value & _SM_RESET:
+                self._invalidate()  # Chip may revert to defaults
+            self._shadow[addr] = value & ~(_SM_RESET | _SM_CANCEL)  # Bits clear themselves
 
     def _read_reg(self, addr):  # Datasheet 7.4
         self._wait_ready()
-        self._spi.init(baudrate = _INITIAL_BAUDRATE if self._slow_spi else _SCI_BAUDRATE)
         b = self._cbuf
         b[0] = 3  # READ
         b[1] = addr & 0xff
         b[2] = 0xff
         b[3] = 0xff
-        self._xcs(0)
-        self._spi.write_readinto(b, b)
-        self._xcs(1)
-        self._spi.init(baudrate=_DATA_BAUDRATE)
-        return (b[2] << 8) | b[3]
+        with self._session:
+            self._xcs(0)
+            self._spi.write_readinto(b, b)
+            self._xcs(1)
+        v = (b[2] << 8) | b[3]
+        if (1 << addr) & _SHADOWED:
+            self._shadow[addr] = v & ~(_SM_RESET | _SM_CANCEL) if addr == _SCI_MODE else v
+        return v
+
+    # Registers written only by the driver are read from the cache. The bus is
+    # accessed only on the first read after a reset.
+    def _reg(self, addr):
+        v = self._shadow[addr]
+        return self._read_reg(addr) if v is None else v
+
+    def _invalidate(self):
+        self._shadow = [None] * 16
 
     def _read_ram(self, addr):
-        self._write_reg(_SCI_WRAMADDR, addr)
-        return self._read_reg(_SCI_WRAM)
+        with self._session:
+            self._write_reg(_SCI_WRAMADDR, addr)
+            return self._read_reg(_SCI_WRAM)
 
     def _write_ram(self, addr, data):
-        self._write_reg(_SCI_WRAMADDR, addr)
-        return self._write_reg(_SCI_WRAM, data)
+        with self._session:
+            self._write_reg(_SCI_WRAMADDR, addr)
+            self._write_reg(_SCI_WRAM, data)
 
     # Datasheet section 10.5.1: procedure for normal end of play
     def _end_play(self, buf):
@@ -162,7 +442,7 @@ class VS1053:
         self.mode_set(_SM_CANCEL)
         for n in range(64):  # send up to 2048 bytes
             self.write(buf)
-            if not self.mode() & _SM_CANCEL:
+            if not self._read_reg(_SCI_MODE) & _SM_CANCEL:
                 break
         else:  # Cancel has not been acknowledged
             self.soft_reset()
@@ -178,52 +458,146 @@ class VS1053:
         self._xdcs(1)
         return len(buf)
 
+    # A plugin image is a sequence of records, each comprising little-endian
+    # words: register address, count, data. If count bit 15 is set the record
+    # is an RLE run: one data word is written count & 0x7fff times. Otherwise
+    # it is a copy run of count data words. The stream is read in large blocks
+    # and decoded in place. Long copy runs are written in pieces: this works
+    # because SCI_WRAM auto-increments.
     def _patch_stream(self, s):
-        def read_word(s, buf=bytearray(2)):
-            if s.readinto(buf) != 2:
-                raise RuntimeError('Invalid file')
-            return (buf[1] << 8) + buf[0]
-
+        buf = bytearray(_PATCH_BUF)
+        self._load(buf, s.readinto(buf), s)
+
+    # Load an image of n bytes in buf. If s is None buf holds the whole image,
+    # otherwise it is refilled from stream s.
+    def _load(self, buf, n, s):
+        mv = memoryview(buf)
+        i = 0  # Index of next record or data word
+        count = 0  # Words remaining in current copy run
         while True:
-            try:
-                addr = read_word(s)
-            except RuntimeError:  # Normal EOF
+            # Refill outside the SCI session as s may share the SPI bus
+            if n - i < 6 and s is not None:  # May not hold a complete RLE record
+                mv[: n - i] = mv[i : n]  # Move remainder to start
+                n -= i
+                i = 0
+                r = s.readinto(mv[n:])
+                n += r
+                if not r:  # EOF: buf holds the rest of the image
+                    s = None
+            with self._session:
+                while s is None or n - i >= 6:
+                    if count:  # Continue a copy run
+                        k = min(count, (n - i) >> 1)
+                        if not k:
+                            raise RuntimeError('Invalid file')
+                        self._write_words(addr, buf, i, k, 2)
+                        i += k << 1
+                        count -= k
+                        continue
+                    if i == n:  # Normal EOF
+                        break
+                    if n - i < 4:
+                        raise RuntimeError('Invalid file')
+                    addr = buf[i] | (buf[i + 1] << 8)
+                    count = buf[i + 2] | (buf[i + 3] << 8)
+                    i += 4
+                    if count & 0x8000:  # RLE run, replicate n samples
+                        if n - i < 2:
+                            raise RuntimeError('Invalid file')
+                        self._write_words(addr, buf, i, count & 0x7fff, 0)
+                        i += 2
+                        count = 0
+            if s is None:
                 break
-            count = read_word(s)
-            if (count & 0x8000):  # RLE run, replicate n samples
-                count &= 0x7fff
-                val = read_word(s)
-                for _ in range(count):
-                    self._write_reg(addr, val)
-            else:  # Copy run, copy n samples
-                for _ in range(count):
-                    val = read_word(s)
-                    self._write_reg(addr, val)
+        self._invalidate()  # A plugin may alter any register
+
+    # SCI multiple write (datasheet 7.4.4) of nwords little-endian words from
+    # buf[idx:] to one register. step is 2 for successive words or 0 to
+    # repeat one word. XCS stays low and DREQ is polled between words. Must be
+    # called in an SCI session.
+    def _write_words(self, addr, buf, idx, nwords, step):
+        if not nwords:
+            return
+        dreq = self._dreq
+        spi = self._spi
+        b = self._cbuf
+        w = self._wbuf
+        self._wait_ready()
+        b[0] = 2  # WRITE
+        b[1] = addr & 0xff
+        b[2] = buf[idx + 1]  # Data 7.4: MSB first
+        b[3] = buf[idx]
+        self._xcs(0)
+        spi.write(b)
+        for _ in range(nwords - 1):
+            idx += step
+            w[0] = buf[idx + 1]
+            w[1] = buf[idx]
+            while not dreq():
+                pass
+            spi.write(w)
+        self._xcs(1)
 
 # Support for recording
 
-    # Optimised for speed
+    # Drain nwords recorded words into buf[idx:], returning the new index.
+    # Data 10.8.4 MSB first. Each SCI read must be terminated by XCS going
+    # high, so the per word overhead is minimised by hoisting all lookups out
+    # of the loop and using a precomputed command and response buffer pair.
+    # Must be called in an SCI session.
     @micropython.native
-    def _save(self, s, rbuf=bytearray(4), hdat0=b'\x03\x08\xff\xff'):
-        n = self._read_reg(_SCI_HDAT1)
-        self._spi.init(baudrate = _SCI_BAUDRATE)
-        mvr = memoryview(rbuf)
-        for _ in range(n):
-            self._xcs(0)
-            self._spi.write_readinto(hdat0, rbuf)
-            self._xcs(1)
-            s.write(mvr[2:])  # Data 10.8.4 MSB first
-        self._overrun = max(self._overrun, n)
-        return n  # Samples written
+    def _drain(self, buf, idx, nwords):
+        xcs = self._xcs
+        rw = self._spi.write_readinto
+        cmd = _HDAT0_READ
+        rbuf = self._hbuf
+        for _ in range(nwords):
+            xcs(0)
+            rw(cmd, rbuf)
+            xcs(1)
+            buf[idx] = rbuf[2]
+            buf[idx + 1] = rbuf[3]
+            idx += 2
+        return idx
+
+    # Generator: recorded words are stored in the block buffer which is yielded
+    # when full. A full buffer is yielded only when more data arrives, so the
+    # last word remains in the buffer. Runs until stop() returns True, then
+    # drains the words available. An SCI session is held only while reading
+    # the chip, never across a yield: a consumer may abandon the generator,
+    # which MicroPython does not close.
+    def _rec_blocks(self, stop):
+        buf = self._rbuf
+        idx = self._ridx
+        while True:
+            fin = stop()
+            with self._session:
+                n = self._read_reg(_SCI_HDAT1)
+            k = n
+            while k:
+                if idx == _REC_BUF:
+                    self._ridx = idx
+                    yield buf
+                    idx = 0
+                m = min(k, (_REC_BUF - idx) >> 1)
+                with self._session:
+                    idx = self._drain(buf, idx, m)
+                k -= m
+            self._nsamples += n
+            self._overrun = max(self._overrun, n)
+            if fin:
+                break
+        self._ridx = idx
 
     # Patch for recording. Data 10.8.1
     def _write_patch(self):
-        self._write_reg(_SCI_WRAMADDR, 0x8010)
-        for x in _PATCH:
-            self._write_reg(_SCI_WRAM, x)
-        self._write_reg(_SCI_WRAMADDR, 0x8028)
-        for x in _PATCH1:
-            self._write_reg(_SCI_WRAM, x)
+        with self._session:
+            self._write_reg(_SCI_WRAMADDR, 0x8010)
+            for x in _PATCH:
+                self._write_reg(_SCI_WRAM, x)
+            self._write_reg(_SCI_WRAMADDR, 0x8028)
+            for x in _PATCH1:
+                self._write_reg(_SCI_WRAM, x)
 
 # *** PLAYBACK API ***
 
@@ -231,6 +605,7 @@ class VS1053:
         self._xcs(1)
         self._xdcs(1)
         self._reset(0)
+        self._invalidate()
         time.sleep_ms(20)
         self._reset(1)
         time.sleep_ms(20)
@@ -238,21 +613,22 @@ class VS1053:
 
     def soft_reset(self):
         self._slow_spi = True  # Use _INITIAL_BAUDRATE
-        self.mode_set(_SM_RESET)
-        # This has many interesting settings data P39
-        time.sleep_ms(20)  # Adafruit have a total of 200ms
-        while not self._dreq():
-            pass
-        # Data P42. P7 footnote 4 recommends xtal * 3.5 + 1: using that.
-        self._write_reg(_SCI_CLOCKF, 0x8800)
-        if self._read_reg(_SCI_CLOCKF) != 0x8800:
-            raise OSError('No VS1053 device found.')
-        time.sleep_ms(1)  # Clock setting can take 100us
-        # Datasheet suggests writing to SPI_BASS. 
-        self._write_reg(_SCI_BASS, 0)  # 0 is flat response
-        self.volume(0, 0)
-        while not self._dreq():
-            pass
+        with self._session:
+            self.mode_set(_SM_RESET)
+            # This has many interesting settings data P39
+            time.sleep_ms(20)  # Adafruit have a total of 200ms
+            while not self._dreq():
+                pass
+            # Data P42. P7 footnote 4 recommends xtal * 3.5 + 1: using that.
+            self._write_reg(_SCI_CLOCKF, 0x8800)
+            if self._read_reg(_SCI_CLOCKF) != 0x8800:
+                raise OSError('No VS1053 device found.')
+            time.sleep_ms(1)  # Clock setting can take 100us
+            # Datasheet suggests writing to SPI_BASS. 
+            self._write_reg(_SCI_BASS, 0)  # 0 is flat response
+            self.volume(0, 0)
+            while not self._dreq():
+                pass
         self._slow_spi = False
 
     # Range is 0 to -63.5 dB
@@ -285,9 +661,10 @@ class VS1053:
         self._write_ram(_IO_DIRECTION, bits & 0xff)
 
     def pins(self, data=None):
-        if data is not None:
-            self._write_ram(_IO_WRITE, data & 0xff)
-        return self._read_ram(_IO_READ) & 0x3ff
+        with self._session:
+            if data is not None:
+                self._write_ram(_IO_WRITE, data & 0xff)
+            return self._read_ram(_IO_READ) & 0x3ff
 
     def version(self):
         return (self._read_reg(_SCI_STATUS) >> 4) & 0x0F
@@ -298,16 +675,18 @@ class VS1053:
     def byte_rate(self):  # Data rate in bytes/sec
         return self._read_ram(_BYTE_RATE)
 
+    # Reads the chip so that transient bits such as SM_CANCEL are reported.
+    # Read-modify-write of the mode register uses the cached value.
     def mode(self):
         return self._read_reg(_SCI_MODE)
 
     def mode_set(self, bits):
-        bits |= self.mode() | _SM_SDINEW
+        bits |= self._reg(_SCI_MODE) | _SM_SDINEW
         self._write_reg(_SCI_MODE, bits)
 
     def mode_clear(self, bits):
         bits ^= 0xffff
-        bits &= self.mode()
+        bits &= self._reg(_SCI_MODE)
         self._write_reg(_SCI_MODE, _SM_SDINEW | bits)  # Ensure new bit always set
 
     def enable_i2s(self, rate=48, mclock=False):
@@ -316,18 +695,28 @@ class VS1053:
             v |= 1
         elif rate == 192:
             v |= 2
-        self._write_ram(0xC017, 0xF0)
-        self._write_ram(0xC040, v)
+        with self._session:
+            self._write_ram(0xC017, 0xF0)
+            self._write_ram(0xC040, v)
 
 # Doesn't return anything useful for MP3
 #    def pos_ms(self):  # Position into stream in ms
 #        return self._read_ram(_POS_MS_LS) | (self._read_ram(_POS_MS_MS) << 16)
 
 
+    # Play a stream. Leading metadata in a seekable stream is skipped.
+    def play(self, s):
+        self._head(_skip(s))
+        self._play(s)
+
+    def _head(self, head):  # Send a header rebuilt by _skip
+        for n in range(0, len(head), 32):
+            self.write(head[n : n + 32])
+
     # Should check for short reads at EOF. Loop is time critical so I skip
     # this check. Sending a few bytes of old data has no obvious consequence.
     @micropython.native
-    def play(self, s, buf = bytearray(32)):
+    def _uplay(self, s, buf = bytearray(32)):
         cancb = self._cancb
         cancnt = 0
         cnt = 0
@@ -350,7 +739,7 @@ class VS1053:
             if cancnt:
                 if cancnt == 1:  # Just cancelled
                     self.mode_set(_SM_CANCEL)
-                if not self.mode() & _SM_CANCEL:  # Cancel done
+                if not self._read_reg(_SCI_MODE) & _SM_CANCEL:  # Cancel done
                     efb = self._read_ram(_END_FILL_BYTE) & 0xff
                     for n in range(len(buf)):
                         buf[n] = efb
@@ -367,6 +756,98 @@ class VS1053:
         else:
             self._end_play(buf)
 
+    # Play a sequence of tracks. items is an iterable of file names or seekable
+    # streams: a list may be extended while it plays. Consecutive tracks of the
+    # same framed format (MP3, AAC ADTS) are played without a gap: the next is
+    # opened and read as the current one reaches EOF. Otherwise the end of
+    # stream procedure is run between tracks. Cancellation ends the list.
+    def play_list(self, items):
+        pl = _Playlist(items)
+        try:
+            while pl.segment():
+                self._head(pl.head)
+                self.play(pl)
+                if not pl.ended():  # Cancelled
+                    break
+        finally:
+            pl.close()
+
+    # Data is read from the stream with readinto(buf, nbytes) using precomputed
+    # views. Buffer size is a multiple of 512. If the stream supports tell() the
+    # first read is placed so that buffer and file offsets are equal modulo 512,
+    # hence refills are in whole sectors at sector aligned file offsets even
+    # if play starts mid-sector (e.g. after skipping a header). A short read
+    # implies EOF.
+    def _bplay(self, s):
+        cancb = self._cancb
+        cancnt = 0
+        dreq = self._dreq
+        chunks = self._chunks  # 32 byte views for SPI writes
+        blocks = self._blocks  # Views from each sector to end of buffer
+        low = self._low
+        high = self._high
+        size = len(self._buf)
+        mask = size - 1
+        cnt = 0
+        rptr = 0  # Buffer read pointer
+        try:
+            rptr = s.tell() & 511
+        except (AttributeError, OSError):  # e.g. a socket
+            pass
+        bsize = s.readinto(blocks[0][rptr:]) if rptr else s.readinto(self._buf)  # No. of bytes in buffer
+        wptr = (rptr + bsize) & mask  # write pointer (normally 0)
+        eof = bsize < size - rptr
+        if rptr & 31 and bsize > 0:  # Send the part chunk preceding a 32 byte boundary
+            n = min(32 - (rptr & 31), bsize)
+            while not dreq():
+                pass
+            self._xdcs(0)
+            self._spi.write(chunks[rptr >> 5][rptr & 31 : (rptr & 31) + n])
+            self._xdcs(1)
+            rptr += n
+            bsize -= n
+        while bsize > 0:
+            cnt += 1
+            # Refill while waiting on dreq. Call the cancel callback during waiting
+            # periods or after 960 bytes if dreq never goes False.
+            while (not dreq()) or cnt > 30 or (bsize < low and not eof):  # 960 byte backstop
+                cnt = 0
+                # Whole sectors of contiguous free space, up to _MAXREAD
+                n = min(size - bsize, size - wptr, _MAXREAD) & ~511
+                if n and bsize < high and not eof:
+                    r = s.readinto(blocks[wptr >> 9], n)
+                    bsize += r
+                    wptr = (wptr + r) & mask
+                    eof = r < n
+                if cancnt == 0 and cancb():  # Not cancelling. Check callback when waiting on dreq.
+                    cancnt = 1  # Send at least one more buffer
+            self._xdcs(0)  # Fast write
+            self._spi.write(chunks[rptr >> 5])
+            self._xdcs(1)
+            rptr = (rptr + 32) & mask  # Bump read pointer modulo buffer size
+            bsize -= 32
+            # cancnt > 0: Cancelling
+            if cancnt:
+                if cancnt == 1:  # Just cancelled
+                    self.mode_set(_SM_CANCEL)
+                if not self._read_reg(_SCI_MODE) & _SM_CANCEL:  # Cancel done
+                    buf = chunks[0]
+                    efb = self._read_ram(_END_FILL_BYTE) & 0xff
+                    for n in range(32):
+                        buf[n] = efb
+                    for n in range(64):  # send 2048 bytes of end fill byte
+                        self.write(buf)
+                    self.write(buf[:4])  # Take to 2052 bytes
+                    if self._read_reg(_SCI_HDAT0) or self._read_reg(_SCI_HDAT1):
+                        raise RuntimeError('Invalid HDAT value.')
+                    break
+                if cancnt > 64:  # Cancel has failed
+                    self.soft_reset()
+                    break
+                cancnt += 1  # keep feeding data from stream
+        else:
+            self._end_play(chunks[0])
+
     # Produce a 517Hz sine wave
     def sine_test(self, seconds=10):
         self.soft_reset()
@@ -377,6 +858,12 @@ class VS1053:
         self.write(b'\x45\x78\x69\x74\0\0\0\0')
         self.mode_clear(_SM_TESTS)
 
+    # Apply a plugin image held in a buffer, typically a bytes object in a
+    # module frozen into firmware: see tools/plugin2py.py. The image is read
+    # in place so no RAM is used for a copy.
+    def patch_from_buffer(self, buf):
+        self._load(buf, len(buf), None)
+
     # Given a directory apply any patch files found. Applied in alphabetical
     # order.
     def patch(self, loc=None):
@@ -402,11 +889,60 @@ class VS1053:
     def from_db(self, db):
         return 0 if db is None else max(min(round(1024*(10**(db/20))), 65535), 1)
 
-    def record(self, fn, line, stop=10_000, sf=8000, agc_gain=None, gain=None, stereo=True):
-        self._overrun = 0
+    # Record to a file. This is a wav file whose header is written after the
+    # data so that it can specify the length.
+    def record(self, fn, line, stop=10_000, sf=8000, agc_gain=None, gain=None, stereo=True,
+               prealloc=False):
+        if prealloc and callable(stop):
+            raise ValueError('Preallocation requires a duration')
+        chans = 2 if stereo else 1
         with open(fn, 'wb') as f:
-            file_size = f.write(_HEADER)  # Write the header template
-            old_mode = self._read_reg(_SCI_MODE)  # Current mode
+            if prealloc:  # Allocate clusters now rather than while recording
+                f.seek(len(_HEADER) + int(stop * sf * chans * 256 / 505_000) + _REC_BUF)
+                f.seek(0)
+            # Header template occupies the start of the first block: writes are sector aligned
+            overrun = self.record_stream(f, line, stop, sf, agc_gain, gain, stereo, _HEADER)
+            if prealloc:
+                try:
+                    f.truncate()  # Discard unused space
+                except AttributeError:  # Unsupported: header defines data length
+                    pass
+            f.seek(0)
+            f.write(wav_header(self._nsamples, sf, stereo))  # Single pass header finalisation
+        return overrun
+
+    # Record to any object with a write method, e.g. a socket. Blocks of
+    # recorded data are written as they fill. Short writes are retried, so a
+    # slow sink holds up recording: the chip buffers 1024 words meanwhile.
+    def record_stream(self, s, line, stop=10_000, sf=8000, agc_gain=None, gain=None, stereo=True,
+                      head=b''):
+        for buf in self.record_blocks(line, stop, sf, agc_gain, gain, stereo, head):
+            mv = memoryview(buf)
+            n = 0
+            while n < len(buf):
+                n += s.write(mv[n:]) or 0  # None: nonblocking stream could not accept data
+        return self._overrun
+
+    # Generator: record, yielding blocks of IMA ADPCM data. Blocks are 1024
+    # bytes except the last which may be shorter. The buffer is reused, so each
+    # block must be consumed before the next is requested. Recording proceeds
+    # at the consumer's pace: if it is too slow the chip's buffer overruns. Any
+    # head data, e.g. a wav header template, occupies the start of the first
+    # block. On completion the number of samples is available as
+    # player.nsamples().
+    def record_blocks(self, line, stop=10_000, sf=8000, agc_gain=None, gain=None, stereo=True,
+                      head=b''):
+        self._overrun = 0
+        self._nsamples = 0
+        buf = bytearray(_REC_BUF)
+        buf[: len(head)] = head
+        self._rbuf = buf
+        self._ridx = len(head)
+        if not callable(stop):
+            t = time.ticks_add(time.ticks_ms(), stop)
+            stop = lambda : time.ticks_diff(time.ticks_ms(), t) >= 0
+        with self._session:
+            old_mode = self._reg(_SCI_MODE)  # Current mode
             mode = old_mode | _SM_RESET | _SM_ADPCM
             if line:
                 mode |= _SM_LINE_IN
@@ -416,38 +952,55 @@ class VS1053:
             self._write_reg(_SCI_AICTRL3, 0 if stereo else 2)  # Always ADPCM. Mono is left channel.
             self._write_reg(_SCI_MODE, mode)  # Must start before patch.
             self._write_patch()
-
-            nsamples = 0  # Number of samples i.e. 16 bit words.
-            if callable(stop):
-                while not stop():
-                    nsamples += self._save(f)
+        yield from self._rec_blocks(stop)
+        yield memoryview(buf)[: self._ridx]
+
+    # Number of 16 bit words in the most recent recording.
+    def nsamples(self):
+        return self._nsamples
+
+    # Record Ogg Vorbis using the VLSI encoder application: see "VS1053b Ogg
+    # Vorbis Encoder" application note. encoder is the path to the encoder
+    # plugin file or a buffer holding it. Sample rate, channels and quality
+    # are defined by the encoder profile.
+    def record_ogg(self, fn, line, encoder, stop=10_000, agc_gain=None, gain=None):
+        self._overrun = 0
+        self._nsamples = 0
+        self._rbuf = bytearray(_REC_BUF)
+        self._ridx = 0
+        if not callable(stop):
+            t = time.ticks_add(time.ticks_ms(), stop)
+            stop = lambda : time.ticks_diff(time.ticks_ms(), t) >= 0
+        with open(fn, 'wb') as f:  # The session is not held across file access
+            with self._session:
+                self._write_reg(_SCI_BASS, 0)
+                self._write_reg(_SCI_CLOCKF, 0xc000)  # 4.5x: required by encoder
+                self._write_ram(_INT_ENABLE, 0x02)  # Disable all interrupts except SCI
+            if isinstance(encoder, str):
+                with open(encoder, 'rb') as s:
+                    self._patch_stream(s)
             else:
-                t = time.ticks_add(time.ticks_ms(), stop)
-                while time.ticks_diff(time.ticks_ms(), t) < 0:
-                    nsamples += self._save(f)
-
-        self._spi.init(baudrate = _DATA_BAUDRATE)
-        file_size += nsamples * 2
-        chans = 2 if stereo else 1
-        # Now know file size so patch header. Data 10.8.4. Arithmetic could be
-        # simplified. Keeping it close to datasheet for now.
-        with open(fn, 'r+b') as f:
-            # Stereo block is 256 words, mono 128.
-            nblocks = nsamples // (256 if stereo else 128)
-            f.seek(4)  # Datasheet ref ChunkSize
-            f.write(int.to_bytes(nblocks * 256 * chans + 52, 4, 'little'))
-            if not stereo:
-                f.seek(22)
-                f.write(b'\x01')
-                f.seek(33)
-                f.write(b'\x01')
-            f.seek(24)  # SampleRate
-            f.write(int.to_bytes(sf, 4, 'little'))
-            f.seek(28)  # ByteRate
-            f.write(int.to_bytes(round(sf * 256 * chans / 505), 4, 'little'))
-            f.seek(48)  # NumOfSamples
-            f.write(int.to_bytes(nblocks * 505, 4, 'little'))  # Stereo??
-            f.seek(56)  # SubChunk3Size
-            f.write(int.to_bytes(nblocks * 256 * chans, 4, 'little'))
-        # print('nsamples', nsamples)
+                self.patch_from_buffer(encoder)
+            with self._session:
+                mode = self._reg(_SCI_MODE) | _SM_ADPCM
+                if line:
+                    mode |= _SM_LINE_IN
+                self._write_reg(_SCI_MODE, mode)
+                self._write_reg(_SCI_AICTRL1, self.from_db(gain))  # None == AGC
+                self._write_reg(_SCI_AICTRL2, self.from_db(agc_gain))  # Max AGC gain
+                self._write_reg(_SCI_AICTRL3, 0)
+                self._write_reg(_SCI_AIADDR, 0x34)  # Start the encoder
+
+            for buf in self._rec_blocks(stop):
+                f.write(buf)
+            with self._session:
+                self._write_reg(_SCI_AICTRL3, self._read_reg(_SCI_AICTRL3) | 1)  # Request stop
+            done = lambda : self._read_reg(_SCI_AICTRL3) & 2  # Encoder has finished
+            for buf in self._rec_blocks(done):  # Includes remaining data
+                f.write(buf)
+            status = self._read_reg(_SCI_AICTRL3)
+            n = self._ridx
+            if n and status & 4:  # Last word holds only one byte
+                n -= 1
+            f.write(memoryview(self._rbuf)[:n])
         return self._overrun
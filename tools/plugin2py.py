@@ -0,0 +1,72 @@
+#! /usr/bin/env python3
+# plugin2py.py Convert a VS1053 plugin binary to a Python module
+# (C) Peter Hinch 2020-2022
+# Released under the MIT licence
+
+# Runs under CPython. Usage:
+# $ python3 tools/plugin2py.py plugins/flac_plugin.bin [flac_plugin.py]
+# The output module defines PLUGIN, a bytes object holding the image. When the
+# module is frozen into firmware the bytes object is stored in flash and may
+# be applied with VS1053.patch_from_buffer without using RAM or a filesystem:
+# from flac_plugin import PLUGIN
+# player.patch_from_buffer(PLUGIN)
+# The image is retained in its compressed form; bytes rather than array('H')
+# is used because an array would be created in RAM at import time.
+
+import os
+import sys
+
+_LINE = 24  # Bytes per line of output
+
+
+# Check that data is a valid image: a sequence of (address, count, data)
+# records of little-endian 16 bit words. Return the number of words written
+# to the chip.
+def check(data):
+    if not data:
+        raise ValueError('Empty image')
+    if len(data) & 1:
+        raise ValueError('Image has odd length')
+    words = [data[i] | data[i + 1] << 8 for i in range(0, len(data), 2)]
+    i = 0
+    total = 0
+    while i < len(words):
+        if i + 2 > len(words) or words[i] > 0x0f:
+            raise ValueError('Invalid record at byte {}'.format(2 * i))
+        count = words[i + 1]
+        i += 2
+        if count & 0x8000:  # RLE run
+            i += 1
+            total += count & 0x7fff
+        else:  # Copy run
+            i += count
+            total += count
+        if i > len(words):
+            raise ValueError('Truncated image')
+    return total
+
+
+def convert(src, dst):
+    with open(src, 'rb') as f:
+        data = f.read()
+    nwords = check(data)
+    with open(dst, 'w') as f:
+        f.write('# {} Generated by plugin2py.py from {}\n'.format(
+                os.path.basename(dst), os.path.basename(src)))
+        f.write('# {} bytes, {} words written to the VS1053.\n'.format(len(data), nwords))
+        f.write('# Freeze into firmware and apply with VS1053.patch_from_buffer(PLUGIN).\n\n')
+        f.write('PLUGIN = (\n')
+        for n in range(0, len(data), _LINE):
+            f.write("    b'{}'\n".format(''.join('\\x{:02x}'.format(b) for b in data[n : n + _LINE])))
+        f.write(')\n')
+    return len(data), nwords
+
+
+if __name__ == '__main__':
+    if not 2 <= len(sys.argv) <= 3:
+        print('Usage: plugin2py.py infile [outfile]')
+        sys.exit(1)
+    src = sys.argv[1]
+    dst = sys.argv[2] if len(sys.argv) == 3 else os.path.splitext(os.path.basename(src))[0] + '.py'
+    nbytes, nwords = convert(src, dst)
+    print('{} -> {}: {} bytes, {} words'.format(src, dst, nbytes, nwords))